@@ -1,23 +1,46 @@
 import io
+import ast
+import atexit
 import base64
+import bisect
+import contextlib
+import copy
+import functools
+import gzip
+import hashlib
+import importlib
+import itertools
+import math
+import multiprocessing
+import operator
 import os
+import queue
 import re
 import json
-from flask import Flask, request, render_template, send_file, redirect, url_for, jsonify, session, flash, send_from_directory
+import logging
+import shutil
+import signal
+import threading
+import time
+import tokenize
+import uuid
+import weakref
+import zipfile
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait as wait_futures
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, g, has_request_context, request, render_template, send_file, redirect, url_for, jsonify, session, flash, send_from_directory, stream_with_context
+import click
 import pandas as pd
 import numpy as np
-from docxtpl import DocxTemplate, InlineImage
-from docx.shared import Mm
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-import plotly.express as px      
-from docxtpl import DocxTemplate
+from pandas.api.types import union_categoricals
+from jinja2 import Environment
 from dotenv import load_dotenv
 from werkzeug.utils import secure_filename
-from datetime import datetime
-from flask_mail import Mail, Message
+from urllib.parse import quote
+from datetime import datetime, date
+# docxtpl/python-docx, plotly, the Google API clients and Flask-Mail are imported where they
+# are used, so a worker only pays for them once a request needs them (or warm_up runs)
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
@@ -27,19 +50,22 @@ load_dotenv('.env')
 
 UPLOAD_FOLDER = 'uploads'
 GENERATED_FOLDER = 'generated'
+CACHE_FOLDER = 'cache'
+CHART_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'charts')
+SESSION_FOLDER = os.path.join(CACHE_FOLDER, 'sessions')
 SETTINGS_PATH = os.path.join(UPLOAD_FOLDER, 'settings.json')
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 REDIRECT_URI = os.getenv("REDIRECT_URI")
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(GENERATED_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+os.makedirs(CHART_CACHE_FOLDER, exist_ok=True)
+os.makedirs(SESSION_FOLDER, exist_ok=True)
 
-cached_docx_path = None
-cached_csv_path = None
-cached_dataframe = None
-date_column = None
-date_min = None
-date_max = None
+# Per-user state (template/CSV paths, dataset id) is kept server-side in dataset_store under
+# an opaque id from the session cookie, so any worker process can serve any request.
 
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 587
@@ -49,28 +75,125 @@ app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 app.config['MAIL_DEFAULT_SENDER'] = os.getenv('MAIL_USERNAME')
 
-mail = Mail(app)
+_mail = None
+
+def get_mail():
+    global _mail
+    if _mail is None:
+        from flask_mail import Mail
+        _mail = Mail(app)
+    return _mail
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logger = logging.getLogger('reportgen')
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(process)d] %(message)s'))
+    logger.addHandler(_log_handler)
+    logger.propagate = False
+
+# Upper bounds (ms) of the latency histogram buckets served by /metrics
+METRIC_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+def observe(metric, seconds):
+    """Add one duration to the `metric` histogram."""
+    ms = seconds * 1000
+    with _metrics_lock:
+        histogram = _metrics.get(metric)
+        if histogram is None:
+            histogram = _metrics[metric] = {'count': 0, 'sum_ms': 0.0, 'buckets': [0] * (len(METRIC_BUCKETS_MS) + 1)}
+        histogram['count'] += 1
+        histogram['sum_ms'] += ms
+        histogram['buckets'][bisect.bisect_left(METRIC_BUCKETS_MS, ms)] += 1
+
+@contextlib.contextmanager
+def span(metric, detail=None):
+    """Time a block: aggregated into the `metric` histogram and, inside a request, reported in its
+    Server-Timing header (per `detail`, e.g. the variable name, so each formula shows up on its own)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(metric, elapsed)
+        if has_request_context() and 'spans' in g:
+            g.spans.append((metric, detail, elapsed))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.spans = []
+
+@app.after_request
+def add_server_timing(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    observe(f"request:{request.endpoint or 'unknown'}", elapsed)
+    entries = []
+    for i, (metric, detail, seconds) in enumerate(g.spans):
+        token = re.sub(r'[^A-Za-z0-9_.-]', '_', metric if detail is None else f"{metric}.{i}")
+        entry = f"{token};dur={seconds * 1000:.2f}"
+        if detail is not None:
+            entry += f';desc="{quote(str(detail))}"'
+        entries.append(entry)
+    entries.append(f"total;dur={elapsed * 1000:.2f}")
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+CHART_WIDTH = 800
+CHART_HEIGHT = 600
+CHART_POOL_SIZE = int(os.getenv('CHART_POOL_SIZE', str(min(4, os.cpu_count() or 1))))
+# Deadline for all the charts one render_chart_images call sends to the pool
+CHART_RENDER_TIMEOUT = float(os.getenv('CHART_RENDER_TIMEOUT', '60'))
+CHART_CACHE_MAX_BYTES = int(os.getenv('CHART_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+_chart_pool = None
+# Chart workers report their pid on this queue, so a hung pool can be killed
+_chart_pool_pid_queue = None
+_chart_pool_pids = set()
+
+def aggregate_chart_data(df, x_col, y_col, chart_type):
+    """The grouped rows a line, bar or pie chart plots (histograms bin raw values)."""
+    window = view_range(df)
+    if window is not None and window[0].rollup is not None:
+        dataset, lo, hi = window
+        days = dataset.rollup.window(lo, hi)
+        data = dataset.rollup.chart_data(x_col, y_col, chart_type, *days) if days is not None else None
+        if data is not None:
+            return data
+    if chart_type == 'line':
+        # Don't write the parsed dates back: df may be a view of the shared dataset
+        x_dates = pd.to_datetime(df[x_col], errors='coerce')
+        daily_df = df.groupby(x_dates.dt.date).agg({y_col: 'sum'}).reset_index()
+        daily_df.rename(columns={daily_df.columns[0]: x_col}, inplace=True)
+        return daily_df
+    if chart_type in ('bar', 'pie'):
+        return df.groupby(x_col).agg({y_col: 'sum'}).reset_index()
+    raise ValueError(f"不支援的圖表類型: {chart_type}")
 
-def generate_chart(df, x_col, y_col, chart_type, output_path, chart_title=None, dpi_scale=2):
+def build_chart_figure(df, x_col, y_col, chart_type, chart_title=None):
+    import plotly.express as px
     fig = None
 
     title = chart_title if chart_title else f"{y_col} by {x_col}"
 
     if chart_type == 'line':
-        df[x_col] = pd.to_datetime(df[x_col], errors='coerce')
-        daily_df = df.groupby(df[x_col].dt.date).agg({y_col: 'sum'}).reset_index()
-        daily_df.rename(columns={daily_df.columns[0]: x_col}, inplace=True)
+        daily_df = aggregate_chart_data(df, x_col, y_col, chart_type)
         fig = px.line(daily_df, x=x_col, y=y_col, title=title, template='simple_white')
     
     elif chart_type == 'bar':
-        bar_df = df.groupby(x_col).agg({y_col: 'sum'}).reset_index()
+        bar_df = aggregate_chart_data(df, x_col, y_col, chart_type)
         fig = px.bar(bar_df, x=x_col, y=y_col, title=title, template='simple_white')
     
     elif chart_type == 'hist':
         fig = px.histogram(df, x=y_col, nbins=20, title=title, template='simple_white')
     
     elif chart_type == 'pie':
-        pie_data = df.groupby(x_col)[y_col].sum().reset_index()
+        pie_data = aggregate_chart_data(df, x_col, y_col, chart_type)
         fig = px.pie(pie_data, values=y_col, names=x_col, title=title)
     
     else:
@@ -87,43 +210,1053 @@ def generate_chart(df, x_col, y_col, chart_type, output_path, chart_title=None,
         paper_bgcolor='white',
         plot_bgcolor='white'
     )
+    return fig
+
+def _json_values(values):
+    # Plain JSON lists: dates as strings, NaN as null
+    series = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        series = series.dt.strftime('%Y-%m-%d')
+    elif len(series) and isinstance(series.iloc[0], (datetime, date)):
+        series = series.astype(str)
+    return [None if pd.isna(v) else (v.item() if hasattr(v, 'item') else v) for v in series]
+
+def build_chart_spec(df, x_col, y_col, chart_type, chart_title=None):
+    """Compact chart description for the browser to draw (preview fidelity), instead of a PNG."""
+    spec = {
+        'chartType': chart_type,
+        'title': chart_title if chart_title else f"{y_col} by {x_col}",
+        'xLabel': x_col,
+        'yLabel': y_col
+    }
+    if chart_type == 'hist':
+        values = pd.to_numeric(df[y_col], errors='coerce').dropna().to_numpy()
+        counts, edges = np.histogram(values, bins=20) if len(values) else (np.array([]), np.array([]))
+        spec['x'] = _json_values((edges[:-1] + edges[1:]) / 2)
+        spec['y'] = _json_values(counts)
+        spec['binWidth'] = float(edges[1] - edges[0]) if len(edges) > 1 else None
+        spec['xLabel'] = y_col
+        return spec
+
+    data = aggregate_chart_data(df, x_col, y_col, chart_type)
+    spec['x'] = _json_values(data[x_col])
+    spec['y'] = _json_values(data[y_col])
+    return spec
 
-    fig.write_image(output_path, width=800, height=600, scale=dpi_scale)
+def generate_chart(df, x_col, y_col, chart_type, output_path, chart_title=None, dpi_scale=2):
+    fig = build_chart_figure(df, x_col, y_col, chart_type, chart_title=chart_title)
+    with span('chart_export'):
+        image = render_chart_images({'chart': (fig, dpi_scale)})['chart']
+    if isinstance(image, Exception):
+        raise image
+    with open(output_path, 'wb') as f:
+        f.write(image)
+
+def chart_cache_key(fig, dpi_scale):
+    # The figure JSON carries the aggregated data, chart type, title and layout
+    digest = hashlib.sha256(fig.to_json().encode('utf-8'))
+    digest.update(f"|{CHART_WIDTH}x{CHART_HEIGHT}@{float(dpi_scale)}".encode('utf-8'))
+    return digest.hexdigest()
+
+def get_cached_chart(key):
+    path = os.path.join(CHART_CACHE_FOLDER, f"{key}.png")
+    try:
+        with open(path, 'rb') as f:
+            image = f.read()
+        os.utime(path)  # mtime marks recent use for LRU eviction
+        return image
+    except OSError:
+        return None
+
+def store_cached_chart(key, image):
+    path = os.path.join(CHART_CACHE_FOLDER, f"{key}.png")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(image)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("寫入圖表快取失敗: %s", e)
+        return
+    evict_chart_cache()
+
+def evict_chart_cache(max_bytes=None):
+    """Delete least recently used cached charts until the cache fits in CHART_CACHE_MAX_BYTES."""
+    max_bytes = CHART_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    with os.scandir(CHART_CACHE_FOLDER) as it:
+        for entry in it:
+            if entry.name.endswith('.png'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+    if total <= max_bytes:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= max_bytes:
+            break
+
+def _warm_chart_worker(pid_queue=None):
+    if pid_queue is not None:
+        pid_queue.put(os.getpid())
+    # Keep one Kaleido browser alive per worker process and pay its start-up cost up front
+    try:
+        import plotly.graph_objects as go
+        # Fails fast when no browser is available, before we start a server that would hang
+        go.Figure().to_image(format='png', width=10, height=10)
+        import kaleido
+        if hasattr(kaleido, 'start_sync_server'):
+            kaleido.start_sync_server(silence_warnings=True)
+    except Exception as e:
+        logger.warning("圖表工作程序預熱失敗: %s", e)
+
+def _render_chart_image(fig_json, dpi_scale):
+    import plotly.io as pio
+    fig = pio.from_json(fig_json)
+    return fig.to_image(format='png', width=CHART_WIDTH, height=CHART_HEIGHT, scale=dpi_scale)
+
+def get_chart_pool():
+    """Lazily start the pool of warm chart exporter processes (None when CHART_POOL_SIZE is 0)."""
+    global _chart_pool, _chart_pool_pid_queue
+    if _chart_pool is None and CHART_POOL_SIZE > 0:
+        # spawn: Kaleido drives a browser from background threads, which doesn't survive fork
+        context = multiprocessing.get_context('spawn')
+        _chart_pool_pid_queue = context.SimpleQueue()
+        _chart_pool = ProcessPoolExecutor(max_workers=CHART_POOL_SIZE, mp_context=context,
+                                          initializer=_warm_chart_worker, initargs=(_chart_pool_pid_queue,))
+    return _chart_pool
+
+def _chart_worker_pids():
+    while _chart_pool_pid_queue is not None and not _chart_pool_pid_queue.empty():
+        _chart_pool_pids.add(_chart_pool_pid_queue.get())
+    return set(_chart_pool_pids)
+
+def shutdown_chart_pool(kill=False):
+    global _chart_pool, _chart_pool_pid_queue
+    pool, _chart_pool = _chart_pool, None
+    if pool is None:
+        return
+    if kill:
+        # A hung export never returns; terminate the workers so the next pool starts clean
+        for pid in _chart_worker_pids():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    _chart_pool_pids.clear()
+    _chart_pool_pid_queue = None
+    pool.shutdown(wait=not kill, cancel_futures=True)
+
+atexit.register(shutdown_chart_pool)
+
+def render_chart_images(figures):
+    """Export {name: (fig, dpi_scale)} to PNG bytes, all charts at once across the chart pool.
+
+    Charts already in the content-addressed image cache are not exported again.
+    Returns {name: bytes | Exception}; charts the pool hasn't finished CHART_RENDER_TIMEOUT seconds
+    after submission get a TimeoutError, and the pool is restarted.
+    """
+    results = {}
+    pending = {}
+    keys = {}
+    for name, (fig, dpi_scale) in figures.items():
+        keys[name] = chart_cache_key(fig, dpi_scale)
+        cached = get_cached_chart(keys[name])
+        if cached is not None:
+            results[name] = cached
+        else:
+            pending[name] = (fig, dpi_scale)
+    exported = set(pending)
+    pool = get_chart_pool()
+
+    if pool is not None and pending:
+        try:
+            futures = {name: pool.submit(_render_chart_image, fig.to_json(), dpi_scale)
+                       for name, (fig, dpi_scale) in pending.items()}
+        except BrokenProcessPool:
+            shutdown_chart_pool(kill=True)
+            futures = {}
+
+        # One deadline for the whole set, not one per chart waited on
+        _, not_done = wait_futures(futures.values(), timeout=CHART_RENDER_TIMEOUT)
+        for name, future in futures.items():
+            if future in not_done:
+                results[name] = TimeoutError(f"圖表 '{name}' 產生逾時（{CHART_RENDER_TIMEOUT:g} 秒）")
+                pending.pop(name, None)
+                continue
+            try:
+                results[name] = future.result()
+            except BrokenProcessPool:
+                continue  # Retried in-process below
+            except Exception as e:
+                results[name] = e
+            pending.pop(name, None)
+
+        if not_done:
+            shutdown_chart_pool(kill=True)
+
+    # No pool (or it broke): export in this process
+    for name, (fig, dpi_scale) in pending.items():
+        try:
+            results[name] = fig.to_image(format='png', width=CHART_WIDTH, height=CHART_HEIGHT, scale=dpi_scale)
+        except Exception as e:
+            results[name] = e
+
+    for name in exported:
+        if not isinstance(results.get(name), Exception):
+            store_cached_chart(keys[name], results[name])
+    return results
+
+_file_hash_memo = {}
+
+def file_content_hash(path):
+    """sha256 of a file's contents, memoised on (path, size, mtime) so unchanged files aren't reread."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _file_hash_memo[memo_key] = digest.hexdigest()
+    return _file_hash_memo[memo_key]
+
+def remember_content_hash(path, content_hash):
+    """Record the hash of a file just written (and hashed on the way) so it isn't read back."""
+    stat = os.stat(path)
+    _file_hash_memo[(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)] = content_hash
+
+TEMPLATE_CACHE_SIZE = int(os.getenv('TEMPLATE_CACHE_SIZE', '8'))
+
+class _CachingEnvironment(Environment):
+    """Jinja environment that compiles each distinct template source only once."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self._compiled = {}
+
+    def from_string(self, source, globals=None, template_class=None):
+        if globals or template_class:
+            return super().from_string(source, globals, template_class)
+        compiled = self._compiled.get(source)
+        if compiled is None:
+            compiled = self._compiled[source] = super().from_string(source)
+        return compiled
+
+class TemplateSkeleton:
+    """A parsed .docx template that every render copies, with its patched XML and compiled Jinja parts."""
+
+    def __init__(self, path):
+        from docx import Document
+        self.document = Document(path)
+        self.patched_xml = {}
+        self.jinja_env = _CachingEnvironment()
+
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+
+def get_template_skeleton(path):
+    """Skeleton of the template at `path`, keyed by content hash; keeps the TEMPLATE_CACHE_SIZE most recent."""
+    key = file_content_hash(path)
+    with _template_cache_lock:
+        skeleton = _template_cache.get(key)
+        if skeleton is not None:
+            _template_cache.move_to_end(key)
+            return skeleton
+    with span('template_parse'):
+        skeleton = TemplateSkeleton(path)
+    with _template_cache_lock:
+        skeleton = _template_cache.setdefault(key, skeleton)
+        _template_cache.move_to_end(key)
+        while len(_template_cache) > TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return skeleton
+
+@functools.lru_cache(maxsize=None)
+def report_template_class():
+    """ReportTemplate, defined on first use so docxtpl is only imported by workers that render."""
+    from docxtpl import DocxTemplate
+
+    class ReportTemplate(DocxTemplate):
+        """DocxTemplate that starts from a deep copy of the cached skeleton instead of unzipping and
+        parsing the file again, and reuses the skeleton's patched XML and compiled Jinja templates."""
+
+        def __init__(self, template_path):
+            super().__init__(template_path)
+            self.skeleton = get_template_skeleton(template_path)
+
+        def init_docx(self, reload=True):
+            if not self.docx or (self.is_rendered and reload):
+                self.docx = copy.deepcopy(self.skeleton.document)
+                self.is_rendered = False
+
+        def patch_xml(self, src_xml):
+            patched = self.skeleton.patched_xml.get(src_xml)
+            if patched is None:
+                patched = self.skeleton.patched_xml[src_xml] = super().patch_xml(src_xml)
+            return patched
+
+        def render(self, context, jinja_env=None, autoescape=False):
+            if jinja_env is None and not autoescape:
+                jinja_env = self.skeleton.jinja_env
+            super().render(context, jinja_env, autoescape)
+
+    return ReportTemplate
 
 def extract_template_variables(template_path):
-    doc = DocxTemplate(template_path)
     full_text = ""
-    for paragraph in doc.get_docx().paragraphs:
+    for paragraph in get_template_skeleton(template_path).document.paragraphs:
         full_text += paragraph.text + "\n"
     matches = re.findall(r"\{\{\s*(.*?)\s*\}\}", full_text)
     return list(set([match.strip() for match in matches]))
 
-def analyze_csv(csv_path):
-    global cached_dataframe, date_column, date_min, date_max
+def _dataset_cache_paths(content_hash):
+    return (os.path.join(CACHE_FOLDER, f"{content_hash}.feather"),
+            os.path.join(CACHE_FOLDER, f"{content_hash}.json"))
 
-    df = pd.read_csv(csv_path)
-    cached_dataframe = df
+def load_cached_dataset(content_hash):
+    """Memory-map a previously ingested dataset; returns (df, meta) or None."""
+    data_path, meta_path = _dataset_cache_paths(content_hash)
+    if not os.path.exists(data_path) or not os.path.exists(meta_path):
+        return None
+    try:
+        import pyarrow.feather as feather
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        df = feather.read_table(data_path, memory_map=True).to_pandas(split_blocks=True)
+        os.utime(meta_path)  # mtime marks recent use for the cache retention policy
+        return df, meta
+    except Exception as e:
+        logger.warning("讀取資料快取失敗 (%s): %s", content_hash, e)
+        return None
 
+def save_cached_dataset(content_hash, df, meta):
+    """Write the typed frame as uncompressed Feather (memory-mappable) plus its metadata."""
+    data_path, meta_path = _dataset_cache_paths(content_hash)
+    try:
+        import pyarrow.feather as feather
+        import pyarrow as pa
+        # Write to temp files first so other workers never see a half-written cache
+        tmp_suffix = f".{os.getpid()}.tmp"
+        feather.write_feather(pa.Table.from_pandas(df, preserve_index=False), data_path + tmp_suffix,
+                              compression='uncompressed')
+        with open(meta_path + tmp_suffix, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(data_path + tmp_suffix, data_path)
+        os.replace(meta_path + tmp_suffix, meta_path)
+    except Exception as e:
+        logger.warning("寫入資料快取失敗 (%s): %s", content_hash, e)
+
+SCHEMA_SAMPLE_SIZE = int(os.getenv('SCHEMA_SAMPLE_SIZE', '1000'))
+DATE_MATCH_RATIO = 0.9
+CATEGORICAL_MAX_RATIO = 0.5
+# Tried in order on the sample; the first one that parses (almost) every value wins
+DATE_FORMATS = [
+    '%Y-%m-%d', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M', '%m/%d/%Y', '%d/%m/%Y', '%m/%d/%Y %H:%M', '%d/%m/%Y %H:%M',
+    '%Y%m%d', '%Y.%m.%d', '%d-%m-%Y', '%m-%d-%Y', '%Y年%m月%d日'
+]
+
+def _infer_date_format(sample):
+    for fmt in DATE_FORMATS:
+        parsed = pd.to_datetime(sample, format=fmt, errors='coerce')
+        if parsed.notna().mean() >= DATE_MATCH_RATIO:
+            return fmt
+    # ISO 8601 with offsets, fractional seconds and the like
+    parsed = pd.to_datetime(sample, format='ISO8601', errors='coerce')
+    if parsed.notna().mean() >= DATE_MATCH_RATIO:
+        return 'ISO8601'
+    return None
+
+def infer_schema(df, sample_size=SCHEMA_SAMPLE_SIZE):
+    """Classify every column from an evenly spaced sample of at most `sample_size` rows.
+
+    Returns {column: {'kind': 'date' | 'numeric' | 'boolean' | 'categorical' | 'text', 'dtype': ..., 'format': ...}};
+    date columns carry the strptime format that parsed the sample.
+    """
+    if len(df) > sample_size:
+        positions = np.linspace(0, len(df) - 1, sample_size).astype(int)
+        sample_df = df.iloc[positions]
+    else:
+        sample_df = df
+
+    schema = {}
     for col in df.columns:
-        try:
-            parsed_dates = pd.to_datetime(df[col], errors='coerce')
-            if parsed_dates.notna().sum() > 0:
-                date_column = col
-                df[col] = parsed_dates
-                date_min = parsed_dates.min().date()
-                date_max = parsed_dates.max().date()
-                break
-        except:
-            continue
+        series = df[col]
+        sample = sample_df[col].dropna()
+        info = {'kind': 'text', 'dtype': str(series.dtype), 'format': None}
+
+        if pd.api.types.is_datetime64_any_dtype(series):
+            info['kind'] = 'date'
+        elif pd.api.types.is_bool_dtype(series):
+            info['kind'] = 'boolean'
+        elif pd.api.types.is_numeric_dtype(series):
+            # Numbers would otherwise parse as epoch timestamps
+            info['kind'] = 'numeric'
+        elif len(sample) > 0:
+            sample = sample.astype(str)
+            fmt = _infer_date_format(sample)
+            if fmt:
+                info['kind'] = 'date'
+                info['format'] = fmt
+            elif sample.nunique() <= max(1, len(sample) * CATEGORICAL_MAX_RATIO):
+                info['kind'] = 'categorical'
+        schema[col] = info
+    return schema
+
+# Files larger than this are read CSV_CHUNK_ROWS rows at a time, compacting each chunk as it arrives
+CSV_CHUNK_BYTES = int(os.getenv('CSV_CHUNK_BYTES', str(128 * 1024 * 1024)))
+CSV_CHUNK_ROWS = int(os.getenv('CSV_CHUNK_ROWS', '250000'))
+
+def compact_frame(df, categorical=()):
+    """Downcast integer columns to the smallest signed type that holds them and store the
+    `categorical` columns as categories. Floats keep float64 so sums don't lose precision."""
+    for col in df.columns:
+        series = df[col]
+        if series.dtype.kind == 'i':
+            df[col] = pd.to_numeric(series, downcast='integer')
+        elif col in categorical and not isinstance(series.dtype, pd.CategoricalDtype):
+            df[col] = series.astype('category')
+    return df
 
-    if not date_column:
+def _concat_chunks(chunks, categorical):
+    if len(chunks) == 1:
+        return chunks[0]
+    columns = {}
+    for col in chunks[0].columns:
+        pieces = [chunk[col] for chunk in chunks]
+        if col in categorical:
+            try:
+                # Merge the per-chunk categories instead of falling back to plain strings
+                columns[col] = pd.Series(union_categoricals(pieces, ignore_order=True), name=col)
+                continue
+            except TypeError:
+                pass
+        columns[col] = pd.concat(pieces, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def _memory_bytes(df):
+    return int(df.memory_usage(index=False, deep=True).sum())
+
+def parse_csv(csv_path, stream=None):
+    """Read a CSV, infer its schema and return the compacted frame sorted by the detected date column.
+
+    Large files are streamed in chunks; the schema comes from the first chunk. `stream`, a binary
+    file object with the CSV's bytes (e.g. a download in progress), is read in chunks instead of csv_path.
+    Returns (df, date_column, schema, memory) with memory = {'raw_bytes', 'compact_bytes'}.
+    """
+    chunked = stream is not None or os.path.getsize(csv_path) > CSV_CHUNK_BYTES
+    source = csv_path if stream is None else stream
+    chunks = iter(pd.read_csv(source, chunksize=CSV_CHUNK_ROWS) if chunked else [pd.read_csv(source)])
+    first = next(chunks)
+    schema = infer_schema(first)
+
+    # The leftmost date-like column wins, as before; it is the only column parsed as dates
+    detected_column = next((col for col, info in schema.items() if info['kind'] == 'date'), None)
+    if not detected_column:
         raise Exception("沒有找到日期欄位")
+    categorical = {col for col, info in schema.items() if info['kind'] == 'categorical'}
+
+    raw_bytes = 0
+    compacted = []
+    for chunk in itertools.chain([first], chunks):
+        raw_bytes += _memory_bytes(chunk)
+        if not pd.api.types.is_datetime64_any_dtype(chunk[detected_column]):
+            chunk[detected_column] = pd.to_datetime(chunk[detected_column], format=schema[detected_column]['format'], errors='coerce')
+        compacted.append(compact_frame(chunk, categorical))
+    df = _concat_chunks(compacted, categorical)
+    del compacted
+    for col in df.columns:
+        schema[col]['dtype'] = str(df[col].dtype)
+
+    # Keep rows sorted by date so any date range is a contiguous positional slice
+    df = df.sort_values(detected_column, kind='mergesort', na_position='last').reset_index(drop=True)
+    memory = {'raw_bytes': raw_bytes, 'compact_bytes': _memory_bytes(df)}
+    logger.info("CSV 載入完成: %d 列%s，記憶體 %.1f MB → %.1f MB", len(df), '（分段讀取）' if chunked else '',
+                memory['raw_bytes'] / 1048576, memory['compact_bytes'] / 1048576)
+    return df, detected_column, schema, memory
+
+# Datasets with at least this many rows get a daily rollup at ingest (0 turns rollups off)
+ROLLUP_MIN_ROWS = int(os.getenv('ROLLUP_MIN_ROWS', '100000'))
+# Categorical columns with more categories than this aren't rolled up
+ROLLUP_MAX_CARDINALITY = int(os.getenv('ROLLUP_MAX_CARDINALITY', '64'))
+ROLLUP_STATS = ['sum', 'count', 'min', 'max']
+
+def rollup_measures(df, date_column):
+    return [col for col in df.columns if col != date_column and df[col].dtype.kind in 'iuf']
+
+def build_rollup_table(df, date_column, measures, dimension=None):
+    """Rows per day (and per `dimension` value) plus sum/count/min/max of each measure,
+    sorted by day. Columns: date_column, [dimension], rows, <measure>_<stat>..."""
+    keys = [df[date_column].dt.floor('D')] + ([df[dimension]] if dimension else [])
+    grouped = df.groupby(keys, observed=True, sort=True)
+    table = grouped[measures].agg(ROLLUP_STATS) if measures else pd.DataFrame(index=grouped.size().index)
+    table.columns = [f"{col}_{stat}" for col, stat in table.columns]
+    table.insert(0, 'rows', grouped.size())
+    return table.reset_index()
+
+class DailyRollup:
+    """Per-day pre-aggregates of a dataset: one table over all rows and one per
+    low-cardinality categorical column (date × category). Built once at ingest.
+
+    Only windows that start and end on day boundaries can be answered from it;
+    `window` returns None for anything else and callers fall back to the rows.
+
+    `base` is the rollup of a leading part of df's rows (the dataset df extends with
+    appended rows): its days are kept and only the rows from its last day on, which
+    the new rows may continue, are aggregated again.
+    """
+
+    def __init__(self, df, date_column, base=None):
+        self.date_column = date_column
+        self.measures = rollup_measures(df, date_column)
+        dimensions = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)
+                      and len(df[col].cat.categories) <= ROLLUP_MAX_CARDINALITY]
+        if base is not None and (base.measures != self.measures or list(base.by_dimension) != dimensions):
+            base = None
+        start = int(base.day_starts[-2]) if base is not None and len(base.days) else 0
+        tail = df.iloc[start:]
+
+        self.daily = build_rollup_table(tail, date_column, self.measures)
+        self.by_dimension = {col: build_rollup_table(tail, date_column, self.measures, col) for col in dimensions}
+        if start:
+            last_day = base.days[-1]
+            self.daily = pd.concat([base.daily.iloc[:len(base.days) - 1], self.daily], ignore_index=True)
+            for col, table in self.by_dimension.items():
+                kept = base.by_dimension[col]
+                kept = kept.iloc[:np.searchsorted(kept[date_column].to_numpy(), last_day)]
+                # Appended rows may have added categories
+                kept = kept.assign(**{col: kept[col].astype(df[col].dtype)})
+                self.by_dimension[col] = pd.concat([kept, table], ignore_index=True)
+        self.days = self.daily[date_column].to_numpy()
+        # Row offset where each day starts in the date-sorted frame, plus the end of the last day
+        self.day_starts = np.concatenate(([0], np.cumsum(self.daily['rows'].to_numpy())))
+        self.nbytes = sum(_memory_bytes(table) for table in itertools.chain([self.daily], self.by_dimension.values()))
+
+    def window(self, lo, hi):
+        """Days [d0, d1) covering exactly rows [lo, hi), or None when the rows split a day."""
+        d0, d1 = np.searchsorted(self.day_starts, [lo, hi])
+        if d0 < len(self.day_starts) and d1 < len(self.day_starts) \
+                and self.day_starts[d0] == lo and self.day_starts[d1] == hi:
+            return int(d0), int(d1)
+        return None
+
+    def table(self, d0, d1, dimension=None):
+        if dimension is None:
+            return self.daily.iloc[d0:d1]
+        table = self.by_dimension[dimension]
+        dates = table[self.date_column].to_numpy()
+        start = np.searchsorted(dates, self.days[d0]) if d0 < len(self.days) else len(table)
+        end = np.searchsorted(dates, self.days[d1]) if d1 < len(self.days) else len(table)
+        return table.iloc[start:end]
+
+    def extreme(self, func, column, d0, d1):
+        if column not in self.measures:
+            return None
+        values = self.daily[f"{column}_{func}"].iloc[d0:d1]
+        value = values.min() if func == 'min' else values.max()
+        if pd.isna(value):
+            return float('nan')
+        return int(value) if values.dtype.kind in 'iu' else float(value)
+
+    def chart_data(self, x_col, y_col, chart_type, d0, d1):
+        """Same frame as aggregate_chart_data for a daily line or a category bar/pie, else None."""
+        if y_col not in self.measures:
+            return None
+        if chart_type == 'line' and x_col == self.date_column:
+            rows = self.daily.iloc[d0:d1]
+            return pd.DataFrame({x_col: rows[x_col].dt.date.to_numpy(), y_col: rows[f"{y_col}_sum"].to_numpy()})
+        if chart_type in ('bar', 'pie') and x_col in self.by_dimension:
+            rows = self.table(d0, d1, x_col)
+            return rows.groupby(x_col, observed=True)[f"{y_col}_sum"].sum().rename(y_col).reset_index()
+        return None
+
+class Dataset:
+    """An ingested CSV: the date-sorted typed frame plus what range queries need."""
+
+    def __init__(self, dataset_id, df, date_column, schema, base=None):
+        """`base` is the dataset df extends with appended rows (all dated no earlier than base's);
+        its indexes are extended rather than rebuilt."""
+        dates = df[date_column]
+        self.id = dataset_id
+        self.df = df
+        self.date_column = date_column
+        self.schema = schema
+        # Appended CSVs stacked on the last fully stored dataset (see DatasetStore.append_csv)
+        self.segments = base.segments + 1 if base is not None else 0
+        # Sorted datetime64 values of date_column (NaT excluded)
+        self.date_index = dates.to_numpy()[:int(dates.notna().sum())]
+        self.date_min = pd.Timestamp(self.date_index[0]).date()
+        self.date_max = pd.Timestamp(self.date_index[-1]).date()
+        self._build_prefix_sums(base)
+        self.rollup = None
+        if ROLLUP_MIN_ROWS and len(df) >= ROLLUP_MIN_ROWS:
+            with span('rollup_build'):
+                self.rollup = DailyRollup(df.iloc[:len(self.date_index)], date_column,
+                                          base.rollup if base is not None else None)
+        self.nbytes = int(df.memory_usage(index=False, deep=True).sum()) + sum(
+            a.nbytes for a in itertools.chain(self.prefix_sums.values(), self.prefix_counts.values()))
+        if self.rollup is not None:
+            self.nbytes += self.rollup.nbytes
+
+    def _build_prefix_sums(self, base=None):
+        # Running totals in date order with a leading 0, so rows [lo, hi) sum to p[hi] - p[lo].
+        # prefix_counts only holds columns with missing values; elsewhere the count is hi - lo.
+        # The dated rows of `base` come first and unchanged, so their totals are reused.
+        # Float columns holding ±inf get no prefix sums (a difference of two infinite totals is
+        # NaN), so their sums and means are computed from the rows.
+        start = len(base.date_index) if base is not None else 0
+        tail = self.df.iloc[start:]
+        self.prefix_sums = {}
+        self.prefix_counts = {}
+        for col in self.df.columns:
+            series = tail[col]
+            nulls = series.isna().to_numpy()
+            counts = base.prefix_counts.get(col) if base is not None else None
+            if counts is not None or nulls.any():
+                head = counts[:start + 1] if counts is not None else np.arange(start + 1, dtype=np.int64)
+                self.prefix_counts[col] = np.concatenate((head, head[-1] + np.cumsum(~nulls, dtype=np.int64)))
+            kind = series.dtype.kind
+            if kind in 'iub':
+                values, dtype = series.to_numpy(), np.int64
+            elif kind == 'f':
+                values, dtype = np.where(nulls, 0.0, series.to_numpy(dtype=np.float64)), np.float64
+                if np.isinf(values).any():
+                    continue
+            else:
+                continue
+            sums = base.prefix_sums.get(col) if base is not None else None
+            if sums is None and start:
+                continue
+            head = sums[:start + 1].astype(dtype, copy=False) if sums is not None else np.zeros(1, dtype)
+            self.prefix_sums[col] = np.concatenate((head, head[-1] + np.cumsum(values, dtype=dtype)))
+
+    def append(self, dataset_id, rows):
+        """A new Dataset with `rows` (aligned to this one by align_appended_rows, sorted by date) added.
+
+        When no new row is dated before the last existing one, the rows go after the existing
+        dated rows and only they are indexed. Otherwise the whole frame is re-sorted and rebuilt.
+        """
+        dated = int(rows[self.date_column].notna().sum())
+        n_dated = len(self.date_index)
+        in_order = dated == 0 or rows[self.date_column].iloc[0] >= self.date_index[-1]
+        categorical = {col for col in self.df.columns if isinstance(self.df[col].dtype, pd.CategoricalDtype)}
+        # Undated rows stay at the end, as parse_csv leaves them
+        df = _concat_chunks([self.df.iloc[:n_dated], rows.iloc[:dated], self.df.iloc[n_dated:], rows.iloc[dated:]],
+                            categorical)
+        schema = {col: dict(info, dtype=str(df[col].dtype)) for col, info in self.schema.items()}
+        if in_order:
+            return Dataset(dataset_id, df, self.date_column, schema, base=self)
+        logger.info("附加資料早於現有資料的最後日期，重新排序並重建索引")
+        df = df.sort_values(self.date_column, kind='mergesort', na_position='last').reset_index(drop=True)
+        dataset = Dataset(dataset_id, df, self.date_column, schema)
+        dataset.segments = self.segments + 1
+        return dataset
+
+    def range_aggregate(self, func, column, lo, hi):
+        """SUM, COUNT or MEAN of `column` over rows [lo, hi) in O(1), MIN or MAX from the daily
+        rollup; None when neither index can answer it."""
+        if func in ('min', 'max'):
+            days = self.rollup.window(lo, hi) if self.rollup is not None else None
+            return self.rollup.extreme(func, column, *days) if days is not None else None
+        if func == 'count':
+            counts = self.prefix_counts.get(column)
+            if counts is not None:
+                return int(counts[hi] - counts[lo])
+            return hi - lo if column in self.df.columns else None
+        sums = self.prefix_sums.get(column)
+        if sums is None or func not in ('sum', 'mean'):
+            return None
+        total = sums[hi] - sums[lo]
+        total = int(total) if sums.dtype.kind == 'i' else float(total)
+        if func == 'sum':
+            return total
+        count = self.range_aggregate('count', column, lo, hi)
+        return total / count if count else float('nan')
+
+    def bounds(self, start_date, end_date):
+        """Positional [lo, hi) rows of the sorted frame within start_date..end_date (inclusive)."""
+        start = pd.to_datetime(start_date).to_datetime64()
+        end = pd.to_datetime(end_date).to_datetime64()
+        lo = int(np.searchsorted(self.date_index, start, side='left'))
+        hi = int(np.searchsorted(self.date_index, end, side='right'))
+        return lo, max(lo, hi)
+
+    def rollup_table(self, lo, hi, dimension=None):
+        """Daily rollup rows for rows [lo, hi), from the prebuilt rollup when it covers them."""
+        days = self.rollup.window(lo, hi) if self.rollup is not None else None
+        if days is not None and (dimension is None or dimension in self.rollup.by_dimension):
+            return self.rollup.table(*days, dimension)
+        return build_rollup_table(self.df.iloc[lo:hi], self.date_column,
+                                  rollup_measures(self.df, self.date_column), dimension)
+
+    def slice(self, start_date, end_date):
+        # O(log n) lookup into the date index; iloc slicing doesn't copy the rows
+        lo, hi = self.bounds(start_date, end_date)
+        view = self.df.iloc[lo:hi]
+        _register_view(view, self, lo, hi)
+        return view
+
+# id(view) -> (dataset, lo, hi) for frames returned by Dataset.slice, dropped when the view is
+# collected; frames derived from a view are new objects and so never match
+_view_ranges = {}
+
+def _register_view(view, dataset, lo, hi):
+    key = id(view)
+    _view_ranges[key] = (dataset, lo, hi)
+    weakref.finalize(view, _view_ranges.pop, key, None)
+
+def view_range(df):
+    """(dataset, lo, hi) when `df` is an unmodified date window of a dataset, else None."""
+    entry = _view_ranges.get(id(df))
+    if entry is not None and len(df) == entry[2] - entry[1]:
+        return entry
+    return None
+
+DATASET_MEMORY_BUDGET = int(os.getenv('DATASET_MEMORY_BUDGET', str(1024 * 1024 * 1024)))
+# Appended segments cached on top of one full copy of a dataset before it is written out whole
+DATASET_MAX_SEGMENTS = int(os.getenv('DATASET_MAX_SEGMENTS', '8'))
+# Schema kinds that may be mixed when appending (a string column can look categorical in one file only)
+SCHEMA_KIND_FAMILIES = {'date': 'date', 'numeric': 'numeric', 'boolean': 'boolean', 'categorical': 'text', 'text': 'text'}
+
+def align_appended_rows(dataset, df, date_column, schema):
+    """Check rows parsed from an appended CSV against `dataset` and give them its column order
+    and dtypes. Columns that are entirely empty in the new rows are not type-checked.
+    Raises ValueError listing every mismatch."""
+    problems = []
+    missing = [str(col) for col in dataset.df.columns if col not in df.columns]
+    extra = [str(col) for col in df.columns if col not in dataset.df.columns]
+    if missing:
+        problems.append(f"缺少欄位 {', '.join(missing)}")
+    if extra:
+        problems.append(f"多出欄位 {', '.join(extra)}")
+    if date_column != dataset.date_column:
+        problems.append(f"日期欄位為 {date_column}，應為 {dataset.date_column}")
+    for col in dataset.df.columns:
+        if col not in df.columns or col == dataset.date_column or df[col].isna().all():
+            continue
+        expected, actual = dataset.schema[col]['kind'], schema[col]['kind']
+        if SCHEMA_KIND_FAMILIES.get(expected) != SCHEMA_KIND_FAMILIES.get(actual):
+            problems.append(f"欄位 {col} 應為 {expected}，卻是 {actual}")
+    if problems:
+        raise ValueError("附加的資料與現有資料結構不符：" + "；".join(problems))
+
+    rows = df[list(dataset.df.columns)]
+    for col in rows.columns:
+        target = dataset.df[col].dtype
+        series = rows[col]
+        if series.isna().all():
+            try:
+                rows[col] = pd.Series(np.nan, index=rows.index, dtype=target)
+            except (TypeError, ValueError):
+                pass
+        elif isinstance(target, pd.CategoricalDtype) != isinstance(series.dtype, pd.CategoricalDtype) \
+                and SCHEMA_KIND_FAMILIES.get(dataset.schema[col]['kind']) == 'text':
+            rows[col] = series.astype('category' if isinstance(target, pd.CategoricalDtype) else target)
+    return rows
+
+class DatasetStore:
+    """Process-local LRU of datasets keyed by content hash, bounded by DATASET_MEMORY_BUDGET bytes.
+
+    The Feather files under CACHE_FOLDER are the shared copy: every worker process
+    memory-maps the same file, so an evicted dataset (or one ingested by another
+    worker) is reloaded from disk instead of re-parsing the CSV.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dataset_id):
+        if not dataset_id:
+            return None
+        with self._lock:
+            dataset = self._datasets.get(dataset_id)
+            if dataset is not None:
+                self._datasets.move_to_end(dataset_id)
+                return dataset
+        with span('dataset_load'):
+            cached = load_cached_dataset(dataset_id)
+        if not cached:
+            return None
+        df, meta = cached
+        if meta.get('base'):
+            # A segment: only the appended rows are stored, on top of their base dataset
+            base = self.get(meta['base'])
+            if base is None:
+                return None
+            with span('dataset_append'):
+                return self._add(base.append(dataset_id, df))
+        return self._add(Dataset(dataset_id, df, meta['date_column'], meta.get('schema') or infer_schema(df)))
+
+    def load_csv(self, csv_path):
+        content_hash = file_content_hash(csv_path)
+        dataset = self.get(content_hash)
+        if dataset is not None:
+            return dataset
+
+        with span('parse_csv'):
+            parsed = parse_csv(csv_path)
+        return self.add_parsed(content_hash, csv_path, parsed)
+
+    def append_csv(self, base, csv_path):
+        """`base` extended with the rows of csv_path, which must match its schema (ValueError otherwise).
+
+        Costs time in proportion to the new rows: they are parsed, checked and indexed on their
+        own, and cached as a Feather segment that points at `base`. Every DATASET_MAX_SEGMENTS
+        appends the whole frame is written out instead, so cold loads don't replay a long chain.
+        """
+        dataset_id = hashlib.sha256(f"{base.id}+{file_content_hash(csv_path)}".encode('utf-8')).hexdigest()
+        dataset = self.get(dataset_id)
+        if dataset is not None:
+            return dataset
+
+        with span('parse_csv'):
+            df, date_column, schema, memory = parse_csv(csv_path)
+        rows = align_appended_rows(base, df, date_column, schema)
+        with span('dataset_append'):
+            dataset = base.append(dataset_id, rows)
+
+        meta = {
+            'source': os.path.basename(csv_path),
+            'date_column': dataset.date_column,
+            'dtypes': {col: str(dtype) for col, dtype in dataset.df.dtypes.items()},
+            'schema': dataset.schema,
+            'rows': len(dataset.df)
+        }
+        if dataset.segments > DATASET_MAX_SEGMENTS:
+            dataset.segments = 0
+            save_cached_dataset(dataset_id, dataset.df, meta)
+        else:
+            save_cached_dataset(dataset_id, rows, dict(meta, base=base.id, segment_rows=len(rows)))
+        logger.info("附加 %d 列至資料集 %s → %s（共 %d 列）", len(rows), base.id[:12], dataset_id[:12], len(dataset.df))
+        return self._add(dataset)
+
+    def add_parsed(self, content_hash, csv_path, parsed):
+        """Cache and hold the parse_csv result of the file whose contents hash to content_hash."""
+        dataset = self.get(content_hash)
+        if dataset is not None:
+            return dataset
+        df, detected_column, schema, memory = parsed
+        save_cached_dataset(content_hash, df, {
+            'source': os.path.basename(csv_path),
+            'date_column': detected_column,
+            'dtypes': {col: str(dtype) for col, dtype in df.dtypes.items()},
+            'schema': schema,
+            'memory': memory,
+            'rows': len(df)
+        })
+        return self._add(Dataset(content_hash, df, detected_column, schema))
+
+    def live_ids(self):
+        """Ids of the datasets in memory, plus the cached bases their appended segments rest on."""
+        with self._lock:
+            pending = list(self._datasets)
+        live = set()
+        while pending:
+            dataset_id = pending.pop()
+            if dataset_id in live:
+                continue
+            live.add(dataset_id)
+            try:
+                with open(_dataset_cache_paths(dataset_id)[1], 'r', encoding='utf-8') as f:
+                    base = json.load(f).get('base')
+            except (OSError, ValueError):
+                continue
+            if base:
+                pending.append(base)
+        return live
+
+    def session_files(self, sid):
+        """Uploads of session `sid`: {'docx_path', 'csv_path', 'csv_appends', 'dataset_id'}.
+
+        Stored as a small JSON file under SESSION_FOLDER so every worker sees it; paths that
+        don't resolve inside UPLOAD_FOLDER are dropped.
+        """
+        if not re.fullmatch(r'[0-9a-f]{32}', sid or ''):
+            return {}
+        try:
+            with open(os.path.join(SESSION_FOLDER, f"{sid}.json"), 'r', encoding='utf-8') as f:
+                files = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        for key in ('docx_path', 'csv_path'):
+            if files.get(key) and not is_upload_path(files[key]):
+                files.pop(key)
+        files['csv_appends'] = [path for path in files.get('csv_appends', []) if is_upload_path(path)]
+        return files
+
+    def update_session_files(self, sid, changes):
+        """Set (or, for None values, remove) entries of session `sid`; returns the new files."""
+        with self._lock:
+            files = self.session_files(sid)
+            for key, value in changes.items():
+                if value is None:
+                    files.pop(key, None)
+                else:
+                    files[key] = value
+            path = os.path.join(SESSION_FOLDER, f"{sid}.json")
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(files, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        return files
+
+    def _add(self, dataset):
+        with self._lock:
+            self._datasets[dataset.id] = dataset
+            self._datasets.move_to_end(dataset.id)
+            # Evict least recently used datasets, but always keep the one just added
+            used = sum(d.nbytes for d in self._datasets.values())
+            while used > self.budget and len(self._datasets) > 1:
+                _, evicted = self._datasets.popitem(last=False)
+                used -= evicted.nbytes
+                logger.info("資料集 %s 已移出記憶體 (%d bytes)", evicted.id[:12], evicted.nbytes)
+        return dataset
+
+dataset_store = DatasetStore(DATASET_MEMORY_BUDGET)
 
-    return df
+def analyze_csv(csv_path):
+    return dataset_store.load_csv(csv_path)
+
+def is_upload_path(path):
+    """Whether path is a file inside UPLOAD_FOLDER (session state must never point elsewhere)."""
+    folder = os.path.realpath(UPLOAD_FOLDER)
+    return os.path.commonpath([folder, os.path.realpath(path)]) == folder
+
+def session_files():
+    """This browser session's uploads; the cookie itself only carries an opaque id."""
+    return dataset_store.session_files(session.get('sid'))
+
+def update_session_files(**changes):
+    if not re.fullmatch(r'[0-9a-f]{32}', session.get('sid') or ''):
+        session['sid'] = uuid.uuid4().hex
+    return dataset_store.update_session_files(session['sid'], changes)
+
+def session_sources(files):
+    """The CSVs a session's dataset is built from: the uploaded one, then its appends in order."""
+    return [files['csv_path'], *files.get('csv_appends', [])] if files.get('csv_path') else []
+
+def build_dataset(csv_paths):
+    """The dataset of csv_paths[0] with the rest appended in order, or None if a file is missing."""
+    # Uploads past their retention may be gone; then the user has to upload the data again
+    if not csv_paths or not all(os.path.exists(path) for path in csv_paths):
+        return None
+    dataset = analyze_csv(csv_paths[0])
+    for append_path in csv_paths[1:]:
+        dataset = dataset_store.append_csv(dataset, append_path)
+    return dataset
+
+def load_session_dataset(files):
+    """The dataset of a session_files() dict, reloaded from the shared cache or its CSVs on any worker."""
+    return dataset_store.get(files.get('dataset_id')) or build_dataset(session_sources(files))
+
+def current_dataset():
+    """The dataset of this browser session."""
+    files = session_files()
+    dataset = load_session_dataset(files)
+    if dataset is not None and dataset.id != files.get('dataset_id'):
+        update_session_files(dataset_id=dataset.id)
+    return dataset
+
+def append_to_current_dataset(csv_path):
+    """Add the rows of csv_path to this session's dataset; raises ValueError on a schema mismatch."""
+    dataset = current_dataset()
+    if dataset is None:
+        raise ValueError("尚未載入資料，無法附加")
+    dataset = dataset_store.append_csv(dataset, csv_path)
+    update_session_files(csv_appends=session_files().get('csv_appends', []) + [csv_path], dataset_id=dataset.id)
+    return dataset
+
+def make_dataset_handle(dataset, start_date, end_date, row_count):
+    return {
+        'dataset_id': dataset.id,
+        'start_date': pd.to_datetime(start_date).strftime('%Y-%m-%d'),
+        'end_date': pd.to_datetime(end_date).strftime('%Y-%m-%d'),
+        'row_count': int(row_count)
+    }
+
+def resolve_dataframe(payload):
+    """Return the frame a request works on.
+
+    Prefers a dataset handle from /filter_data (served from the typed frame held
+    on the server) and falls back to the legacy row-oriented `data` payload.
+    """
+    handle = payload.get('dataset')
+    if handle:
+        dataset = dataset_store.get(handle.get('dataset_id'))
+        if dataset is None:
+            dataset = current_dataset()
+            if dataset is None:
+                raise ValueError("尚未載入資料")
+            if handle.get('dataset_id') != dataset.id:
+                raise ValueError("資料集已過期，請重新篩選資料")
+        return dataset.slice(handle.get('start_date'), handle.get('end_date'))
+
+    data = payload.get('data')
+    if not data:
+        return None
+    return pd.DataFrame(data)
+
+FILTER_PAGE_SIZE = int(os.getenv('FILTER_PAGE_SIZE', '1000'))
+FILTER_MAX_PAGE_SIZE = int(os.getenv('FILTER_MAX_PAGE_SIZE', '50000'))
+FILTER_SAMPLE_ROWS = int(os.getenv('FILTER_SAMPLE_ROWS', '20'))
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 1024
+DATA_FORMATS = ('handle', 'summary', 'rollup', 'columnar', 'records', 'arrow')
+
+def frame_to_columnar_json(df):
+    """{"columns": [...], "data": {col: [...]}} built from pandas' C JSON writer, one column at a time."""
+    columns = json.dumps([str(col) for col in df.columns], ensure_ascii=False)
+    data = ','.join(json.dumps(str(col), ensure_ascii=False) + ':'
+                    + df[col].to_json(orient='values', date_format='iso', double_precision=15, force_ascii=False)
+                    for col in df.columns)
+    return f'{{"columns":{columns},"data":{{{data}}}}}'
+
+def frame_to_arrow_stream(df):
+    import pyarrow as pa
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def compressed_response(body, mimetype, headers=None):
+    """Response with the body gzip- or brotli-encoded when the client accepts it."""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    headers = dict(headers or {})
+    with span('compress'):
+        body, encoding = _compress_body(body)
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    headers['Vary'] = 'Accept-Encoding'
+    return Response(body, mimetype=mimetype, headers=headers)
+
+def _compress_body(body):
+    """(body, Content-Encoding) using the best encoding the client accepts; unchanged when none or tiny."""
+    accepted = request.headers.get('Accept-Encoding', '').lower()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if 'br' in accepted:
+        try:
+            import brotli
+            return brotli.compress(body, quality=5), 'br'
+        except ImportError:
+            pass
+    if 'gzip' in accepted:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
 
 def convert_docx_to_html(template_path):
-    from docx import Document
-    document = Document(template_path)
+    document = get_template_skeleton(template_path).document
     html = ""
 
     for para in document.paragraphs:
@@ -133,7 +1266,546 @@ def convert_docx_to_html(template_path):
 
     return html
 
-def evaluate_formula(formula: str, df: pd.DataFrame, context: dict = None, formulas: dict = None) -> float:
+FORMULA_CACHE_SIZE = int(os.getenv('FORMULA_CACHE_SIZE', '512'))
+
+# Formula function name -> pandas reduction
+AGGREGATE_FUNCTIONS = {
+    'SUM': 'sum',
+    'MEAN': 'mean',
+    'MAX': 'max',
+    'MIN': 'min',
+    'MEDIAN': 'median',
+    'STD': 'std',
+    'VAR': 'var'
+}
+FORMULA_FUNCTIONS = set(AGGREGATE_FUNCTIONS) | {'COUNT', 'DISTINCT', 'MODE', 'PERCENT_CHANGE', 'DIFF', 'CAGR'}
+RESERVED_NAMES = {'df', 'np'}
+
+# Reductions that a single df.agg call can batch per column
+BATCHED_REDUCTIONS = {'sum', 'mean', 'max', 'min', 'median', 'std', 'var', 'count', 'nunique'}
+# Reductions a dataset window answers from its prefix sums or daily rollup without touching the rows
+INDEXED_REDUCTIONS = {'sum', 'mean', 'count', 'min', 'max'}
+
+# A formula parsed once: `evaluate(env)` plus the columns, variables and aggregates it references
+CompiledFormula = namedtuple('CompiledFormula', ['source', 'evaluate', 'columns', 'variables', 'aggregates'])
+# One data aggregate inside a formula; `key` is shared by identical subexpressions across formulas
+AggregateSpec = namedtuple('AggregateSpec', ['key', 'func', 'column', 'expr'])
+
+def _column(df, name):
+    series = df[name]
+    # Ingestion stores integers in their smallest type; widen before arithmetic so row-wise results can't overflow
+    if series.dtype.kind == 'i' and series.dtype.itemsize < 8:
+        return series.astype(np.int64)
+    return series
+
+def _as_series(value):
+    return value if isinstance(value, pd.Series) else pd.Series([value])
+
+def _fn_count_where(mask):
+    return int(_as_series(mask).sum())
+
+def _fn_mode(value):
+    modes = _as_series(value).mode()
+    return modes.iloc[0] if len(modes) > 0 else None
+
+def _fn_percent_change(value):
+    values = _as_series(value)
+    return (values.iloc[-1] - values.iloc[0]) / values.iloc[0] * 100
+
+def _fn_diff(value):
+    values = _as_series(value)
+    return values.iloc[-1] - values.iloc[0]
+
+def _fn_cagr(start, end, periods):
+    start_val = _as_series(start).iloc[0]
+    end_val = _as_series(end).iloc[-1]
+    return (end_val / start_val) ** (1 / float(periods)) - 1
+
+def _reduce(func, value):
+    if func == 'count_where':
+        return _fn_count_where(value)
+    if func == 'mode':
+        return _fn_mode(value)
+    return getattr(_as_series(value), func)()
+
+def _restore_scalar_type(func, series, value):
+    # df.agg shares one dtype per result column, so integer results can come back as floats
+    if pd.isna(value):
+        return value
+    if func in ('count', 'nunique'):
+        return int(value)
+    if func in ('sum', 'max', 'min') and (pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype)):
+        return int(value)
+    return value
+
+class AggregateResults(dict):
+    """Aggregate values for one frame, keyed by AggregateSpec.key.
+
+    `compute` fills every planned aggregate with one df.agg pass per column;
+    anything not planned ahead is computed on first access. When `df` is a date
+    window from Dataset.slice, SUM/COUNT/MEAN of a plain column come straight
+    from the dataset's prefix sums, and MIN/MAX from its daily rollup.
+    """
+
+    def __init__(self, df, specs=()):
+        super().__init__()
+        self.df = df
+        self.specs = {spec.key: spec for spec in specs}
+        self.window = view_range(df)
+
+    def add(self, specs):
+        for spec in specs:
+            self.specs.setdefault(spec.key, spec)
+
+    def compute(self):
+        batch = {}
+        for spec in self.specs.values():
+            if spec.key in self:
+                continue
+            value = self._from_index(spec)
+            if value is not None:
+                self[spec.key] = value
+            elif spec.column is not None and spec.func in BATCHED_REDUCTIONS:
+                batch.setdefault(spec.column, set()).add(spec.func)
+            else:
+                self[spec.key] = self._compute_one(spec)
+
+        if batch:
+            try:
+                agg_frame = self.df.agg({col: sorted(funcs) for col, funcs in batch.items()})
+            except Exception:
+                # e.g. MEAN over a text column: batch the remaining columns one by one
+                # and leave the failing ones to __missing__ to report per formula
+                agg_frame = None
+            for col, funcs in batch.items():
+                if agg_frame is not None:
+                    values = agg_frame[col]
+                else:
+                    try:
+                        values = self.df[col].agg(sorted(funcs))
+                    except Exception:
+                        continue
+                for spec in self.specs.values():
+                    if spec.column == col and spec.func in funcs and spec.key not in self:
+                        self[spec.key] = _restore_scalar_type(spec.func, self.df[col], values[spec.func])
+        return self
+
+    def _from_index(self, spec):
+        if self.window is None or spec.column is None or spec.func not in INDEXED_REDUCTIONS:
+            return None
+        dataset, lo, hi = self.window
+        return dataset.range_aggregate(spec.func, spec.column, lo, hi)
+
+    def _compute_one(self, spec):
+        value = self._from_index(spec)
+        if value is not None:
+            return value
+        return _reduce(spec.func, spec.expr(FormulaEnv(self.df)))
+
+    def __missing__(self, key):
+        value = self._compute_one(self.specs[key])
+        self[key] = value
+        return value
+
+# Only these are callable from a formula besides FORMULA_FUNCTIONS
+SAFE_BUILTINS = {'abs': abs, 'round': round, 'len': len, 'int': int, 'float': float, 'str': str}
+NUMPY_FUNCTIONS = {'abs', 'sqrt', 'log', 'log10', 'log2', 'exp', 'floor', 'ceil', 'round', 'where',
+                   'maximum', 'minimum', 'clip', 'isnan', 'sign'}
+# Element-wise column expressions over at least this many rows run through numexpr when it is installed
+NUMEXPR_MIN_ROWS = int(os.getenv('NUMEXPR_MIN_ROWS', '100000'))
+# Integer powers whose result would need more bits than this are rejected (9**9**9 would pin a worker)
+FORMULA_MAX_INT_BITS = 4096
+# Likewise for repeating a string or list ('a' * 10**10 would exhaust the worker's memory)
+FORMULA_MAX_SEQUENCE_LENGTH = 1_000_000
+
+def _bounded_pow(base, exponent):
+    # Python ints grow without limit; floats overflow and arrays wrap, both in constant time
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 1 and abs(base) > 1 \
+            and exponent * math.log2(abs(base)) > FORMULA_MAX_INT_BITS:
+        raise ValueError(f"次方結果過大: {base} ** {exponent}")
+    return operator.pow(base, exponent)
+
+def _bounded_mul(left, right):
+    for sequence, count in ((left, right), (right, left)):
+        if isinstance(sequence, (str, bytes, list, tuple)) and isinstance(count, int) \
+                and len(sequence) * count > FORMULA_MAX_SEQUENCE_LENGTH:
+            raise ValueError(f"重複結果過大: 長度 {len(sequence)} × {count}")
+    return operator.mul(left, right)
+
+_BINARY_OPS = {
+    ast.Add: ('+', operator.add), ast.Sub: ('-', operator.sub), ast.Mult: ('*', _bounded_mul),
+    ast.Div: ('/', operator.truediv), ast.FloorDiv: ('//', operator.floordiv), ast.Mod: ('%', operator.mod),
+    ast.Pow: ('**', _bounded_pow), ast.BitAnd: ('&', operator.and_), ast.BitOr: ('|', operator.or_)
+}
+_COMPARE_OPS = {
+    ast.Eq: ('==', operator.eq), ast.NotEq: ('!=', operator.ne), ast.Lt: ('<', operator.lt),
+    ast.LtE: ('<=', operator.le), ast.Gt: ('>', operator.gt), ast.GtE: ('>=', operator.ge)
+}
+# Operators numexpr evaluates with the same semantics as pandas
+_NUMEXPR_OPS = {'+', '-', '*', '/', '**', '&', '|', '==', '!=', '<', '<=', '>', '>='}
+
+_numexpr = None
+
+def _load_numexpr():
+    global _numexpr
+    if _numexpr is None:
+        try:
+            import numexpr
+            _numexpr = numexpr
+        except ImportError:
+            _numexpr = False
+    return _numexpr
+
+class FormulaEnv:
+    """What a compiled formula runs against: the frame, the variable values and the aggregate lookup."""
+    __slots__ = ('df', 'context', 'agg')
+
+    def __init__(self, df, context=None, agg=None):
+        self.df = df
+        self.context = context or {}
+        self.agg = agg
+
+# A compiled sub-expression: `fn(env)` computes it, `text` is its canonical source (aggregate keys)
+# and `ne` is (numexpr source, {alias: column}) when it is a pure element-wise column expression
+_Expr = namedtuple('_Expr', ['fn', 'text', 'ne'])
+
+def _is_vector(value):
+    return isinstance(value, (pd.Series, np.ndarray))
+
+def _elementwise_and(values):
+    if any(_is_vector(v) for v in values):
+        return functools.reduce(operator.and_, values)
+    return all(values)
+
+def _elementwise_or(values):
+    if any(_is_vector(v) for v in values):
+        return functools.reduce(operator.or_, values)
+    return any(values)
+
+def _elementwise_not(value):
+    return ~value if _is_vector(value) else not value
+
+def _invert(value):
+    # ~ is logical not on booleans (row masks) and bitwise not on integers, as in pandas
+    if isinstance(value, (bool, np.bool_)):
+        return not value
+    return ~value
+
+def _is_condition(node):
+    """Whether COUNT(node) counts matching rows rather than non-null values."""
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not) or (isinstance(node.op, ast.Invert) and _is_condition(node.operand))
+    return False
+
+class FormulaCompiler:
+    """Compile a formula AST into closures over vectorized pandas/NumPy operations.
+
+    Only the formula vocabulary is accepted: constants, column and variable names,
+    arithmetic, comparisons, and/or/not, `in [...]`, FORMULA_FUNCTIONS, SAFE_BUILTINS
+    and np.<NUMPY_FUNCTIONS>. Anything else (attributes, lambdas, comprehensions, other
+    calls) is rejected at compile time; nothing is handed to eval.
+
+    Column names are matched case-insensitively and read through `_column`; any other
+    name is a variable resolved from the evaluation context at run time.
+    """
+
+    def __init__(self, columns):
+        self.col_map = {col.lower(): col for col in columns if isinstance(col, str)}
+        self.columns = set()
+        self.variables = set()
+        self.aggregates = {}
+        self.variable_refs = 0
+        self.aliases = {}
+
+    def compile(self, node, condition=False):
+        method = getattr(self, f"_compile_{type(node).__name__}", None)
+        if method is None:
+            raise ValueError(f"不支援的語法: {type(node).__name__}")
+        return method(node, condition)
+
+    def _compile_Expression(self, node, condition):
+        return self.compile(node.body, condition)
+
+    def _compile_Constant(self, node, condition):
+        value = node.value
+        if not isinstance(value, (int, float, str, type(None))):
+            raise ValueError(f"不支援的常數: {value!r}")
+        ne = (repr(value), {}) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+        return _Expr(lambda env: value, repr(value), ne)
+
+    def _column_expr(self, col):
+        self.columns.add(col)
+        alias = self.aliases.setdefault(col, f"c{len(self.aliases)}")
+        return _Expr(lambda env: _column(env.df, col), col, (alias, {alias: col}))
+
+    def _compile_Name(self, node, condition):
+        if node.id in RESERVED_NAMES:
+            raise ValueError(f"不支援的名稱: {node.id}")
+        col = self.col_map.get(node.id.lower())
+        if col is not None:
+            return self._column_expr(col)
+        name = node.id
+        self.variables.add(name)
+        self.variable_refs += 1
+
+        def variable(env):
+            try:
+                return env.context[name]
+            except KeyError:
+                raise NameError(f"name '{name}' is not defined") from None
+        return _Expr(variable, name, None)
+
+    def _compile_Subscript(self, node, condition):
+        # df["column name"] for columns that aren't valid identifiers
+        if (isinstance(node.value, ast.Name) and node.value.id == 'df'
+                and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)):
+            col = self.col_map.get(node.slice.value.lower())
+            if col is None:
+                raise ValueError(f"找不到欄位: {node.slice.value}")
+            return self._column_expr(col)
+        if isinstance(node.slice, (ast.Constant, ast.Slice)) or \
+                (isinstance(node.value, ast.Name) and node.value.id == 'df'):
+            raise ValueError("不支援的語法: Subscript")
+        # column[mask], e.g. SUM(sales[qty > 3]) as df.eval allowed
+        values, mask = self.compile(node.value, condition), self.compile(node.slice, True)
+        vfn, mfn = values.fn, mask.fn
+
+        def select(env):
+            series, rows = vfn(env), mfn(env)
+            if not isinstance(series, pd.Series) or not _is_vector(rows):
+                raise ValueError("只能以條件篩選欄位，例如 sales[qty > 3]")
+            return series[rows]
+        return _Expr(select, f"{values.text}[{mask.text}]", None)
+
+    def _vectorized(self, fn, text, ne):
+        """Run `fn` through numexpr when the frame is large and every referenced column is numeric."""
+        if ne is None or not ne[1]:
+            return _Expr(fn, text, ne)
+        source, aliases = ne
+
+        def run(env):
+            numexpr = _load_numexpr()
+            df = env.df
+            if numexpr and len(df) >= NUMEXPR_MIN_ROWS and all(df[col].dtype.kind in 'ifb' for col in aliases.values()):
+                local = {alias: _column(df, col).to_numpy() for alias, col in aliases.items()}
+                return pd.Series(numexpr.evaluate(source, local_dict=local), index=df.index)
+            return fn(env)
+        return _Expr(run, text, ne)
+
+    @staticmethod
+    def _join_ne(symbol, parts):
+        if symbol not in _NUMEXPR_OPS or any(part.ne is None for part in parts):
+            return None
+        aliases = {}
+        for part in parts:
+            aliases.update(part.ne[1])
+        return f"({f' {symbol} '.join(part.ne[0] for part in parts)})", aliases
+
+    def _compile_BinOp(self, node, condition):
+        if type(node.op) not in _BINARY_OPS:
+            raise ValueError(f"不支援的運算子: {type(node.op).__name__}")
+        symbol, op = _BINARY_OPS[type(node.op)]
+        left, right = self.compile(node.left, condition), self.compile(node.right, condition)
+        lfn, rfn = left.fn, right.fn
+        if isinstance(node.op, ast.Pow) and isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant):
+            # Fold constant powers, so an oversized one fails at compile time
+            return self._compile_Constant(ast.Constant(op(lfn(None), rfn(None))), condition)
+        return self._vectorized(lambda env: op(lfn(env), rfn(env)), f"({left.text} {symbol} {right.text})",
+                                self._join_ne(symbol, [left, right]))
+
+    def _compile_UnaryOp(self, node, condition):
+        operand = self.compile(node.operand, condition)
+        ofn = operand.fn
+        if isinstance(node.op, ast.USub):
+            ne = (f"(-{operand.ne[0]})", operand.ne[1]) if operand.ne else None
+            return self._vectorized(lambda env: -ofn(env), f"(-{operand.text})", ne)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if isinstance(node.op, ast.Not):
+            ne = (f"(~{operand.ne[0]})", operand.ne[1]) if operand.ne else None
+            # df.query semantics: `not` negates row masks element-wise
+            return self._vectorized(lambda env: _elementwise_not(ofn(env)), f"(not {operand.text})", ne)
+        if isinstance(node.op, ast.Invert):
+            ne = (f"(~{operand.ne[0]})", operand.ne[1]) if operand.ne else None
+            return self._vectorized(lambda env: _invert(ofn(env)), f"(~{operand.text})", ne)
+        raise ValueError(f"不支援的運算子: {type(node.op).__name__}")
+
+    def _compile_BoolOp(self, node, condition):
+        values = [self.compile(value, condition) for value in node.values]
+        fns = [value.fn for value in values]
+        if isinstance(node.op, ast.And):
+            combine, symbol, word = _elementwise_and, '&', 'and'
+        else:
+            combine, symbol, word = _elementwise_or, '|', 'or'
+        return self._vectorized(lambda env: combine([fn(env) for fn in fns]),
+                                f"({f' {word} '.join(v.text for v in values)})", self._join_ne(symbol, values))
+
+    def _compile_Compare(self, node, condition):
+        operands = [node.left] + node.comparators
+        parts = []
+        # The right-hand side of `in` is a constant list, read by _membership itself
+        compiled = [None if i and isinstance(node.ops[i - 1], (ast.In, ast.NotIn)) else self.compile(operand, condition)
+                    for i, operand in enumerate(operands)]
+        for i, op_node in enumerate(node.ops):
+            left, right = compiled[i], compiled[i + 1]
+            if left is None:
+                raise ValueError("in 的比較結果不能再串接比較")
+            if isinstance(op_node, (ast.In, ast.NotIn)):
+                parts.append(self._membership(left, operands[i + 1], isinstance(op_node, ast.NotIn)))
+                continue
+            if type(op_node) not in _COMPARE_OPS:
+                raise ValueError(f"不支援的比較: {type(op_node).__name__}")
+            symbol, op = _COMPARE_OPS[type(op_node)]
+            lfn, rfn = left.fn, right.fn
+            parts.append(self._vectorized(lambda env, op=op, lfn=lfn, rfn=rfn: op(lfn(env), rfn(env)),
+                                          f"({left.text} {symbol} {right.text})", self._join_ne(symbol, [left, right])))
+        if len(parts) == 1:
+            return parts[0]
+        # a < b < c -> (a < b) & (b < c)
+        fns = [part.fn for part in parts]
+        return self._vectorized(lambda env: _elementwise_and([fn(env) for fn in fns]),
+                                f"({' and '.join(p.text for p in parts)})", self._join_ne('&', parts))
+
+    def _compile_IfExp(self, node, condition):
+        test, body, orelse = (self.compile(part, condition) for part in (node.test, node.body, node.orelse))
+        tfn, bfn, efn = test.fn, body.fn, orelse.fn
+
+        def select(env):
+            mask = tfn(env)
+            if not _is_vector(mask):
+                # Scalar condition: only the chosen branch is evaluated, as in Python
+                return bfn(env) if mask else efn(env)
+            values = np.where(mask, bfn(env), efn(env))
+            return pd.Series(values, index=mask.index) if isinstance(mask, pd.Series) else values
+        return _Expr(select, f"({body.text} if {test.text} else {orelse.text})", None)
+
+    def _membership(self, left, container, negate):
+        if not isinstance(container, (ast.List, ast.Tuple, ast.Set)) or \
+                not all(isinstance(item, ast.Constant) for item in container.elts):
+            raise ValueError("in 只能搭配常數清單，例如 region in ['North', 'South']")
+        values = [item.value for item in container.elts]
+        lfn = left.fn
+
+        def member(env):
+            value = lfn(env)
+            result = value.isin(values) if isinstance(value, pd.Series) else value in values
+            return _elementwise_not(result) if negate else result
+        return _Expr(member, f"({left.text} {'not in' if negate else 'in'} {values!r})", None)
+
+    def _aggregate(self, func, arg, condition=False):
+        # Aggregates over pure column expressions are planned and shared via env.agg(key);
+        # ones that depend on other variables are evaluated inline.
+        refs = self.variable_refs
+        expr = self.compile(arg, condition)
+        if self.variable_refs != refs:
+            efn = expr.fn
+            return _Expr(lambda env: _reduce(func, efn(env)), f"{func}({expr.text})", None)
+
+        column = expr.text if isinstance(arg, (ast.Name, ast.Subscript)) and expr.text in self.columns else None
+        key = f"{func}:{expr.text}"
+        if key not in self.aggregates:
+            self.aggregates[key] = AggregateSpec(key, func, column, expr.fn)
+        return _Expr(lambda env: env.agg(key), key, None)
+
+    def _compile_Call(self, node, condition):
+        if node.keywords:
+            raise ValueError("公式函數不支援關鍵字參數")
+        if isinstance(node.func, ast.Attribute):
+            # np.<function> from the whitelist
+            if not (isinstance(node.func.value, ast.Name) and node.func.value.id == 'np'
+                    and node.func.attr in NUMPY_FUNCTIONS):
+                raise ValueError(f"不支援的函數: {ast.unparse(node.func)}")
+            return self._helper_call(getattr(np, node.func.attr), f"np.{node.func.attr}", node.args, condition)
+        if not isinstance(node.func, ast.Name):
+            raise ValueError("不支援的函數呼叫")
+
+        name = node.func.id.upper()
+        if name not in FORMULA_FUNCTIONS:
+            if node.func.id in SAFE_BUILTINS:
+                return self._helper_call(SAFE_BUILTINS[node.func.id], node.func.id, node.args, condition)
+            raise ValueError(f"不支援的函數: {node.func.id}")
+
+        args = node.args
+        if name == 'CAGR':
+            if len(args) != 3:
+                raise ValueError("CAGR 需要三個參數")
+            return self._helper_call(_fn_cagr, 'CAGR', args, condition)
+        if len(args) != 1:
+            raise ValueError(f"{name} 需要一個參數")
+
+        arg = args[0]
+        if name == 'COUNT':
+            if isinstance(arg, ast.Call) and isinstance(arg.func, ast.Name) and arg.func.id.upper() == 'DISTINCT':
+                if len(arg.args) != 1:
+                    raise ValueError("DISTINCT 需要一個參數")
+                return self._aggregate('nunique', arg.args[0])
+            if _is_condition(arg):
+                return self._aggregate('count_where', arg, condition=True)
+            return self._aggregate('count', arg)
+        if name == 'MODE':
+            return self._aggregate('mode', arg)
+        if name == 'PERCENT_CHANGE':
+            return self._helper_call(_fn_percent_change, name, args, condition)
+        if name == 'DIFF':
+            return self._helper_call(_fn_diff, name, args, condition)
+        if name == 'DISTINCT':
+            raise ValueError("DISTINCT 只能用於 COUNT(DISTINCT(欄位))")
+        return self._aggregate(AGGREGATE_FUNCTIONS[name], arg)
+
+    def _helper_call(self, func, label, args, condition):
+        compiled = [self.compile(arg, condition) for arg in args]
+        fns = [arg.fn for arg in compiled]
+        return _Expr(lambda env: func(*[fn(env) for fn in fns]),
+                     f"{label}({', '.join(arg.text for arg in compiled)})", None)
+
+_QUERY_BOOLEANS = {'&': 'and', '|': 'or'}
+
+def replace_query_booleans(formula):
+    """df.query semantics: `&` and `|` are the logical and/or, binding looser than comparisons,
+    so `qty > 5 & region == 'North'` means `(qty > 5) and (region == 'North')`."""
+    if '&' not in formula and '|' not in formula:
+        return formula
+    tokens = tokenize.generate_tokens(io.StringIO(formula).readline)
+    return tokenize.untokenize(
+        (tokenize.NAME, _QUERY_BOOLEANS[tok.string]) if tok.type == tokenize.OP and tok.string in _QUERY_BOOLEANS
+        else (tok.type, tok.string) for tok in tokens)
+
+@functools.lru_cache(maxsize=FORMULA_CACHE_SIZE)
+def compile_formula(formula: str, columns: tuple) -> CompiledFormula:
+    """Parse a formula once for a given column schema (LRU-cached)."""
+    tree = ast.parse(replace_query_booleans(formula).strip(), mode='eval')
+    compiler = FormulaCompiler(columns)
+    expr = compiler.compile(tree)
+    return CompiledFormula(formula, expr.fn, frozenset(compiler.columns), frozenset(compiler.variables),
+                           tuple(compiler.aggregates.values()))
+
+def plan_aggregates(formulas: dict, df: pd.DataFrame) -> AggregateResults:
+    """Collect every aggregate the formula set needs and compute them in one batch."""
+    results = AggregateResults(df)
+    columns = tuple(df.columns)
+    for setting in formulas.values():
+        if isinstance(setting, dict):
+            if setting.get('type') != 'formula':
+                continue
+            formula = setting.get('value', '')
+        else:
+            formula = setting
+        if not isinstance(formula, str):
+            continue
+        formula = formula.strip()
+        if not formula or (formula.startswith("'") and formula.endswith("'")):
+            continue
+        try:
+            results.add(compile_formula(formula, columns).aggregates)
+        except Exception:
+            # Broken formulas report their own error when evaluated
+            continue
+    return results.compute()
+
+def evaluate_formula(formula: str, df: pd.DataFrame, context: dict = None, formulas: dict = None,
+                     aggregates: AggregateResults = None) -> float:
     formula = formula.strip()
     if context is None:
         context = {}
@@ -144,96 +1816,30 @@ def evaluate_formula(formula: str, df: pd.DataFrame, context: dict = None, formu
         if formula.startswith("'") and formula.endswith("'"):
             return formula.strip("'")
 
-        col_map = {col.lower(): col for col in df.columns}
-        variables_in_formula = re.findall(r"[a-zA-Z_][a-zA-Z0-9_]*", formula)
-        
+        plan = compile_formula(formula, tuple(df.columns))
+        if aggregates is None:
+            aggregates = AggregateResults(df, plan.aggregates)
+        else:
+            aggregates.add(plan.aggregates)
+
         # First deal with variable dependencies in formulas
-        processed_vars = set()
-        for var in variables_in_formula:
-            if var not in context and var in formulas and var not in processed_vars:
-                # Avoid circular dependencies
-                processed_vars.add(var)
+        for var in plan.variables:
+            if var not in context and var in formulas:
                 try:
                     # Redirectly calculate the value of the dependent variable
                     next_formula = formulas[var]
                     if isinstance(next_formula, dict) and next_formula.get('type') == 'formula':
                         next_formula = next_formula.get('value', '')
-                    context[var] = evaluate_formula(next_formula, df, context, formulas)
-                    # print(f"Computed variable {var} = {context[var]}")
+                    context[var] = evaluate_formula(next_formula, df, context, formulas, aggregates)
                 except Exception as e:
-                    # print(f"Error occurred while calculating variable {var}: {str(e)}")
                     raise ValueError(f"變數 {var} 計算錯誤: {str(e)}")
 
-        # Handle column name case insensitivity
-        for var in variables_in_formula:
-            var_lower = var.lower()
-            if var_lower in col_map:
-                correct_col = col_map[var_lower]
-                formula = re.sub(r'\b' + re.escape(var) + r'\b', correct_col, formula)
-
-        # Handle special functions
-        formula = re.sub(r'COUNT\s*\(\s*DISTINCT\s*\((.*?)\)\s*\)', r'df["\1"].nunique()', formula, flags=re.I)
-        formula = re.sub(r'MODE\s*\(\s*(.*?)\s*\)', r'df["\1"].mode().iloc[0] if len(df["\1"].mode()) > 0 else None', formula, flags=re.I)
-        # Handle special COUNT(condition) situations
-        count_pattern = re.compile(r'COUNT\s*\(\s*(.+?)\s*\)', re.I)
-        for match in count_pattern.finditer(formula):
-            content = match.group(1)
-            if '==' in content or '!=' in content or '>' in content or '<' in content or '>=' in content or '<=' in content:
-                # Conditional expression
-                replacement = f'(df.query("{content.replace("==", "==")}", engine="python").shape[0])'
-                formula = formula.replace(match.group(0), replacement)
-            else:
-                # Normal column count
-                replacement = f'df["{content}"].count()'
-                formula = formula.replace(match.group(0), replacement)
-
-        formula = re.sub(r'SUM\s*\(\s*(.*?)\s*\)', r'df.eval("\1").sum()', formula, flags=re.I)
-        formula = re.sub(r'MEAN\s*\(\s*(.*?)\s*\)', r'df.eval("\1").mean()', formula, flags=re.I)
-        formula = re.sub(r'MAX\s*\(\s*(.*?)\s*\)', r'df.eval("\1").max()', formula, flags=re.I)
-        formula = re.sub(r'MIN\s*\(\s*(.*?)\s*\)', r'df.eval("\1").min()', formula, flags=re.I)
-        formula = re.sub(r'MEDIAN\s*\(\s*(.*?)\s*\)', r'df.eval("\1").median()', formula, flags=re.I)
-        formula = re.sub(r'STD\s*\(\s*(.*?)\s*\)', r'df.eval("\1").std()', formula, flags=re.I)
-        formula = re.sub(r'VAR\s*\(\s*(.*?)\s*\)', r'df.eval("\1").var()', formula, flags=re.I)
-
-        if formula.upper().startswith("PERCENT_CHANGE("):
-            inside = re.findall(r'PERCENT_CHANGE\((.*?)\)', formula, flags=re.I)[0]
-            values = df.eval(inside.strip())
-            return (values.iloc[-1] - values.iloc[0]) / values.iloc[0] * 100
-
-        if formula.upper().startswith("DIFF("):
-            inside = re.findall(r'DIFF\((.*?)\)', formula, flags=re.I)[0]
-            values = df.eval(inside.strip())
-            return values.iloc[-1] - values.iloc[0]
-
-        if formula.upper().startswith("CAGR("):
-            inside = re.findall(r'CAGR\((.*?)\)', formula, flags=re.I)[0]
-            parts = [p.strip() for p in inside.split(",")]
-            start_val = df.eval(parts[0]).iloc[0]
-            end_val = df.eval(parts[1]).iloc[-1]
-            periods = float(parts[2])
-            return (end_val / start_val) ** (1/periods) - 1
-
-        # Replace variables with actual values
-        for var_name, var_value in context.items():
-            if isinstance(var_value, str):
-                # If it is a string, quotes are required
-                formula = re.sub(r'\b' + re.escape(var_name) + r'\b', f"'{var_value}'", formula)
-            else:
-                # If it is a numeric value, replace it directly
-                formula = re.sub(r'\b' + re.escape(var_name) + r'\b', str(var_value), formula)
-
-        eval_globals = {"df": df, "np": np}
-        eval_globals.update(context)
+        result = plan.evaluate(FormulaEnv(df, context, aggregates.__getitem__))
 
-        result = eval(formula, eval_globals)
-        if any(name in formula for name in ["top_region", "top_product"]):
-            print(f"⚡ DEBUG: 變數評估後結果 type={type(result)}, value={result}")
-
-        if isinstance(result, (list, pd.Series)):
-            if len(result) > 0:
-                result = result[0]
-            else:
-                result = None
+        if isinstance(result, pd.Series):
+            result = result.iloc[0] if len(result) > 0 else None
+        elif isinstance(result, list):
+            result = result[0] if len(result) > 0 else None
         elif isinstance(result, dict):
             if result:
                 result = list(result.values())[0]
@@ -244,6 +1850,713 @@ def evaluate_formula(formula: str, df: pd.DataFrame, context: dict = None, formu
     except Exception as e:
         raise ValueError(f"公式錯誤：{str(e)}")
 
+PREVIEW_SESSION_LIMIT = int(os.getenv('PREVIEW_SESSION_LIMIT', '64'))
+
+def formula_expression(setting):
+    """The formula text of a variable setting ('' for charts and fixed values)."""
+    if isinstance(setting, dict):
+        return setting.get('value', '') if setting.get('type') == 'formula' else ''
+    return setting if isinstance(setting, str) else ''
+
+def is_chart_setting(setting):
+    return isinstance(setting, dict) and setting.get('type') == 'chart'
+
+def depends_on_data(setting):
+    # Fixed text (and unknown setting types) don't change with the date range
+    if isinstance(setting, dict):
+        return setting.get('type') in ('formula', 'chart')
+    return True
+
+class FormulaGraph:
+    """Dependency graph of a template's variables, evaluated in topological order.
+
+    Shared by /render_preview and /render. It keeps the last evaluated value of every
+    variable, so after a delta only the changed variables and their dependents are
+    recomputed; everything else is read back from `values`.
+    """
+
+    def __init__(self, formulas, columns=()):
+        self.columns = tuple(columns)
+        self.formulas = {}
+        self.dependencies = {}
+        self.dependents = {}
+        self.values = {}
+        self.update(formulas)
+
+    def _dependencies_of(self, var, setting):
+        expr = formula_expression(setting)
+        if not isinstance(expr, str) or not expr.strip():
+            return set()
+        try:
+            names = compile_formula(expr.strip(), self.columns).variables
+        except Exception:
+            # Broken formulas still get ordered after anything they appear to use
+            names = set(re.findall(r'[a-zA-Z_][a-zA-Z0-9_]*', expr))
+        return {name for name in names if name in self.formulas and name != var}
+
+    def update(self, changed=None, removed=()):
+        """Apply a delta of variable settings; returns the variables whose values are stale."""
+        stale = set()
+        for var in removed:
+            if var in self.formulas:
+                stale |= self.dependents.get(var, set())
+                del self.formulas[var]
+                self.values.pop(var, None)
+        for var, setting in (changed or {}).items():
+            if var not in self.formulas or self.formulas[var] != setting:
+                self.formulas[var] = setting
+                stale.add(var)
+
+        self.dependencies = {var: self._dependencies_of(var, setting) for var, setting in self.formulas.items()}
+        self.dependents = {var: set() for var in self.formulas}
+        for var, deps in self.dependencies.items():
+            for dep in deps:
+                self.dependents[dep].add(var)
+        return {var for var in stale if var in self.formulas}
+
+    def downstream(self, names):
+        """`names` plus every variable that depends on them, directly or transitively."""
+        result = set()
+        stack = [var for var in names if var in self.formulas]
+        while stack:
+            var = stack.pop()
+            if var in result:
+                continue
+            result.add(var)
+            stack.extend(self.dependents.get(var, ()))
+        return result
+
+    def order(self, names=None):
+        """Topological order (dependencies first) of `names`; returns (order, variables in a cycle)."""
+        targets = set(self.formulas) if names is None else set(names) & set(self.formulas)
+        visited = set()
+        in_progress = set()
+        cyclic = set()
+        order = []
+
+        def visit(node):
+            if node in visited:
+                return
+            if node in in_progress:
+                cyclic.add(node)
+                return
+            in_progress.add(node)
+            for dep in sorted(self.dependencies.get(node, ())):
+                if dep in targets:
+                    visit(dep)
+            in_progress.discard(node)
+            visited.add(node)
+            order.append(node)
+
+        # Keep the caller's (template) order among independent variables
+        for var in self.formulas:
+            if var in targets:
+                visit(var)
+        cyclic |= {var for var in order if self.dependencies.get(var, set()) & cyclic}
+        return [var for var in order if var not in cyclic], cyclic
+
+    def _evaluate_setting(self, setting, df, context, aggregates):
+        if isinstance(setting, dict):
+            if setting.get('type') == 'formula':
+                value = evaluate_formula(setting.get('value', ''), df, context=context, formulas=self.formulas, aggregates=aggregates)
+            else:
+                value = setting.get('value', '')
+        else:
+            # Bare values are formulas if they evaluate, literal text otherwise
+            try:
+                value = evaluate_formula(str(setting), df, context=context, formulas=self.formulas, aggregates=aggregates)
+            except ValueError:
+                value = str(setting)
+
+        if hasattr(value, "item"):
+            value = value.item()
+        if isinstance(value, (int, float)):
+            value = round(value, 2)
+        return value
+
+    def evaluate(self, df, names=None, evaluate_chart=None):
+        """Evaluate `names` (default: every variable) against df and return {var: value}.
+
+        Variables outside `names` keep their previous values and feed the context of the
+        ones being recomputed. Chart values come from `evaluate_chart(var, setting)`.
+        A variable that fails (or sits in a dependency cycle) gets the exception as its value.
+        """
+        order, cyclic = self.order(names)
+        targets = set(order) | cyclic
+
+        context = {var: value for var, value in self.values.items()
+                   if var not in targets and not isinstance(value, Exception)
+                   and not is_chart_setting(self.formulas.get(var))}
+        with span('aggregates'):
+            aggregates = plan_aggregates({var: self.formulas[var] for var in order}, df)
+
+        results = {}
+        for var in cyclic:
+            results[var] = ValueError(f"循環依賴: {var}")
+        for var in order:
+            setting = self.formulas[var]
+            try:
+                if is_chart_setting(setting):
+                    with span('chart', var):
+                        value = evaluate_chart(var, setting) if evaluate_chart else ''
+                else:
+                    with span('formula', var):
+                        value = self._evaluate_setting(setting, df, context, aggregates)
+                    context[var] = value
+            except Exception as e:
+                value = e
+                context.pop(var, None)
+            results[var] = value
+
+        self.values.update(results)
+        return results
+
+# Preview id (from the Flask session) -> evaluated graph and the view it was evaluated on
+preview_sessions = OrderedDict()
+# Preview id -> lock held while a request updates and evaluates that session's graph
+_preview_locks = OrderedDict()
+_preview_sessions_lock = threading.Lock()
+
+def preview_lock(preview_id):
+    """Serializes one session's /render_preview requests: each applies its delta to the graph the
+    previous one left, so two at once (e.g. on threaded workers) would interleave their updates."""
+    with _preview_sessions_lock:
+        lock = _preview_locks.get(preview_id)
+        if lock is None:
+            lock = _preview_locks[preview_id] = threading.Lock()
+        _preview_locks.move_to_end(preview_id)
+        while len(_preview_locks) > PREVIEW_SESSION_LIMIT:
+            _preview_locks.popitem(last=False)
+        return lock
+
+def get_preview(preview_id):
+    with _preview_sessions_lock:
+        return preview_sessions.get(preview_id)
+
+def remember_preview(preview_id, state):
+    with _preview_sessions_lock:
+        preview_sessions[preview_id] = state
+        preview_sessions.move_to_end(preview_id)
+        while len(preview_sessions) > PREVIEW_SESSION_LIMIT:
+            preview_sessions.popitem(last=False)
+
+class ReportError(Exception):
+    """A report that can't be rendered; `status` is the HTTP status /render answers with."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+def prepare_report(payload):
+    """Validate a /render payload against this session; returns (docx_path, formulas, filename, df)."""
+    docx_path = session_files().get('docx_path')
+    formulas = payload.get('formulas', {})
+    filename = payload.get('filename', 'final_report.docx')
+
+    if not docx_path or not os.path.exists(docx_path):
+        raise ReportError("錯誤：找不到 Word 模板文件。", 400)
+
+    try:
+        # A dataset handle keeps the typed frame on the server; `data` is the legacy fallback
+        filtered_df = resolve_dataframe(payload)
+    except Exception as e:
+        logger.warning("Error creating DataFrame from data: %s", e)
+        raise ReportError(f"錯誤：處理輸入數據時出錯: {str(e)}", 400)
+
+    if filtered_df is None or filtered_df.empty:
+        raise ReportError("錯誤：沒有提供用於渲染的數據。", 400)
+    return docx_path, formulas, filename, filtered_df
+
+def build_report(docx_path, formulas, filtered_df, output, progress=None):
+    """Evaluate every variable, export the charts and render the template to `output`.
+
+    `output` is a path or a writable binary stream; chart images go into the document
+    straight from memory. `progress(fraction, message)` is called as each stage starts.
+    Raises ReportError.
+    """
+    from docxtpl import InlineImage
+    from docx.shared import Mm
+    progress = progress or (lambda fraction, message: None)
+
+    # Same dependency graph engine as /render_preview, evaluated in full
+    progress(0.0, '計算公式中')
+    graph = FormulaGraph(formulas, filtered_df.columns)
+    order, cyclic = graph.order()
+    if cyclic:
+        logger.error("錯誤：偵測到循環依賴 involving %s", sorted(cyclic))
+        raise ReportError(f"公式計算順序錯誤（可能存在循環依賴）: 循環依賴: {', '.join(sorted(cyclic))}")
+    logger.debug("render_word: formula calculation order: %s", order)
+
+    # ---Initialize DocxTemplate ---
+    try:
+        with span('template_load'):
+            doc = report_template_class()(docx_path)
+    except Exception as e:
+         logger.error("Error loading DocxTemplate: %s", e)
+         raise ReportError(f"錯誤：無法加載 Word 模板 '{os.path.basename(docx_path)}': {str(e)}")
+
+    def build_report_chart(var, setting):
+        x_col = setting.get('x')
+        y_col = setting.get('y')
+        chart_type = setting.get('chartType')
+        chart_title = setting.get('chartTitle') # Get chart title
+        # Use a default DPI scale if not provided
+        dpi_scale_str = setting.get('dpi', '2') # Get DPI setting as string
+        try:
+            dpi_scale = float(dpi_scale_str)
+        except (ValueError, TypeError):
+            logger.warning("圖表 '%s' 的 DPI 設定 '%s' 無效，使用預設值 2。", var, dpi_scale_str)
+            dpi_scale = 2
+
+        if not x_col or not y_col or not chart_type:
+            logger.warning("render_word: 圖表 '%s' 缺少設定 (X:%s, Y:%s, Type:%s)，跳過。", var, x_col, y_col, chart_type)
+            return "[圖表設定不完整]"
+        # Ensure columns exist in DataFrame
+        if x_col not in filtered_df.columns or y_col not in filtered_df.columns:
+            logger.warning("render_word: 圖表 '%s' 所需欄位 (%s, %s) 不在資料中，跳過。", var, x_col, y_col)
+            return f"[錯誤：找不到欄位 {x_col} 或 {y_col}]"
+
+        logger.debug("render_word: building chart '%s' with title '%s', DPI scale %s", var, chart_title, dpi_scale)
+        return build_chart_figure(filtered_df, x_col, y_col, chart_type, chart_title=chart_title), dpi_scale
+
+    # ---Process variables ---
+    context = {}
+    chart_figures = {} # var -> (figure, dpi scale), exported in parallel below
+    for var, value in graph.evaluate(filtered_df, evaluate_chart=build_report_chart).items():
+        if isinstance(value, Exception):
+            logger.warning("處理變數 '%s' 時發生錯誤: %s", var, value)
+            context[var] = f"[處理錯誤: {str(value)}]"
+        elif is_chart_setting(formulas[var]) and isinstance(value, tuple):
+            chart_figures[var] = value
+            context[var] = "[圖表將在此生成]"
+        elif value is None:
+            logger.warning("render_word: 變數 '%s' 計算結果為 None。", var)
+            context[var] = ""
+        else:
+            context[var] = value
+
+    # ---Export every chart of the report at once ---
+    progress(0.3, f'產生圖表中（{len(chart_figures)} 張）')
+    with span('chart_export'):
+        chart_images = render_chart_images(chart_figures)
+    for var, image in chart_images.items():
+        if isinstance(image, Exception):
+            logger.error("render_word: 圖表 '%s' 圖片生成失敗: %s", var, image)
+            context[var] = "[圖表生成失敗]"
+            continue
+        context[var] = InlineImage(doc, io.BytesIO(image), width=Mm(120)) # Adjust width as needed
+        logger.debug("render_word: added chart '%s' to context", var)
+
+    # ---Final rendering ---
+    progress(0.8, '產生 Word 文件中')
+    try:
+        logger.debug("render_word: final context: %s", context)
+        with span('docx_render'):
+            doc.render(context)
+        if isinstance(output, str):
+            os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        with span('docx_save'):
+            doc.save(output)
+        logger.info("Word document rendered from %s", docx_path)
+    except Exception as e:
+         logger.exception("最終渲染 Word 文件 '%s' 時出錯", os.path.basename(docx_path))
+         raise ReportError(f"渲染 Word 時發生嚴重錯誤: {str(e)}")
+    return output
+
+RENDER_WORKERS = int(os.getenv('RENDER_WORKERS', '2'))
+# Jobs waiting for a worker beyond this are rejected with 429
+RENDER_QUEUE_LIMIT = int(os.getenv('RENDER_QUEUE_LIMIT', '16'))
+# Finished jobs (status + .docx) are removed after this many seconds
+RENDER_JOB_TTL = int(os.getenv('RENDER_JOB_TTL', '3600'))
+# Jobs still queued or running this long after submission belong to a worker that died; they are marked failed
+RENDER_JOB_TIMEOUT = int(os.getenv('RENDER_JOB_TIMEOUT', '1800'))
+RENDER_JOBS_FOLDER = os.path.join(GENERATED_FOLDER, 'jobs')
+# Offer progress over server-sent events; each open stream holds a worker thread for the whole
+# render, so gunicorn.conf.py only enables it for threaded/async workers (clients poll otherwise)
+RENDER_JOB_EVENTS = os.getenv('RENDER_JOB_EVENTS', '1') != '0'
+RENDER_JOB_EVENTS_INTERVAL = 0.5
+os.makedirs(RENDER_JOBS_FOLDER, exist_ok=True)
+
+_render_executor = None
+_render_jobs_lock = threading.Lock()
+# Counters of this process' job queue, exposed by /render_jobs/metrics
+render_job_stats = {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'seconds': 0.0}
+
+def _render_job_folder(job_id):
+    return os.path.join(RENDER_JOBS_FOLDER, job_id)
+
+def read_render_job(job_id):
+    """Status of a job from its status file, so any worker process can answer for it."""
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        return None
+    try:
+        with open(os.path.join(_render_job_folder(job_id), 'status.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_render_job(job):
+    status_path = os.path.join(_render_job_folder(job['id']), 'status.json')
+    tmp_path = f"{status_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp_path, status_path)
+
+def prune_render_jobs():
+    now = datetime.now().timestamp()
+    for job_id in os.listdir(RENDER_JOBS_FOLDER):
+        job = read_render_job(job_id)
+        if job is None:
+            # A folder whose status was never written (or can't be read) is removed once it is as old
+            try:
+                stale = os.path.getmtime(_render_job_folder(job_id)) < now - RENDER_JOB_TTL
+            except OSError:
+                continue
+            if stale:
+                shutil.rmtree(_render_job_folder(job_id), ignore_errors=True)
+        elif job['status'] in ('queued', 'running') and (job.get('submitted_at') or 0) < now - RENDER_JOB_TIMEOUT:
+            job.update(status='failed', error='報表工作逾時或執行程序已中止', message='失敗', finished_at=now)
+            write_render_job(job)
+        elif job['status'] in ('done', 'failed') and (job.get('finished_at') or 0) < now - RENDER_JOB_TTL:
+            shutil.rmtree(_render_job_folder(job_id), ignore_errors=True)
+
+def get_render_executor():
+    global _render_executor
+    if _render_executor is None:
+        _render_executor = ThreadPoolExecutor(max_workers=max(1, RENDER_WORKERS), thread_name_prefix='render')
+    return _render_executor
+
+def _run_render_job(job, docx_path, formulas, filtered_df):
+    with _render_jobs_lock:
+        render_job_stats['queued'] -= 1
+        render_job_stats['running'] += 1
+    job.update(status='running', started_at=datetime.now().timestamp())
+
+    def progress(fraction, message):
+        job.update(progress=fraction, message=message)
+        write_render_job(job)
+
+    folder = _render_job_folder(job['id'])
+    try:
+        try:
+            write_render_job(job)
+            build_report(docx_path, formulas, filtered_df, os.path.join(folder, 'report.docx'), progress=progress)
+            job.update(status='done', progress=1.0, message='完成')
+        except Exception as e:
+            job.update(status='failed', error=str(e), message='失敗')
+        job['finished_at'] = datetime.now().timestamp()
+        # If this write fails too, prune_render_jobs marks the job failed after RENDER_JOB_TIMEOUT
+        write_render_job(job)
+    finally:
+        with _render_jobs_lock:
+            render_job_stats['running'] -= 1
+            render_job_stats['completed' if job['status'] == 'done' else 'failed'] += 1
+            render_job_stats['seconds'] += (job['finished_at'] or datetime.now().timestamp()) - job['started_at']
+
+def submit_render_job(docx_path, formulas, filename, filtered_df):
+    """Queue a report render on the local worker pool; returns the job, or None when the queue is full."""
+    with _render_jobs_lock:
+        if render_job_stats['queued'] >= RENDER_QUEUE_LIMIT:
+            render_job_stats['rejected'] += 1
+            return None
+        render_job_stats['queued'] += 1
+
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'filename': filename,
+        'progress': 0.0,
+        'message': '排隊中',
+        'error': None,
+        'submitted_at': datetime.now().timestamp(),
+        'started_at': None,
+        'finished_at': None
+    }
+    try:
+        prune_render_jobs()
+        os.makedirs(_render_job_folder(job['id']), exist_ok=True)
+        write_render_job(job)
+        get_render_executor().submit(_run_render_job, dict(job), docx_path, formulas, filtered_df)
+    except BaseException:
+        with _render_jobs_lock:
+            render_job_stats['queued'] -= 1
+        raise
+    return job
+
+# Uploaded templates/CSVs, loose files in generated/ (chart previews) and cached datasets are
+# deleted once older than their retention, then oldest first while over their size cap (0: no cap)
+UPLOAD_RETENTION_SECONDS = int(os.getenv('UPLOAD_RETENTION_SECONDS', str(7 * 24 * 3600)))
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+GENERATED_RETENTION_SECONDS = int(os.getenv('GENERATED_RETENTION_SECONDS', str(24 * 3600)))
+GENERATED_MAX_BYTES = int(os.getenv('GENERATED_MAX_BYTES', str(512 * 1024 * 1024)))
+DATASET_CACHE_RETENTION_SECONDS = int(os.getenv('DATASET_CACHE_RETENTION_SECONDS', str(7 * 24 * 3600)))
+DATASET_CACHE_MAX_BYTES = int(os.getenv('DATASET_CACHE_MAX_BYTES', str(4 * 1024 * 1024 * 1024)))
+# Requests scan the folders at most this often per process
+FILE_PRUNE_INTERVAL = int(os.getenv('FILE_PRUNE_INTERVAL', '300'))
+
+_last_file_prune = 0.0
+_file_prune_lock = threading.Lock()
+
+def prune_folder(folder, max_age, max_bytes, keep=(), group=None):
+    """Delete the files directly in `folder` older than max_age seconds, then the least recently
+    modified ones until the rest fit in max_bytes. Sub-folders and paths in `keep` are left alone.
+
+    `group(name)` maps a file name to the entry it belongs to; the files of one entry are aged
+    and deleted together, and a None key leaves the file alone. Returns (files removed, bytes freed).
+    """
+    keep = {os.path.abspath(path) for path in keep if path}
+    cutoff = time.time() - max_age
+    entries = {}
+    total = 0
+    with os.scandir(folder) as it:
+        for entry in it:
+            if not entry.is_file(follow_symlinks=False) or os.path.abspath(entry.path) in keep:
+                continue
+            key = entry.name if group is None else group(entry.name)
+            if key is None:
+                continue
+            stat = entry.stat()
+            mtime, size, paths = entries.get(key, (0.0, 0, []))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size, paths + [entry.path])
+            total += stat.st_size
+    removed = freed = 0
+    for mtime, size, paths in sorted(entries.values()):
+        if mtime >= cutoff and (max_bytes <= 0 or total <= max_bytes):
+            break
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += 1
+        total -= size
+        freed += size
+    return removed, freed
+
+def _dataset_cache_entry(name):
+    stem, ext = os.path.splitext(name)
+    return stem if ext in ('.feather', '.json') and re.fullmatch(r'[0-9a-f]{64}', stem) else None
+
+def prune_dataset_cache():
+    """Apply the retention policy to the Feather copies in CACHE_FOLDER, except the ones
+    backing a dataset this process holds (and the bases its appended segments rest on)."""
+    keep = [path for dataset_id in dataset_store.live_ids() for path in _dataset_cache_paths(dataset_id)]
+    return prune_folder(CACHE_FOLDER, DATASET_CACHE_RETENTION_SECONDS, DATASET_CACHE_MAX_BYTES,
+                        keep=keep, group=_dataset_cache_entry)
+
+def prune_files(keep=()):
+    """Apply the upload and generated-file retention policy; `keep` protects files still in use."""
+    keep = [SETTINGS_PATH, DRIVE_MANIFEST_PATH, *keep]
+    uploads = prune_folder(UPLOAD_FOLDER, UPLOAD_RETENTION_SECONDS, UPLOAD_MAX_BYTES, keep=keep)
+    generated = prune_folder(GENERATED_FOLDER, GENERATED_RETENTION_SECONDS, GENERATED_MAX_BYTES, keep=keep)
+    datasets = prune_dataset_cache()
+    # A session is of no use once its uploads have expired
+    prune_folder(SESSION_FOLDER, UPLOAD_RETENTION_SECONDS, 0)
+    prune_render_jobs()
+    return {'uploads': uploads, 'generated': generated, 'datasets': datasets}
+
+def maybe_prune_files():
+    """prune_files() at most once per FILE_PRUNE_INTERVAL, keeping this session's uploads."""
+    global _last_file_prune
+    now = time.monotonic()
+    with _file_prune_lock:
+        if _last_file_prune and now - _last_file_prune < FILE_PRUNE_INTERVAL:
+            return
+        _last_file_prune = now
+    keep = []
+    if has_request_context():
+        files = session_files()
+        keep = [files.get('docx_path'), files.get('csv_path'), *files.get('csv_appends', [])]
+    try:
+        prune_files(keep=keep)
+    except OSError as e:
+        logger.warning("清理檔案失敗: %s", e)
+
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', str(os.cpu_count() or 1)))
+BATCH_MAX_PARTITIONS = int(os.getenv('BATCH_MAX_PARTITIONS', '500'))
+BATCH_FOLDER = os.path.join(GENERATED_FOLDER, 'batches')
+os.makedirs(BATCH_FOLDER, exist_ok=True)
+
+_batch_pool = None
+
+def _init_batch_worker():
+    # Each batch worker exports its own charts in-process instead of nesting a chart pool
+    global CHART_POOL_SIZE
+    CHART_POOL_SIZE = 0
+    _warm_chart_worker()
+
+def _render_batch_partition(dataset_id, csv_paths, docx_path, formulas, partition, output_path):
+    """Render one partition to output_path. Runs in a batch worker: the dataset is memory-mapped
+    from the shared Feather cache (or rebuilt from csv_paths, the base CSV and its appends) and
+    compiled formulas stay cached for the worker's next partition."""
+    dataset = dataset_store.get(dataset_id) or build_dataset(csv_paths)
+    if dataset is None or dataset.id != dataset_id:
+        raise ReportError("找不到批次所用的資料集，請重新上傳資料", 400)
+    view = partition_frame(dataset, partition)
+    if view.empty:
+        raise ReportError("此分區沒有資料", 400)
+    # The partition itself is available to the template as fixed values
+    formulas = dict(formulas)
+    for key in ('start_date', 'end_date', 'group'):
+        if partition.get(key) is not None:
+            formulas.setdefault(f"partition_{key}", {'type': 'fixed', 'value': str(partition[key])})
+    build_report(docx_path, formulas, view, output_path)
+    return output_path
+
+def get_batch_pool():
+    """Lazily start the batch render processes (None when BATCH_WORKERS is 0)."""
+    global _batch_pool
+    if _batch_pool is None and BATCH_WORKERS > 0:
+        _batch_pool = ProcessPoolExecutor(max_workers=BATCH_WORKERS,
+                                          mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=_init_batch_worker)
+    return _batch_pool
+
+def shutdown_batch_pool():
+    global _batch_pool
+    pool, _batch_pool = _batch_pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown_batch_pool)
+
+def partition_frame(dataset, partition):
+    view = dataset.slice(partition['start_date'], partition['end_date'])
+    group_by = partition.get('group_by')
+    if group_by:
+        view = view[view[group_by].astype(str) == str(partition['group'])]
+    return view
+
+def expand_partitions(dataset, start_date=None, end_date=None, frequency=None, windows=None, group_by=None, groups=None):
+    """Date windows (explicit, or `frequency` periods of start..end) crossed with the values of `group_by`."""
+    start_date = pd.to_datetime(start_date or dataset.date_min)
+    end_date = pd.to_datetime(end_date or dataset.date_max)
+
+    if windows:
+        ranges = [(pd.to_datetime(w['start_date']), pd.to_datetime(w['end_date'])) for w in windows]
+    elif frequency:
+        try:
+            periods = pd.period_range(start_date, end_date, freq=frequency)
+        except ValueError:
+            raise ValueError(f"不支援的週期: {frequency}")
+        ranges = [(max(p.start_time, start_date), min(p.end_time.normalize(), end_date)) for p in periods]
+    else:
+        ranges = [(start_date, end_date)]
+
+    if group_by:
+        if group_by not in dataset.df.columns:
+            raise ValueError(f"找不到分組欄位: {group_by}")
+        if not groups:
+            lo, hi = dataset.bounds(start_date, end_date)
+            groups = sorted(dataset.df[group_by].iloc[lo:hi].dropna().astype(str).unique())
+    else:
+        groups = [None]
+
+    partitions = []
+    for start, end in ranges:
+        for group in groups:
+            partitions.append({
+                'start_date': start.strftime('%Y-%m-%d'),
+                'end_date': end.strftime('%Y-%m-%d'),
+                'group_by': group_by,
+                'group': group
+            })
+    if len(partitions) > BATCH_MAX_PARTITIONS:
+        raise ValueError(f"分區數量 {len(partitions)} 超過上限 {BATCH_MAX_PARTITIONS}")
+    return partitions
+
+def partition_filename(pattern, partition):
+    if pattern:
+        # Only these keys are substituted; str.format would also allow attribute lookups
+        values = {'start_date': partition['start_date'], 'end_date': partition['end_date'],
+                  'group': partition['group'] or ''}
+
+        def substitute(match):
+            if match.group(1) not in values:
+                raise KeyError(match.group(1))
+            return str(values[match.group(1)])
+        name = re.sub(r'\{([^{}]*)\}', substitute, pattern)
+    else:
+        name = f"report_{partition['start_date']}_{partition['end_date']}"
+        if partition['group'] is not None:
+            name += f"_{partition['group']}"
+    # secure_filename drops non-ASCII, which would merge every Chinese group name into one file
+    name = re.sub(r'[\\/:*?"<>|\s]+', '_', name).strip('._') or 'report'
+    return name if name.lower().endswith('.docx') else f"{name}.docx"
+
+class _ZipChunks:
+    """Write-only file object that collects what zipfile writes, so the archive can be streamed."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_batch_zip(dataset, csv_paths, docx_path, formulas, partitions, filename_pattern=None):
+    """Render every partition across the batch pool and yield a zip of the reports as they finish."""
+    folder = os.path.join(BATCH_FOLDER, uuid.uuid4().hex)
+    os.makedirs(folder, exist_ok=True)
+
+    names = {}
+    tasks = []
+    for i, partition in enumerate(partitions):
+        name = partition_filename(filename_pattern, partition)
+        if name in names.values():
+            name = f"{name[:-5]}_{i}.docx"
+        names[i] = name
+        # One sub-folder per partition keeps chart images of parallel renders apart
+        os.makedirs(os.path.join(folder, str(i)), exist_ok=True)
+        tasks.append((dataset.id, csv_paths, docx_path, formulas, partition, os.path.join(folder, str(i), name)))
+
+    def results():
+        pool = get_batch_pool()
+        if pool is None:
+            for i, task in enumerate(tasks):
+                try:
+                    yield i, _render_batch_partition(*task)
+                except Exception as e:
+                    yield i, e
+            return
+        futures = {pool.submit(_render_batch_partition, *task): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except BrokenProcessPool:
+                shutdown_batch_pool()
+                try:
+                    result = _render_batch_partition(*tasks[futures[future]])
+                except Exception as e:
+                    result = e
+                yield futures[future], result
+            except Exception as e:
+                yield futures[future], e
+
+    sink = _ZipChunks()
+    errors = []
+    try:
+        with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for i, result in results():
+                if isinstance(result, Exception):
+                    errors.append(f"{names[i]}: {result}")
+                    continue
+                archive.write(result, arcname=names[i])
+                yield sink.drain()
+            if errors:
+                archive.writestr('errors.txt', '\n'.join(errors))
+        yield sink.drain()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
 # Add homepage route
 @app.route('/')
 def home():
@@ -252,32 +2565,66 @@ def home():
 
 @app.route('/upload', methods=['GET', 'POST'])
 def upload():
-    global cached_docx_path, cached_csv_path
-
     if request.method == 'POST':
         if 'docx_file' in request.files:
             docx_file = request.files['docx_file']
             if docx_file.filename != '':
                 filename = datetime.now().strftime('%Y%m%d%H%M%S_') + secure_filename(docx_file.filename)
-                cached_docx_path = os.path.join(UPLOAD_FOLDER, filename)
-                docx_file.save(cached_docx_path)
+                docx_path = os.path.join(UPLOAD_FOLDER, filename)
+                docx_file.save(docx_path)
+                update_session_files(docx_path=docx_path)
 
         if 'csv_file' in request.files:
             csv_file = request.files['csv_file']
             if csv_file.filename != '':
                 filename = datetime.now().strftime('%Y%m%d%H%M%S_') + secure_filename(csv_file.filename)
-                cached_csv_path = os.path.join(UPLOAD_FOLDER, filename)
-                csv_file.save(cached_csv_path)
+                csv_path = os.path.join(UPLOAD_FOLDER, filename)
+                csv_file.save(csv_path)
+                if request.form.get('csv_mode') == 'append' and session_files().get('csv_path'):
+                    try:
+                        append_to_current_dataset(csv_path)
+                    except Exception as e:
+                        logger.warning("附加資料失敗: %s", e)
+                        return render_template('index.html', error=f"附加資料失敗: {str(e)}",
+                                               can_append=True)
+                else:
+                    update_session_files(csv_path=csv_path, csv_appends=None, dataset_id=None)
 
         if 'settings_file' in request.files:
             settings_file = request.files['settings_file']
             if settings_file.filename != '' and settings_file.filename.endswith('.json'):
                 settings_file.save(SETTINGS_PATH)
 
-        if cached_docx_path and cached_csv_path:
+        maybe_prune_files()
+        files = session_files()
+        if files.get('docx_path') and files.get('csv_path'):
             return redirect(url_for('preview'))
 
-    return render_template('index.html')
+    return render_template('index.html', can_append=bool(session_files().get('csv_path')))
+
+@app.route('/append_csv', methods=['POST'])
+def append_csv():
+    """Append the uploaded `csv_file` to this session's dataset (e.g. a weekly refresh)."""
+    csv_file = request.files.get('csv_file')
+    if csv_file is None or csv_file.filename == '':
+        return jsonify({'error': '請上傳 CSV 檔案'}), 400
+    filename = datetime.now().strftime('%Y%m%d%H%M%S_') + secure_filename(csv_file.filename)
+    csv_path = os.path.join(UPLOAD_FOLDER, filename)
+    csv_file.save(csv_path)
+    before = current_dataset()
+    try:
+        dataset = append_to_current_dataset(csv_path)
+    except Exception as e:
+        # Schema mismatches and unreadable files are problems with the upload
+        return jsonify({'error': str(e)}), 400
+    maybe_prune_files()
+    return jsonify({
+        'dataset_id': dataset.id,
+        'row_count': len(dataset.df),
+        'rows_added': len(dataset.df) - len(before.df),
+        'date_min': dataset.date_min.isoformat(),
+        'date_max': dataset.date_max.isoformat()
+    })
 
 # Keep the original index route, but now forward to the upload function
 @app.route('/index', methods=['GET', 'POST'])
@@ -286,6 +2633,7 @@ def index():
 
 @app.route('/login')
 def login():
+    from google_auth_oauthlib.flow import Flow
     flow = Flow.from_client_secrets_file(
         '/etc/secrets/credentials.json',
         scopes=SCOPES,
@@ -302,6 +2650,7 @@ def logout():
 
 @app.route('/oauth2callback')
 def oauth2callback():
+    from google_auth_oauthlib.flow import Flow
     flow = Flow.from_client_secrets_file(
         '/etc/secrets/credentials.json',
         scopes=SCOPES,
@@ -328,6 +2677,7 @@ def set_token():
         return jsonify({'success': False, 'error': 'Missing token'}), 400
 
     # Create credentials with token
+    from google.oauth2.credentials import Credentials
     creds = Credentials(token=token)
     session['credentials'] = {
         'token': creds.token,
@@ -349,496 +2699,354 @@ def save_token():
 
 @app.route('/preview', methods=['GET'])
 def preview():
-    global cached_docx_path, cached_csv_path
+    files = session_files()
+    docx_path = files.get('docx_path')
+    csv_path = files.get('csv_path')
 
-    if not cached_docx_path or not cached_csv_path:
+    if not docx_path or not csv_path:
         return redirect(url_for('upload'))
 
     try:
-        variables = extract_template_variables(cached_docx_path)
-        analyze_csv(cached_csv_path)
-        html_content = convert_docx_to_html(cached_docx_path)
+        variables = extract_template_variables(docx_path)
+        # Includes any CSVs appended to the uploaded one
+        dataset = current_dataset()
+        if dataset is None:
+            raise Exception("找不到資料檔案")
+        html_content = convert_docx_to_html(docx_path)
 
         return render_template('preview.html',
                             html_content=html_content,
                             variables=variables,
-                            date_column=date_column,
-                            date_min=date_min,
-                            date_max=date_max)
+                            date_column=dataset.date_column,
+                            date_min=dataset.date_min,
+                            date_max=dataset.date_max)
     except Exception as e:
-        print(f"預覽生成錯誤: {str(e)}")
+        logger.exception("預覽生成錯誤: %s", e)
         return render_template('index.html', error=f"預覽生成失敗: {str(e)}")
 
 @app.route('/filter_data', methods=['POST'])
 def filter_data():
-    global cached_dataframe, date_column
-
+    """Select a date range. By default only the dataset handle is returned; `format` asks for
+    a head sample ('summary'), per-day totals optionally split by `group_by` ('rollup')
+    or a page of rows ('columnar', 'records', 'arrow')."""
     data = request.json
-    start_date = pd.to_datetime(data.get('start_date'))
-    end_date = pd.to_datetime(data.get('end_date'))
-
-    if not date_column:
-        return jsonify([])
+    start_date = data.get('start_date')
+    end_date = data.get('end_date')
+    response_format = data.get('format', 'handle')
+
+    dataset = current_dataset()
+    if dataset is None:
+        return jsonify({'error': '尚未載入資料'}), 400
+    if response_format not in DATA_FORMATS:
+        return jsonify({'error': f"不支援的格式: {response_format}"}), 400
+
+    lo, hi = dataset.bounds(start_date, end_date)
+    handle = make_dataset_handle(dataset, start_date, end_date, hi - lo)
+    if response_format == 'handle':
+        return jsonify(handle)
+
+    if response_format == 'summary':
+        head = dataset.df.iloc[lo:min(hi, lo + FILTER_SAMPLE_ROWS)]
+        body = (json.dumps(dict(handle, schema=dataset.schema), ensure_ascii=False)[:-1]
+                + f',"head":{head.to_json(orient="records", date_format="iso", double_precision=15, force_ascii=False)}}}')
+        return compressed_response(body, 'application/json')
+
+    if response_format == 'rollup':
+        group_by = data.get('group_by')
+        if group_by is not None and (group_by not in dataset.df.columns or group_by == dataset.date_column):
+            return jsonify({'error': f"無法依欄位分組: {group_by}"}), 400
+        with span('rollup'):
+            table = dataset.rollup_table(lo, hi, group_by)
+        with span('serialize'):
+            rows = frame_to_columnar_json(table)
+        body = json.dumps(dict(handle, group_by=group_by), ensure_ascii=False)[:-1] + f',"rollup":{rows}}}'
+        return compressed_response(body, 'application/json')
 
-    filtered = cached_dataframe[
-        (cached_dataframe[date_column] >= start_date) &
-        (cached_dataframe[date_column] <= end_date)
-    ]
-
-    return jsonify(filtered.to_dict(orient='records'))
+    try:
+        offset = max(0, int(data.get('offset', 0)))
+        limit = min(max(1, int(data.get('limit', FILTER_PAGE_SIZE))), FILTER_MAX_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'offset / limit 必須是整數'}), 400
+    page = dataset.df.iloc[min(hi, lo + offset):min(hi, lo + offset + limit)]
+    next_offset = offset + limit if lo + offset + limit < hi else None
+
+    if response_format == 'arrow':
+        # Paging metadata travels in headers so the body stays a plain Arrow IPC stream
+        headers = {'X-Dataset-Id': handle['dataset_id'], 'X-Row-Count': str(handle['row_count'])}
+        if next_offset is not None:
+            headers['X-Next-Offset'] = str(next_offset)
+        with span('serialize'):
+            body = frame_to_arrow_stream(page)
+        return compressed_response(body, 'application/vnd.apache.arrow.stream', headers)
+
+    with span('serialize'):
+        if response_format == 'columnar':
+            rows = frame_to_columnar_json(page)
+        else:
+            rows = page.to_json(orient='records', date_format='iso', double_precision=15, force_ascii=False)
+    meta = dict(handle, offset=offset, limit=limit, next_offset=next_offset)
+    body = json.dumps(meta, ensure_ascii=False)[:-1] + f',"rows":{rows}}}'
+    return compressed_response(body, 'application/json')
 
 @app.route('/render_preview', methods=['POST'])
 def render_preview():
-    data = request.json.get('data', [])
-    formulas = request.json.get('formulas', {})
-
-    if not data:
-        return jsonify({})
-
-    df = pd.DataFrame(data)
-    results = {}
-    calculated_context = {}
-    special_vars = ['start_date', 'end_date']
-
-    # Create a formula dependency diagram
-    formula_graph = {}
-    for var, formula_info in formulas.items():
-        if isinstance(formula_info, dict) and formula_info.get('type') == 'formula':
-            formula = formula_info.get('value', '')
-        elif isinstance(formula_info, dict) and formula_info.get('type') == 'chart':
-            formula = ''
-        else:
-            formula = formula_info
-
-        dependencies = set()
-        for other_var in formulas:
-            if other_var != var and isinstance(formula, str) and re.search(r'\b' + re.escape(other_var) + r'\b', formula):
-                dependencies.add(other_var)
-        formula_graph[var] = dependencies
-
-    visited = set()
-    temp_visited = set()
-    order = []
-
-    def topo_sort(node):
-        if node in temp_visited:
-            print(f"循環依賴: {node}")
-            return
-        if node in visited:
-            return
-        temp_visited.add(node)
-        for dep in formula_graph.get(node, []):
-            topo_sort(dep)
-        temp_visited.remove(node)
-        visited.add(node)
-        order.append(node)
-
-    for var in formulas:
-        if var not in visited:
-            topo_sort(var)
+    payload = request.json
+    # 'vector' returns chart specs for the browser to draw; 'raster' exports PNGs like /render
+    fidelity = payload.get('fidelity', 'vector')
+    # {'changed': {var: setting}, 'removed': [var]} against the formulas this session sent before
+    delta = payload.get('delta')
 
-    order.reverse()
-
-    for var in formulas:
-        if var not in order:
-            try:
-                setting = formulas[var]
-                if var in special_vars and 'date' in df.columns:
-                    if var == 'start_date':
-                        value = df['date'].min()
-                    else:
-                        value = df['date'].max()
-                    if pd.isna(value):
-                        value = ''
-                    else:
-                        value = pd.to_datetime(value).strftime('%Y/%m/%d')
-                    results[var] = value
-                    calculated_context[var] = value
-                elif isinstance(setting, dict):
-                    if setting.get('type') == 'formula':
-                        expr = setting.get('value')
-                        value = evaluate_formula(expr, df, context=calculated_context, formulas=formulas)
-                        if hasattr(value, "item"):
-                            value = value.item()
-                        if isinstance(value, (int, float)):
-                            value = round(value, 2)
-                        results[var] = value
-                        calculated_context[var] = value
-                    elif setting.get('type') == 'chart':
-                        results[var] = ''
-                    else:
-                        results[var] = setting.get('value', '')
-                        calculated_context[var] = setting.get('value', '')
-                else:
-                    results[var] = setting
-                    calculated_context[var] = setting
-            except Exception as e:
-                results[var] = f"錯誤: {str(e)}"
-
-    for var in order:
-        try:
-            setting = formulas[var]
-            if isinstance(setting, dict):
-                if setting.get('type') == 'chart':
-                    x_col = setting.get('x')
-                    y_col = setting.get('y')
-                    chart_type = setting.get('chartType')
-
-                    if not all([x_col, y_col, chart_type]):
-                        results[var] = '錯誤：缺少圖表設定'
-                        continue
+    try:
+        df = resolve_dataframe(payload)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-                    fig = None
-                    if chart_type == 'line':
-                        df[x_col] = pd.to_datetime(df[x_col], errors='coerce')
-                        daily_df = df.groupby(df[x_col].dt.date).agg({y_col: 'sum'}).reset_index()
-                        daily_df.rename(columns={daily_df.columns[0]: x_col}, inplace=True)
-                        fig = px.line(daily_df, x=x_col, y=y_col, title=f"{y_col} by {x_col}")
-                    
-                    elif chart_type == 'bar':
-                        bar_df = df.groupby(x_col).agg({y_col: 'sum'}).reset_index()
-                        fig = px.bar(bar_df, x=x_col, y=y_col, title=f"{y_col} by {x_col}")
-                    
-                    elif chart_type == 'hist':
-                        fig = px.histogram(df, x=y_col, nbins=20, title=f"{y_col} Histogram")
-                    
-                    elif chart_type == 'pie':
-                        pie_data = df.groupby(x_col)[y_col].sum().reset_index()
-                        fig = px.pie(pie_data, values=y_col, names=x_col, title=f"{y_col} 分佈")
-                    
-                    else:
-                        results[var] = '錯誤：不支援的圖表類型'
-                        continue
+    if df is None or df.empty:
+        return jsonify({})
 
-                    save_path = os.path.join('generated', f'{var}.png')
-                    fig.write_image(save_path, width=800, height=600, scale=2)
+    def preview_chart(var, setting):
+        x_col = setting.get('x')
+        y_col = setting.get('y')
+        chart_type = setting.get('chartType')
 
-                    results[var] = ''
+        if not all([x_col, y_col, chart_type]):
+            raise ValueError('缺少圖表設定')
 
-                elif setting.get('type') == 'formula':
-                    expr = setting.get('value')
-                    value = evaluate_formula(expr, df, context=calculated_context, formulas=formulas)
-                    if hasattr(value, "item"):
-                        value = value.item()
-                    if isinstance(value, (int, float)):
-                        value = round(value, 2)
-                    results[var] = value
-                    calculated_context[var] = value
+        if fidelity == 'vector':
+            return {'chart': build_chart_spec(df, x_col, y_col, chart_type, chart_title=setting.get('chartTitle'))}
 
-                else:
-                    results[var] = setting.get('value', '')
-                    calculated_context[var] = setting.get('value', '')
-            else:
-                results[var] = setting
-                calculated_context[var] = setting
+        # Same figure builder and image cache as /render, so the final export can reuse it
+        save_path = os.path.join(GENERATED_FOLDER, f'{var}.png')
+        generate_chart(df, x_col, y_col, chart_type, save_path, chart_title=setting.get('chartTitle'), dpi_scale=2)
+        return ''
 
-        except Exception as e:
-            results[var] = f"錯誤: {str(e)}"
+    preview_id = session.setdefault('preview_id', uuid.uuid4().hex)
+    view = (json.dumps(payload.get('dataset'), sort_keys=True), fidelity)
 
-    return jsonify(results)
+    # Held until the results are read off the graph, which the session's next request updates
+    with preview_lock(preview_id):
+        if delta is None:
+            graph = FormulaGraph(payload.get('formulas', {}), df.columns)
+            names = None
+        else:
+            state = get_preview(preview_id)
+            if state is None or not payload.get('dataset') or state['graph'].columns != tuple(df.columns):
+                return jsonify({'error': '預覽狀態已失效，請重新送出完整公式', 'resync': True}), 409
+            graph = state['graph']
+            stale = graph.update(delta.get('changed'), delta.get('removed', []))
+            if state['view'] != view:
+                # A new date range (or fidelity) invalidates everything computed from the data
+                stale |= {var for var, setting in graph.formulas.items() if depends_on_data(setting)}
+            names = graph.downstream(stale)
+
+        previous = dict(graph.values)
+        evaluated = graph.evaluate(df, names, evaluate_chart=preview_chart)
+        remember_preview(preview_id, {'graph': graph, 'view': view})
+
+        results = {}
+        for var, value in evaluated.items():
+            # A delta only reports what actually changed (a re-exported PNG always counts)
+            if delta is not None and not isinstance(value, Exception) and previous.get(var) == value \
+                    and not (is_chart_setting(graph.formulas[var]) and fidelity == 'raster'):
+                continue
+            results[var] = f"錯誤: {str(value)}" if isinstance(value, Exception) else value
+
+    with span('json_encode'):
+        response = jsonify(results)
+    return response
 
 @app.route('/render', methods=['POST'])
 def render_word():
-    global cached_docx_path # Ensure this global variable is accessible
-
-    formulas = request.json.get('formulas', {})
-    data = request.json.get('data', [])
-    filename = request.json.get('filename', 'final_report.docx')
-
-    if not cached_docx_path or not os.path.exists(cached_docx_path):
-         return "錯誤：找不到 Word 模板文件。", 400
-    if not data:
-        return "錯誤：沒有提供用於渲染的數據。", 400
-
     try:
-        filtered_df = pd.DataFrame(data)
-        # Convert date column to datetime if it exists and isn't already
-        # Assuming date_column is known globally or can be inferred
-        # if date_column and date_column in filtered_df.columns:
-        #     filtered_df[date_column] = pd.to_datetime(filtered_df[date_column], errors='coerce')
-
-    except Exception as e:
-        print(f"Error creating DataFrame from data: {e}")
-        return f"錯誤：處理輸入數據時出錯: {str(e)}", 400
-
-    context = {}
-    calculated_context = {} # Keep track of calculated values for dependencies
-
-    # ---Explicitly add start_date and end_date ---
-    # Ensure they are set before potentially complex formula evaluations.
-    if 'start_date' in formulas and isinstance(formulas['start_date'], dict) and formulas['start_date'].get('type') == 'fixed':
-        start_date_val = formulas['start_date'].get('value', '')
-        context['start_date'] = start_date_val
-        calculated_context['start_date'] = start_date_val
-        print(f"DEBUG (render_word): Explicitly set start_date in context: {start_date_val}")
-
-    if 'end_date' in formulas and isinstance(formulas['end_date'], dict) and formulas['end_date'].get('type') == 'fixed':
-        end_date_val = formulas['end_date'].get('value', '')
-        context['end_date'] = end_date_val
-        calculated_context['end_date'] = end_date_val
-        print(f"DEBUG (render_word): Explicitly set end_date in context: {end_date_val}")
-
-    # ---Topological Sort Logic ---
-    formula_graph = {}
-    valid_vars = set(formulas.keys()) # Keep track of variables defined in formulas
-
-    for var, formula_info in formulas.items():
-        # Skip dates if already handled
-        if var in ['start_date', 'end_date'] and var in context:
-             continue
-
-        formula = '' # Default to empty string
-        if isinstance(formula_info, dict):
-            if formula_info.get('type') == 'formula':
-                formula = formula_info.get('value', '')
-        elif isinstance(formula_info, str): # Handle case where formula is just a string
-             formula = formula_info
-        # else: # Charts or other types have no formula string for dependency check
-
-        dependencies = set()
-        if isinstance(formula, str) and formula: # Only check dependencies if formula is a non-empty string
-            # Find potential variable names (simple regex, might need refinement)
-            potential_deps = re.findall(r'[a-zA-Z_][a-zA-Z0-9_]*', formula)
-            for dep in potential_deps:
-                # Check if the potential dependency is a defined variable, not the variable itself,
-                # and not a known function name (basic check, might need expansion)
-                 if dep in valid_vars and dep != var and dep.upper() not in ['SUM', 'MEAN', 'MAX', 'MIN', 'COUNT', 'MEDIAN', 'STD', 'VAR', 'PERCENT_CHANGE', 'DIFF', 'CAGR', 'MODE', 'DISTINCT', 'NP']:
-                     dependencies.add(dep)
-        formula_graph[var] = dependencies
-
-
-    visited = set()
-    recursion_stack = set() # To detect cycles
-    order = []
-
-    def topo_sort(node):
-        if node not in valid_vars: # Skip if node isn't a defined variable
-             print(f"DEBUG (topo_sort): Node '{node}' not in valid_vars, skipping.")
-             return
-        # Skip dates if already handled
-        if node in ['start_date', 'end_date'] and node in context:
-            return
-
-        if node in recursion_stack:
-            print(f"錯誤：偵測到循環依賴 involving '{node}'")
-            raise Exception(f"循環依賴: {node}") # Raise error on cycle
-        if node in visited:
-            return
-
-        visited.add(node)
-        recursion_stack.add(node)
-
-        # Ensure dependencies exist in the graph before recursing
-        for dep in formula_graph.get(node, []):
-             if dep in valid_vars:
-                 topo_sort(dep)
-             else:
-                 # This dependency might be a column name, not another formula variable.
-                 # Or it could be an error in the formula. Let evaluate_formula handle it later.
-                 print(f"DEBUG (topo_sort): Dependency '{dep}' for node '{node}' not in formula graph keys.")
-
-
-        recursion_stack.remove(node)
-        # Only add nodes that are actually defined in formulas to the order
-        order.append(node) # Add after visiting all dependencies
-
-    # Build the execution order
-    for var in formulas:
-         if var not in visited and var not in ['start_date', 'end_date']: # Avoid re-processing handled dates
-            try:
-                topo_sort(var)
-            except Exception as e:
-                 print(f"Error during topological sort for var '{var}': {e}")
-                 # Return error if cycle detected during sort
-                 return f"公式計算順序錯誤（可能存在循環依賴）: {str(e)}", 500
-
-
-    # No need to reverse if appending happens after visiting dependencies
-    print(f"DEBUG (render_word): Formula calculation order: {order}")
-
-    # ---Initialize DocxTemplate ---
+        docx_path, formulas, filename, filtered_df = prepare_report(request.json)
+        # Rendered in memory and streamed back; nothing is left behind in generated/
+        output = build_report(docx_path, formulas, filtered_df, io.BytesIO())
+    except ReportError as e:
+        return str(e), e.status
+    maybe_prune_files()
+    output.seek(0)
+    return send_file(output, as_attachment=True, download_name=filename, mimetype=DOCX_MIMETYPE)
+
+@app.route('/render_jobs', methods=['POST'])
+def create_render_job():
     try:
-        doc = DocxTemplate(cached_docx_path)
-    except Exception as e:
-         print(f"Error loading DocxTemplate: {e}")
-         return f"錯誤：無法加載 Word 模板 '{os.path.basename(cached_docx_path)}': {str(e)}", 500
-
-
-    # ---Process variables ---
-    # Process variables NOT necessarily in the determined order first,
-    # especially fixed values or those without dependencies that weren't explicitly handled (like dates).
-    for var, setting in formulas.items():
-        if var not in order and var not in context: # Check if not already processed by explicit handling or order
-            print(f"DEBUG (render_word): Processing non-ordered var: {var}")
-            try:
-                value_to_set = None
-                is_chart = False
-                if isinstance(setting, dict):
-                    var_type = setting.get('type')
-                    if var_type == 'formula':
-                         # Evaluate only if no dependencies or handled dependencies
-                        expr = setting.get('value', '')
-                        # Be cautious evaluating here, dependencies might not be ready.
-                        # Better to rely on the 'order' loop for formulas.
-                        # Maybe set as placeholder? For now, let's attempt evaluation.
-                        value_to_set = evaluate_formula(expr, filtered_df, context=calculated_context, formulas=formulas)
-                    elif var_type == 'fixed':
-                         value_to_set = setting.get('value', '')
-                    elif var_type == 'chart':
-                         is_chart = True # Mark as chart, handle in the main loop
-                         context[var] = "[圖表將在此生成]" # Placeholder
-                    else: # Unknown dict type
-                         value_to_set = str(setting) # Convert dict to string as fallback
-
-                else: # Handle cases where 'setting' is not a dictionary (e.g., simple value)
-                    # Could be a simple formula string -attempt evaluation
-                    try:
-                         value_to_set = evaluate_formula(str(setting), filtered_df, context=calculated_context, formulas=formulas)
-                    except ValueError: # If evaluation fails, treat as literal string
-                         value_to_set = str(setting)
-
-
-                # Common post-processing for non-chart numeric values
-                if not is_chart and value_to_set is not None:
-                    if hasattr(value_to_set, "item"): # Convert numpy types
-                        value_to_set = value_to_set.item()
-                    if isinstance(value_to_set, (int, float)):
-                         value_to_set = round(value_to_set, 2) # Round numeric results
-
-                    context[var] = value_to_set
-                    calculated_context[var] = value_to_set # Update calculated context
-                    print(f"DEBUG (render_word): Set non-ordered var '{var}' in context: {value_to_set}")
-
-            except Exception as e:
-                print(f"錯誤：處理非順序變數 '{var}' 時出錯: {e}")
-                context[var] = f"[錯誤: {str(e)}]"
-                calculated_context[var] = None # Mark as error in calculated context
-
-
-    # ---Process variables IN topological order ---
-    for var in order:
-        # Ensure the variable is actually in formulas before processing
-        if var not in formulas:
-             print(f"警告 (render_word): 變數 '{var}' 在計算順序中但不在 formulas 中，跳過。")
-             continue
-        # Skip if already processed (e.g., fixed values handled above)
-        if var in context and not (isinstance(formulas[var], dict) and formulas[var].get('type') == 'chart' and context[var] == "[圖表將在此生成]"):
-            print(f"DEBUG (render_word): Var '{var}' already in context, skipping ordered processing.")
-            continue
-
-        print(f"DEBUG (render_word): Processing ordered var: {var}")
-        try:
-            setting = formulas[var]
-            value_to_set = None # Reset for each variable
-            is_chart = False
-
-            if isinstance(setting, dict):
-                var_type = setting.get('type')
-                if var_type == 'formula':
-                    expr = setting.get('value', '')
-                    print(f"DEBUG (render_word): Evaluating formula for '{var}': {expr}")
-                    value_to_set = evaluate_formula(expr, filtered_df, context=calculated_context, formulas=formulas)
-
-                elif var_type == 'chart':
-                    is_chart = True
-                    x_col = setting.get('x')
-                    y_col = setting.get('y')
-                    chart_type = setting.get('chartType')
-                    chart_title = setting.get('chartTitle') # Get chart title
-                    # Use a default DPI scale if not provided
-                    dpi_scale_str = setting.get('dpi', '2') # Get DPI setting as string
-                    try:
-                        dpi_scale = float(dpi_scale_str)
-                    except (ValueError, TypeError):
-                        print(f"警告：圖表 '{var}' 的 DPI 設定 '{dpi_scale_str}' 無效，使用預設值 2。")
-                        dpi_scale = 2
-
-
-                    if not x_col or not y_col or not chart_type:
-                        print(f"警告 (render_word): 圖表 '{var}' 缺少設定 (X:{x_col}, Y:{y_col}, Type:{chart_type})，跳過。")
-                        context[var] = "[圖表設定不完整]"
-                        continue
-                     # Ensure columns exist in DataFrame
-                    if x_col not in filtered_df.columns or y_col not in filtered_df.columns:
-                         print(f"錯誤 (render_word): 圖表 '{var}' 所需欄位 ({x_col}, {y_col}) 不在資料中，跳過。")
-                         context[var] = f"[錯誤：找不到欄位 {x_col} 或 {y_col}]"
-                         continue
-
-                    img_path = os.path.join(GENERATED_FOLDER, f"{var}.png")
-                    print(f"DEBUG (render_word): Generating chart for '{var}' with title: '{chart_title}', DPI scale: {dpi_scale}")
-                    generate_chart(
-                        filtered_df,
-                        x_col,
-                        y_col,
-                        chart_type,
-                        img_path, # Pass output path directly
-                        chart_title=chart_title, # Pass the title
-                        dpi_scale=dpi_scale # Pass DPI scale
-                        )
-                    # Add InlineImage to context if image generation succeeded
-                    if os.path.exists(img_path):
-                         context[var] = InlineImage(doc, img_path, width=Mm(120)) # Adjust width as needed
-                         print(f"DEBUG (render_word): Added chart '{var}' to context.")
-                    else:
-                         print(f"錯誤 (render_word): 圖表 '{var}' 圖片生成失敗或未找到。")
-                         context[var] = "[圖表生成失敗]"
-                    # Charts don't usually add to calculated_context unless their result is needed elsewhere
-
-                elif var_type == 'fixed': # Should have been handled above, but catch just in case
-                    value_to_set = setting.get('value', '')
-                else: # Unknown dict type
-                     value_to_set = str(setting)
-
-            else: # Handle non-dict formulas/values if they end up in 'order'
-                 print(f"DEBUG (render_word): Evaluating non-dict formula/value for '{var}': {setting}")
-                 try:
-                     value_to_set = evaluate_formula(str(setting), filtered_df, context=calculated_context, formulas=formulas)
-                 except ValueError as ve:
-                     # If evaluation fails, treat as literal string? Or report error?
-                     print(f"警告：評估非字典變數 '{var}' 時出錯 ({ve})，將其視為字串。")
-                     value_to_set = str(setting)
-
-            # Common post-processing and context update for non-chart variables
-            if not is_chart and value_to_set is not None:
-                 if hasattr(value_to_set, "item"): # Convert numpy types
-                     value_to_set = value_to_set.item()
-                 if isinstance(value_to_set, (int, float)):
-                    # Apply rounding only if it's not already a string representation
-                    if not isinstance(value_to_set, str):
-                         value_to_set = round(value_to_set, 2)
-
-                 context[var] = value_to_set
-                 calculated_context[var] = value_to_set # Update calculated context
-                 print(f"DEBUG (render_word): Set ordered var '{var}' in context: {value_to_set}")
-            elif not is_chart and value_to_set is None:
-                 print(f"警告 (render_word): 變數 '{var}' 計算結果為 None。")
-                 context[var] = "" # Set empty string for None results in template? Or handle differently?
-                 calculated_context[var] = None
-
-
-        except Exception as e:
-            print(f"錯誤：處理順序變數 '{var}' 時發生嚴重錯誤: {e}")
-            import traceback
-            traceback.print_exc() # Print full traceback for debugging
-            context[var] = f"[處理錯誤: {str(e)}]"
-            calculated_context[var] = None # Mark as error in calculated context
+        docx_path, formulas, filename, filtered_df = prepare_report(request.json)
+    except ReportError as e:
+        return jsonify({'error': str(e)}), e.status
+
+    job = submit_render_job(docx_path, formulas, filename, filtered_df)
+    if job is None:
+        return jsonify({'error': '目前排隊的報表過多，請稍後再試'}), 429, {'Retry-After': '5'}
+    urls = {
+        'job_id': job['id'],
+        'status_url': url_for('render_job_status', job_id=job['id']),
+        'download_url': url_for('download_render_job', job_id=job['id'])
+    }
+    if RENDER_JOB_EVENTS:
+        urls['events_url'] = url_for('render_job_events', job_id=job['id'])
+    return jsonify(urls), 202
+
+@app.route('/render_jobs/metrics', methods=['GET'])
+def render_job_metrics():
+    with _render_jobs_lock:
+        stats = dict(render_job_stats)
+    finished = stats['completed'] + stats['failed']
+    stats['avg_seconds'] = round(stats.pop('seconds') / finished, 3) if finished else None
+    stats['workers'] = RENDER_WORKERS
+    stats['queue_limit'] = RENDER_QUEUE_LIMIT
+    return jsonify(stats)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms of every span and request endpoint in this process (JSON, or
+    Prometheus text with ?format=prometheus), plus render queue and dataset store gauges."""
+    with _metrics_lock:
+        snapshot = {name: dict(h, buckets=list(h['buckets'])) for name, h in _metrics.items()}
+    with _render_jobs_lock:
+        jobs = dict(render_job_stats)
+    datasets = list(dataset_store._datasets.values())
+    gauges = {
+        'render_jobs_queued': jobs['queued'],
+        'render_jobs_running': jobs['running'],
+        'render_jobs_completed': jobs['completed'],
+        'render_jobs_failed': jobs['failed'],
+        'render_jobs_rejected': jobs['rejected'],
+        'datasets_in_memory': len(datasets),
+        'dataset_memory_bytes': sum(d.nbytes for d in datasets),
+        'dataset_memory_budget_bytes': DATASET_MEMORY_BUDGET,
+    }
 
-    # ---Final rendering ---
+    if request.args.get('format') == 'prometheus':
+        lines = ['# TYPE reportgen_duration_ms histogram']
+        for name, h in sorted(snapshot.items()):
+            label = name.replace('\\', '\\\\').replace('"', '\\"')
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS_MS + ('+Inf',), h['buckets']):
+                cumulative += count
+                lines.append(f'reportgen_duration_ms_bucket{{span="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'reportgen_duration_ms_sum{{span="{label}"}} {h["sum_ms"]:.3f}')
+            lines.append(f'reportgen_duration_ms_count{{span="{label}"}} {h["count"]}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE reportgen_{name} gauge')
+            lines.append(f'reportgen_{name} {value}')
+        return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+    histograms = {}
+    for name, h in snapshot.items():
+        histograms[name] = {
+            'count': h['count'],
+            'sum_ms': round(h['sum_ms'], 3),
+            'mean_ms': round(h['sum_ms'] / h['count'], 3),
+            'buckets': {str(bound): count for bound, count in zip(METRIC_BUCKETS_MS + ('+Inf',), h['buckets'])}
+        }
+    return jsonify({'pid': os.getpid(), 'histograms': histograms, 'gauges': gauges})
+
+@app.route('/render_jobs/<job_id>', methods=['GET'])
+def render_job_status(job_id):
+    job = read_render_job(job_id)
+    if job is None:
+        return jsonify({'error': '找不到此報表工作'}), 404
+    return jsonify(job)
+
+@app.route('/render_jobs/<job_id>/events', methods=['GET'])
+def render_job_events(job_id):
+    if read_render_job(job_id) is None:
+        return jsonify({'error': '找不到此報表工作'}), 404
+
+    def stream():
+        # Server-sent events: one message per status change until the job finishes, and a
+        # comment line in between so proxies don't close the idle connection
+        last = None
+        while True:
+            job = read_render_job(job_id)
+            if job is None:
+                return
+            if job != last:
+                yield f"data: {json.dumps(job, ensure_ascii=False)}\n\n"
+                last = job
+            else:
+                yield ": keep-alive\n\n"
+            if job['status'] in ('done', 'failed'):
+                return
+            time.sleep(RENDER_JOB_EVENTS_INTERVAL)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/render_jobs/<job_id>/download', methods=['GET'])
+def download_render_job(job_id):
+    job = read_render_job(job_id)
+    if job is None:
+        return jsonify({'error': '找不到此報表工作'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': '報表尚未完成', 'status': job['status']}), 409
+    return send_file(os.path.abspath(os.path.join(_render_job_folder(job_id), 'report.docx')),
+                     as_attachment=True, download_name=job['filename'])
+
+@app.route('/batch_render', methods=['POST'])
+def batch_render():
+    """One report per partition: date windows (`windows` or a `frequency` such as 'W'/'M' over the
+    dataset handle's range) crossed with the values of `group_by`; streams back a zip."""
+    payload = request.json
+    dataset = current_dataset()
+    files = session_files()
+    docx_path = files.get('docx_path')
+    if dataset is None or not docx_path or not os.path.exists(docx_path):
+        return jsonify({'error': '尚未載入模板或資料'}), 400
+
+    # Either the formulas themselves or a saved settings JSON ({'formulas': ...})
+    formulas = payload.get('formulas') or (payload.get('settings') or {}).get('formulas', {})
+    handle = payload.get('dataset') or {}
     try:
-        print(f"DEBUG (render_word): Final context for rendering: {context}") # Debug: print final context
-        doc.render(context)
-        output_path = os.path.join(GENERATED_FOLDER, filename)
-        # Ensure the generated folder exists
-        os.makedirs(GENERATED_FOLDER, exist_ok=True)
-        doc.save(output_path)
-        print(f"INFO (render_word): Word document saved to {output_path}")
-        return send_file(output_path, as_attachment=True, download_name=filename)
-    except Exception as e:
-         print(f"錯誤：最終渲染 Word 文件 '{filename}' 時出錯: {e}")
-         import traceback
-         traceback.print_exc()
-         # Consider returning an error response to the user
-         return f"渲染 Word 時發生嚴重錯誤: {str(e)}", 500
+        partitions = expand_partitions(dataset, handle.get('start_date'), handle.get('end_date'),
+                                       frequency=payload.get('frequency'), windows=payload.get('windows'),
+                                       group_by=payload.get('group_by'), groups=payload.get('groups'))
+        partition_filename(payload.get('filename'), partitions[0])
+    except (ValueError, KeyError, IndexError) as e:
+        return jsonify({'error': f"批次設定錯誤: {e}"}), 400
+
+    zip_name = payload.get('zip_filename', 'reports.zip')
+    stream = stream_batch_zip(dataset, session_sources(files), docx_path, formulas, partitions,
+                              filename_pattern=payload.get('filename'))
+    return Response(stream, mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{secure_filename(zip_name) or "reports.zip"}"'})
+
+@app.cli.command('batch-render')
+@click.option('--template', 'docx_path', required=True, help='Word template (.docx)')
+@click.option('--csv', 'csv_path', required=True, help='Data CSV')
+@click.option('--append', 'append_paths', multiple=True, help='CSV with more rows for --csv (repeatable, in order)')
+@click.option('--settings', 'settings_path', required=True, help='Settings JSON saved from the editor')
+@click.option('--start', 'start_date', default=None, help='First date (default: first date in the data)')
+@click.option('--end', 'end_date', default=None, help='Last date (default: last date in the data)')
+@click.option('--frequency', default=None, help="Split the range into periods, e.g. 'W' or 'M'")
+@click.option('--group-by', default=None, help='Also split by every value of this column')
+@click.option('--filename', default=None, help='Report name pattern, e.g. "weekly_{start_date}_{group}"')
+@click.option('--output', default='reports.zip', help='Zip file to write')
+def batch_render_command(docx_path, csv_path, append_paths, settings_path, start_date, end_date, frequency, group_by,
+                         filename, output):
+    """Render one report per partition into a zip, in parallel across BATCH_WORKERS processes."""
+    with open(settings_path, 'r', encoding='utf-8') as f:
+        formulas = json.load(f).get('formulas', {})
+    dataset = analyze_csv(csv_path)
+    for append_path in append_paths:
+        dataset = dataset_store.append_csv(dataset, append_path)
+    partitions = expand_partitions(dataset, start_date, end_date, frequency=frequency, group_by=group_by)
+    click.echo(f"Rendering {len(partitions)} reports with {BATCH_WORKERS} workers")
+    with open(output, 'wb') as f:
+        for chunk in stream_batch_zip(dataset, [csv_path, *append_paths], docx_path, formulas, partitions,
+                                      filename_pattern=filename):
+            f.write(chunk)
+    click.echo(f"Saved {output}")
+
+@app.cli.command('prune-files')
+@click.option('--max-age', type=int, default=None, help='Override both retention periods (seconds)')
+def prune_files_command(max_age):
+    """Delete expired uploads, generated files, cached datasets and finished render jobs now."""
+    global UPLOAD_RETENTION_SECONDS, GENERATED_RETENTION_SECONDS, DATASET_CACHE_RETENTION_SECONDS
+    if max_age is not None:
+        UPLOAD_RETENTION_SECONDS = GENERATED_RETENTION_SECONDS = DATASET_CACHE_RETENTION_SECONDS = max_age
+    for folder, (removed, freed) in prune_files().items():
+        click.echo(f"{folder}: removed {removed} files ({freed / (1024 * 1024):.1f} MB)")
 
 @app.route('/save_settings', methods=['POST'])
 def save_settings():
@@ -891,15 +3099,15 @@ def load_settings():
 
 @app.route('/get_columns', methods=['GET'])
 def get_columns():
-    global cached_dataframe
-    if cached_dataframe is not None:
-        return jsonify({"columns": list(cached_dataframe.columns)})
+    dataset = current_dataset()
+    if dataset is not None:
+        return jsonify({"columns": list(dataset.df.columns), "schema": dataset.schema})
     else:
-        return jsonify({"columns": []})
+        return jsonify({"columns": [], "schema": {}})
 
 @app.route('/generated/<path:filename>')
 def serve_generated_file(filename):
-    return send_from_directory('generated', filename)
+    return send_from_directory(os.path.abspath(GENERATED_FOLDER), filename)
 
 @app.route('/regenerate_chart', methods=['POST'])
 def regenerate_chart():
@@ -910,15 +3118,17 @@ def regenerate_chart():
     y_col = content.get('y')
     chart_type = content.get('chartType')
     chart_title = content.get('chartTitle')
-    data = content.get('data')
     dpi_scale = content.get('dpi', 2)  # 🔥 Preset dpi_scale 2
 
-    if not all([var_name, x_col, y_col, chart_type, data]):
+    if not all([var_name, x_col, y_col, chart_type]):
         return jsonify({'error': '缺少必要參數'}), 400
 
-    df = pd.DataFrame(data)
+    try:
+        df = resolve_dataframe(content)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    if df.empty:
+    if df is None or df.empty:
         return jsonify({'error': '沒有資料'}), 400
 
     try:
@@ -958,6 +3168,8 @@ def contact():
         return redirect(url_for('home'))
 
     try:
+        from flask_mail import Message
+        mail = get_mail()
         msg = Message('網站聯絡表單新訊息 ✉️', recipients=[app.config['MAIL_USERNAME']], charset='utf-8')
         msg.body = f"""
 收到一封新的聯絡表單：
@@ -970,7 +3182,7 @@ def contact():
         mail.send(msg)
         flash('感謝您的聯絡！我們已收到您的訊息！', 'success')
     except Exception as e:
-        print(f"寄信失敗：{e}")
+        logger.error("寄信失敗：%s", e)
         flash('寄信時發生錯誤，請稍後再試！', 'warning')
 
     return redirect(url_for('home'))
@@ -1004,10 +3216,178 @@ def get_config():
         "GOOGLE_DEVELOPER_KEY": os.getenv("GOOGLE_DEVELOPER_KEY")
     })
 
+DRIVE_MANIFEST_PATH = os.path.join(UPLOAD_FOLDER, 'drive_manifest.json')
+# Bytes per ranged GET. Large enough that round trips don't matter, small enough that a CSV
+# starts parsing long before the download ends
+DRIVE_CHUNK_BYTES = int(os.getenv('DRIVE_CHUNK_BYTES', str(32 * 1024 * 1024)))
+DRIVE_CLIENT_CACHE_SIZE = int(os.getenv('DRIVE_CLIENT_CACHE_SIZE', '32'))
+# Base URL of the Drive v3 API, e.g. a local stand-in for tests: http://127.0.0.1:9000/drive/v3/
+DRIVE_API_ROOT = os.getenv('DRIVE_API_ROOT')
+DRIVE_FILE_FIELDS = 'id,name,mimeType,md5Checksum,modifiedTime,size'
+DRIVE_MIME_TYPES = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+    'text/csv': 'csv',
+    'application/json': 'json'
+}
+
+_drive_clients = OrderedDict()
+_drive_clients_lock = threading.Lock()
+_drive_manifest_lock = threading.Lock()
+
+def get_drive_service(credentials_info):
+    """Drive v3 client for these credentials, reused across requests.
+
+    Keyed by thread as well: a client's httplib2 connection must not be shared between threads.
+    """
+    key = (hashlib.sha256(json.dumps(credentials_info, sort_keys=True).encode('utf-8')).hexdigest(),
+           threading.get_ident())
+    with _drive_clients_lock:
+        service = _drive_clients.get(key)
+        if service is not None:
+            _drive_clients.move_to_end(key)
+            return service
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
+    service = build('drive', 'v3', credentials=Credentials(**credentials_info), cache_discovery=False,
+                    client_options={'api_endpoint': DRIVE_API_ROOT} if DRIVE_API_ROOT else None)
+    with _drive_clients_lock:
+        _drive_clients[key] = service
+        while len(_drive_clients) > DRIVE_CLIENT_CACHE_SIZE:
+            _drive_clients.popitem(last=False)
+    return service
+
+def read_drive_manifest():
+    try:
+        with open(DRIVE_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def update_drive_manifest(file_id, entry):
+    with _drive_manifest_lock:
+        manifest = read_drive_manifest()
+        manifest[file_id] = entry
+        tmp_path = f"{DRIVE_MANIFEST_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, DRIVE_MANIFEST_PATH)
+
+def cached_drive_copy(file_id, metadata):
+    """The manifest entry of an earlier download of this file when its content hasn't changed since."""
+    entry = read_drive_manifest().get(file_id)
+    if not entry or not os.path.exists(entry['path']):
+        return None
+    if metadata.get('md5Checksum'):
+        unchanged = entry.get('md5Checksum') == metadata['md5Checksum']
+    else:
+        unchanged = bool(metadata.get('modifiedTime')) and entry.get('modifiedTime') == metadata['modifiedTime']
+    return entry if unchanged else None
+
+class _ChunkPipe(io.RawIOBase):
+    """Bounded in-memory pipe: the downloader puts chunks, the CSV parser reads them as a file."""
+
+    def __init__(self, max_chunks=4):
+        super().__init__()
+        self._queue = queue.Queue(max_chunks)
+        self._buffer = memoryview(b'')
+        self._abandoned = False
+
+    def put(self, chunk):
+        if not self._abandoned:
+            self._queue.put(chunk)
+
+    def finish(self):
+        self.put(None)
+
+    def abandon(self):
+        # The reader stopped early: drop what's queued so the downloader never blocks on it
+        self._abandoned = True
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            chunk = self._queue.get()
+            if chunk is None:
+                self._queue.put(None)
+                return 0
+            self._buffer = memoryview(chunk)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+class _DownloadSink:
+    """What MediaIoBaseDownload writes to: the file on disk, a running sha256 and optionally a pipe."""
+
+    def __init__(self, f, pipe=None):
+        self.file = f
+        self.pipe = pipe
+        self.digest = hashlib.sha256()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.digest.update(chunk)
+        if self.pipe is not None:
+            self.pipe.put(bytes(chunk))
+        return len(chunk)
+
+def download_drive_file(service, file_id, save_path, ingest=False):
+    """Download a Drive file to save_path in DRIVE_CHUNK_BYTES ranges.
+
+    With ingest=True the bytes are parsed as a CSV while they arrive and the Dataset is
+    returned; None when parsing fails (the upload flow reports the error later, as before).
+    """
+    from googleapiclient.http import MediaIoBaseDownload
+    pipe = _ChunkPipe() if ingest else None
+    parsed = {}
+
+    def parse():
+        try:
+            with span('parse_csv'):
+                parsed['result'] = parse_csv(save_path, stream=io.BufferedReader(pipe, 1024 * 1024))
+        except Exception as e:
+            parsed['error'] = e
+        finally:
+            pipe.abandon()
+
+    parser = threading.Thread(target=parse, daemon=True) if ingest else None
+    if parser is not None:
+        parser.start()
+    try:
+        with open(save_path, 'wb') as f:
+            sink = _DownloadSink(f, pipe)
+            downloader = MediaIoBaseDownload(sink, service.files().get_media(fileId=file_id),
+                                             chunksize=DRIVE_CHUNK_BYTES)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+    except Exception:
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        raise
+    finally:
+        if parser is not None:
+            pipe.finish()
+            parser.join()
+
+    content_hash = sink.digest.hexdigest()
+    remember_content_hash(save_path, content_hash)
+    if not ingest:
+        return None
+    if 'error' in parsed:
+        logger.warning("Drive CSV 解析失敗 (%s): %s", os.path.basename(save_path), parsed['error'])
+        return None
+    return dataset_store.add_parsed(content_hash, save_path, parsed['result'])
+
 @app.route('/import_drive_file')
 def import_drive_file():
-    global cached_docx_path, cached_csv_path
-
     file_id = request.args.get('file_id')
     file_type = request.args.get('type')  # Can be used to determine which file it is: docx, csv, json
 
@@ -1018,43 +3398,79 @@ def import_drive_file():
         return jsonify(success=False, error="Not logged in to Google")
 
     try:
-        creds = Credentials(**session['credentials'])
-        drive_service = build('drive', 'v3', credentials=creds)
-        metadata = drive_service.files().get(fileId=file_id).execute()
+        drive_service = get_drive_service(session['credentials'])
+        # Fetched with the user's credentials even when a cached copy exists, so access is still checked
+        metadata = drive_service.files().get(fileId=file_id, fields=DRIVE_FILE_FIELDS).execute()
         file_name = metadata['name']
         mime_type = metadata['mimeType']
 
-        ext = {
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
-            'text/csv': 'csv',
-            'application/json': 'json'
-        }.get(mime_type)
-
+        ext = DRIVE_MIME_TYPES.get(mime_type)
         if not ext:
             return jsonify(success=False, error="Unsupported file type")
 
-        save_folder = 'uploads'
-        os.makedirs(save_folder, exist_ok=True)
-        timestamped_name = datetime.now().strftime('%Y%m%d%H%M%S_') + secure_filename(file_name)
-        save_path = os.path.join(save_folder, timestamped_name)
-
-        request_drive = drive_service.files().get_media(fileId=file_id)
-        with io.FileIO(save_path, 'wb') as fh:
-            downloader = MediaIoBaseDownload(fh, request_drive)
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-
-        # 🔥 Set to cached_xxx_path according to file type
+        dataset = None
+        cached = cached_drive_copy(file_id, metadata)
+        if cached:
+            save_path = cached['path']
+            logger.info("Drive 檔案未變更，沿用先前下載: %s", file_name)
+        else:
+            timestamped_name = datetime.now().strftime('%Y%m%d%H%M%S_') + secure_filename(file_name)
+            save_path = os.path.join(UPLOAD_FOLDER, timestamped_name)
+            with span('drive_download'):
+                # CSVs are ingested while they download, so /preview finds the dataset ready
+                dataset = download_drive_file(drive_service, file_id, save_path, ingest=(ext == 'csv'))
+            update_drive_manifest(file_id, {
+                'path': save_path,
+                'name': file_name,
+                'mimeType': mime_type,
+                'md5Checksum': metadata.get('md5Checksum'),
+                'modifiedTime': metadata.get('modifiedTime')
+            })
+
+        # 🔥 Remember the path in this user's session according to file type
         if ext == 'docx':
-            cached_docx_path = save_path
+            update_session_files(docx_path=save_path)
         elif ext == 'csv':
-            cached_csv_path = save_path
+            update_session_files(csv_path=save_path, csv_appends=None,
+                                 dataset_id=dataset.id if dataset is not None else None)
+        maybe_prune_files()
         # You do not need to set cached for setting files, but can be expanded
-        return jsonify(success=True, filename=timestamped_name, file_type=ext, mime_type=mime_type)
+        return jsonify(success=True, filename=os.path.basename(save_path), file_type=ext, mime_type=mime_type,
+                       cached=bool(cached))
 
     except Exception as e:
         return jsonify(success=False, error=str(e))
 
+# Subsystems app.py imports on first use; warm_up loads them ahead of the first request
+WARMUP_MODULES = ('plotly.express', 'docxtpl', 'docx.shared', 'flask_mail', 'google_auth_oauthlib.flow',
+                  'google.oauth2.credentials', 'googleapiclient.discovery', 'googleapiclient.http')
+# How many of the most recently cached datasets warm_up loads into dataset_store
+WARMUP_DATASETS = int(os.getenv('WARMUP_DATASETS', '0'))
+
+def warm_up(datasets=None):
+    """Import the lazily loaded subsystems and fill read-only caches before serving.
+
+    gunicorn.conf.py calls this in the master before fork when the app is preloaded, so
+    every worker shares the imported modules and loaded datasets copy-on-write, or once
+    per worker otherwise. It starts no threads or process pools: those don't survive fork
+    and are still created on first use in each worker.
+    """
+    start = time.perf_counter()
+    for name in WARMUP_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning("預熱載入 %s 失敗: %s", name, e)
+    report_template_class()
+    get_mail()
+    # The first figure loads plotly's templates and validators
+    build_chart_figure(pd.DataFrame({'x': ['a'], 'y': [1]}), 'x', 'y', 'bar')
+
+    count = WARMUP_DATASETS if datasets is None else datasets
+    cached = sorted((entry for entry in os.scandir(CACHE_FOLDER) if entry.name.endswith('.json')),
+                    key=lambda entry: entry.stat().st_mtime, reverse=True)
+    loaded = sum(dataset_store.get(entry.name[:-len('.json')]) is not None for entry in cached[:max(0, count)])
+    logger.info("預熱完成: %.2f 秒，已載入 %d 個資料集", time.perf_counter() - start, loaded)
+
 if __name__ == '__main__':
     app.run(debug=True, port="8000")
\ No newline at end of file
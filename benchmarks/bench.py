@@ -0,0 +1,376 @@
+"""Benchmark the report pipeline on synthetic data.
+
+Generates CSVs and .docx templates, drives the app through the Flask test client
+(and the ingestion/formula/chart functions directly) and writes latency
+percentiles, throughput and the process' peak RSS to a JSON file.
+
+    python benchmarks/bench.py --rows 1e4,1e5 --output bench.json
+    python benchmarks/bench.py --rows 1e6 --width 20 --density 1000 --charts 5
+    python benchmarks/bench.py --thresholds benchmarks/thresholds.json --baseline old.json
+
+Exits with status 1 when a stage fails (any run errors, or a report comes back
+with a failed chart or formula), or a threshold or the allowed regression
+against the baseline is exceeded. Runs in a scratch directory so the repo's uploads/,
+generated/ and cache/ are left alone.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import zipfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['analyze_csv', 'analyze_csv_cached', 'filter_data', 'evaluate_formula',
+          'render_preview', 'generate_chart', 'render_word']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', default='1e4,1e5', help='comma separated dataset sizes (1e4 .. 1e7)')
+    parser.add_argument('--width', type=int, default=4, help='numeric value columns per row')
+    parser.add_argument('--density', type=int, default=50, help='rows per calendar day')
+    parser.add_argument('--placeholders', type=int, default=20, help='formula placeholders in the template')
+    parser.add_argument('--charts', type=int, default=2, help='charts in the template')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per stage')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--workdir', default=None, help='scratch directory (default: a temp dir)')
+    parser.add_argument('--output', default='bench_results.json', help='machine-readable results')
+    parser.add_argument('--thresholds', default=None,
+                        help='JSON {stage or "rows:stage": {"p95_ms": .., "p50_ms": .., "process_peak_rss_mb": ..}}')
+    parser.add_argument('--baseline', default=None, help='previous results file to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.25,
+                        help='allowed p50 slowdown against --baseline (0.25 = 25%%)')
+    return parser.parse_args()
+
+
+def generate_csv(path, rows, width, density, seed=0):
+    import numpy as np
+    import pandas as pd
+
+    rng = np.random.default_rng(seed)
+    days = max(1, math.ceil(rows / density))
+    dates = pd.Timestamp('2020-01-01') + pd.to_timedelta(np.sort(rng.integers(0, days, rows)), unit='D')
+    columns = {
+        'date': dates.strftime('%Y-%m-%d'),
+        'order_id': np.arange(rows),
+        'region': rng.choice(['North', 'South', 'East', 'West'], rows),
+        'channel': rng.choice(['web', 'store', 'phone'], rows),
+        'quantity': rng.integers(1, 50, rows),
+    }
+    for i in range(width):
+        columns[f'value{i}'] = np.round(rng.gamma(2.0, 50.0, rows), 2)
+    pd.DataFrame(columns).to_csv(path, index=False)
+
+
+def generate_template(path, placeholders, charts):
+    from docx import Document
+
+    doc = Document()
+    doc.add_heading('Benchmark report {{ start_date }} - {{ end_date }}', level=1)
+    for i in range(placeholders):
+        doc.add_paragraph(f'Metric {i}: {{{{ m{i} }}}}')
+    for j in range(charts):
+        doc.add_paragraph(f'{{{{ chart{j} }}}}')
+    doc.save(path)
+
+
+def build_formulas(placeholders, charts, width):
+    templates = [
+        'SUM(value{v})', 'MEAN(value{v})', 'MAX(value{v})', "COUNT(region == 'North')",
+        'COUNT(DISTINCT(channel))', 'MODE(region)', 'SUM(quantity * value{v})', 'MEDIAN(value{v})',
+    ]
+    formulas = {
+        'start_date': {'type': 'fixed', 'value': 'start'},
+        'end_date': {'type': 'fixed', 'value': 'end'},
+    }
+    numeric = []
+    for i in range(placeholders):
+        if len(numeric) >= 2 and i % 5 == 0:
+            # Derived metrics exercise the dependency graph
+            value = f'{numeric[-1]} / {numeric[-2]}'
+        else:
+            value = templates[i % len(templates)].format(v=i % max(1, width))
+        formulas[f'm{i}'] = {'type': 'formula', 'value': value}
+        if not value.startswith('MODE'):
+            numeric.append(f'm{i}')
+    chart_types = ['line', 'bar', 'pie', 'hist']
+    for j in range(charts):
+        chart_type = chart_types[j % len(chart_types)]
+        x = {'line': 'date', 'bar': 'region', 'pie': 'channel', 'hist': 'value0'}[chart_type]
+        formulas[f'chart{j}'] = {'type': 'chart', 'x': x, 'y': 'value0' if width else 'quantity',
+                                 'chartType': chart_type}
+    return formulas
+
+
+def peak_rss_mb():
+    """Peak RSS of this process so far: ru_maxrss never goes down, so it is cumulative over
+    every stage and size run before, not a figure for one stage."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(usage / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def summarize(latencies, rows=None, error=None):
+    if not latencies:
+        return {'error': error or 'not run'}
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+        return round(ordered[index] * 1000, 3)
+
+    mean = sum(ordered) / len(ordered)
+    summary = {
+        'runs': len(ordered),
+        'p50_ms': percentile(50),
+        'p90_ms': percentile(90),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+        'mean_ms': round(mean * 1000, 3),
+        'ops_per_s': round(1 / mean, 3) if mean else None,
+        'process_peak_rss_mb': peak_rss_mb(),
+    }
+    if rows:
+        summary['rows_per_s'] = round(rows / mean) if mean else None
+    if error:
+        summary['error'] = error
+    return summary
+
+
+def timed(fn, repeat, setup=None):
+    """Run fn `repeat` times; returns (latencies, first error message)."""
+    latencies = []
+    error = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            error = error or f"{type(e).__name__}: {' '.join(str(e).split())}"
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, error
+
+
+def check(response, stage):
+    if response.status_code >= 400:
+        raise RuntimeError(f'{stage} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+# What build_report writes in place of a chart or variable it could not produce
+REPORT_ERROR_MARKERS = ['[圖表生成失敗]', '[處理錯誤', '[圖表設定不完整]', '[錯誤：']
+
+
+def check_preview(response):
+    """/render_preview answers 200 with per-variable "錯誤: ..." values; any of those is a failure."""
+    check(response, 'render_preview')
+    failed = sorted(name for name, value in response.get_json().items()
+                    if isinstance(value, str) and value.startswith('錯誤'))
+    if failed:
+        raise RuntimeError(f"render_preview failed for {', '.join(failed)}: {response.get_json()[failed[0]]}")
+    return response
+
+
+def check_report(response):
+    """A rendered .docx counts as a success only if every chart and formula made it in."""
+    check(response, 'render_word')
+    with zipfile.ZipFile(io.BytesIO(response.get_data())) as docx:
+        text = docx.read('word/document.xml').decode('utf-8')
+    failed = [marker for marker in REPORT_ERROR_MARKERS if marker in text]
+    if failed:
+        raise RuntimeError(f"render_word produced a report with {', '.join(failed)}")
+    return response
+
+
+def run_size(app_module, client, rows, args, data_dir, stages):
+    csv_path = os.path.join(data_dir, f'bench_{rows}_{args.width}_{args.density}.csv')
+    docx_path = os.path.join(data_dir, f'bench_{args.placeholders}_{args.charts}.docx')
+    if not os.path.exists(csv_path):
+        generate_csv(csv_path, rows, args.width, args.density)
+    if not os.path.exists(docx_path):
+        generate_template(docx_path, args.placeholders, args.charts)
+    formulas = build_formulas(args.placeholders, args.charts, args.width)
+
+    results = {}
+
+    def cold_ingest():
+        # Drop every cached copy so the CSV is parsed from scratch
+        app_module.dataset_store._datasets.clear()
+        content_hash = app_module.file_content_hash(csv_path)
+        for path in app_module._dataset_cache_paths(content_hash):
+            if os.path.exists(path):
+                os.remove(path)
+
+    if 'analyze_csv' in stages:
+        latencies, error = timed(lambda: app_module.analyze_csv(csv_path), args.repeat, setup=cold_ingest)
+        results['analyze_csv'] = summarize(latencies, rows, error)
+    dataset = app_module.analyze_csv(csv_path)
+    if 'analyze_csv_cached' in stages:
+        latencies, error = timed(lambda: app_module.analyze_csv(csv_path), args.repeat,
+                                 setup=app_module.dataset_store._datasets.clear)
+        results['analyze_csv_cached'] = summarize(latencies, rows, error)
+
+    # Session state is kept server-side under the opaque id in the cookie
+    sid = uuid.uuid4().hex
+    with client.session_transaction() as sess:
+        sess['sid'] = sid
+    app_module.dataset_store.update_session_files(sid, {'docx_path': docx_path, 'csv_path': csv_path,
+                                                        'dataset_id': dataset.id})
+
+    date_range = {'start_date': str(dataset.date_min), 'end_date': str(dataset.date_max)}
+    handle = check(client.post('/filter_data', json=date_range), 'filter_data').get_json()
+    if 'filter_data' in stages:
+        latencies, error = timed(lambda: check(client.post('/filter_data', json=date_range), 'filter_data'),
+                                 args.repeat)
+        results['filter_data'] = summarize(latencies, rows, error)
+
+    if 'evaluate_formula' in stages:
+        view = app_module.resolve_dataframe({'dataset': handle})
+        plain = {name: setting for name, setting in formulas.items() if setting.get('type') == 'formula'}
+
+        def evaluate_all():
+            context = {}
+            for name, setting in plain.items():
+                context[name] = app_module.evaluate_formula(setting['value'], view, context)
+
+        latencies, error = timed(evaluate_all, args.repeat)
+        results['evaluate_formula'] = summarize(latencies, rows, error)
+
+    if 'render_preview' in stages:
+        payload = {'dataset': handle, 'formulas': formulas, 'fidelity': 'vector'}
+        latencies, error = timed(lambda: check_preview(client.post('/render_preview', json=payload)),
+                                 args.repeat)
+        results['render_preview'] = summarize(latencies, rows, error)
+
+    def clear_chart_cache():
+        shutil.rmtree(app_module.CHART_CACHE_FOLDER, ignore_errors=True)
+        os.makedirs(app_module.CHART_CACHE_FOLDER, exist_ok=True)
+
+    if 'generate_chart' in stages:
+        view = app_module.resolve_dataframe({'dataset': handle})
+        chart = formulas.get('chart0') or {'x': 'date', 'y': 'quantity', 'chartType': 'line'}
+        output_path = os.path.join(app_module.GENERATED_FOLDER, 'bench_chart.png')
+        latencies, error = timed(
+            lambda: app_module.generate_chart(view, chart['x'], chart['y'], chart['chartType'], output_path),
+            args.repeat, setup=clear_chart_cache)
+        results['generate_chart'] = summarize(latencies, rows, error)
+
+    if 'render_word' in stages:
+        payload = {'dataset': handle, 'formulas': formulas, 'filename': 'bench_report.docx'}
+        latencies, error = timed(lambda: check_report(client.post('/render', json=payload)),
+                                 args.repeat, setup=clear_chart_cache)
+        results['render_word'] = summarize(latencies, rows, error)
+
+    return {'rows': rows, 'width': args.width, 'density': args.density, 'repeat': args.repeat,
+            'placeholders': args.placeholders, 'charts': args.charts, 'stages': results}
+
+
+def find_violations(report, thresholds, baseline, max_regression):
+    violations = []
+    for entry in report['results']:
+        for stage, summary in entry['stages'].items():
+            # A stage that errored (even on some runs) fails the gate, whatever its timings
+            if 'error' in summary:
+                violations.append(f"{entry['rows']} rows {stage}: {summary.get('runs', 0)}/{entry['repeat']} "
+                                  f"runs succeeded: {summary['error']}")
+            if 'p50_ms' not in summary:
+                continue
+            limits = thresholds.get(f"{entry['rows']}:{stage}") or thresholds.get(stage) or {}
+            for metric, limit in limits.items():
+                if summary.get(metric) is not None and summary[metric] > limit:
+                    violations.append(f"{entry['rows']} rows {stage}: {metric} {summary[metric]} > {limit}")
+
+    if baseline:
+        previous = {(e['rows'], stage): s for e in baseline.get('results', []) for stage, s in e['stages'].items()}
+        for entry in report['results']:
+            for stage, summary in entry['stages'].items():
+                before = previous.get((entry['rows'], stage), {}).get('p50_ms')
+                if before and summary.get('p50_ms') and summary['p50_ms'] > before * (1 + max_regression):
+                    violations.append(f"{entry['rows']} rows {stage}: p50 {summary['p50_ms']} ms vs baseline "
+                                      f"{before} ms (+{(summary['p50_ms'] / before - 1) * 100:.0f}%)")
+    return violations
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = parse_args()
+    sizes = [int(float(size)) for size in args.rows.split(',') if size.strip()]
+    stages = {stage.strip() for stage in args.stages.split(',') if stage.strip()}
+    output_path = os.path.abspath(args.output)
+    thresholds = {}
+    if args.thresholds:
+        with open(args.thresholds, 'r', encoding='utf-8') as f:
+            thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='reportgen-bench-'))
+    os.makedirs(workdir, exist_ok=True)
+    # The app creates uploads/, generated/ and cache/ relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as app_module
+    # Sessions may only point at files inside the upload folder
+    data_dir = os.path.join(workdir, app_module.UPLOAD_FOLDER)
+
+    client = app_module.app.test_client()
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'results': [],
+    }
+    for rows in sizes:
+        print(f'== {rows} rows', flush=True)
+        entry = run_size(app_module, client, rows, args, data_dir, stages)
+        for stage, summary in entry['stages'].items():
+            if 'p50_ms' in summary:
+                print(f"  {stage:<20} p50 {summary['p50_ms']:>10.1f} ms  p95 {summary['p95_ms']:>10.1f} ms  "
+                      f"process peak rss {summary['process_peak_rss_mb']} MB" + (f"  ({summary['error']})" if 'error' in summary else ''))
+            else:
+                print(f"  {stage:<20} failed: {summary['error']}")
+        report['results'].append(entry)
+    report['meta']['process_peak_rss_mb'] = peak_rss_mb()
+
+    violations = find_violations(report, thresholds, baseline, args.max_regression)
+    report['violations'] = violations
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'Results written to {output_path}')
+
+    if violations:
+        print('Regressions:')
+        for violation in violations:
+            print(f'  {violation}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Profile worker start-up: import time and memory of app.py, with and without warm-up.
+
+Every measurement runs in a fresh interpreter in a scratch directory:
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --top 30 --output startup.json
+
+Reports wall time and RSS after `import app` (the lazy start-up every worker pays)
+and after app.warm_up(), which of the deferred subsystems each phase has loaded,
+the slowest modules from `python -X importtime`, and on Linux how much of a forked
+child's memory is still shared with the parent, i.e. what gunicorn workers inherit
+from a preloaded master, with and without gc.freeze().
+"""
+import argparse
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top', type=int, default=15, help='slowest imports to list')
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per phase (best run is kept)')
+    parser.add_argument('--output', help='write the report as JSON here')
+    parser.add_argument('--workdir', help='scratch directory (default: a new temp dir)')
+    parser.add_argument('--probe', choices=['lazy', 'warm'], help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def smaps_mb():
+    totals = {}
+    with open('/proc/self/smaps_rollup', 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                totals[parts[0].rstrip(':')] = int(parts[1])
+    return {
+        'rss_mb': round(totals.get('Rss', 0) / 1024, 1),
+        'shared_mb': round((totals.get('Shared_Clean', 0) + totals.get('Shared_Dirty', 0)) / 1024, 1),
+        'private_mb': round((totals.get('Private_Clean', 0) + totals.get('Private_Dirty', 0)) / 1024, 1),
+    }
+
+
+def forked_child_memory():
+    """Memory of a forked child after one garbage collection, as a fresh worker would see it."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        gc.collect()
+        os.write(write_fd, json.dumps(smaps_mb()).encode('utf-8'))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def probe(mode):
+    """Runs inside the measured interpreter and prints one JSON result."""
+    sys.path.insert(0, REPO_ROOT)
+    start = time.perf_counter()
+    import app
+    result = {'import': {'seconds': round(time.perf_counter() - start, 3), 'rss_mb': rss_mb(),
+                         'modules': len(sys.modules)}}
+    if mode == 'warm':
+        start = time.perf_counter()
+        app.warm_up()
+        result['warm_up'] = {'seconds': round(time.perf_counter() - start, 3), 'rss_mb': rss_mb(),
+                             'modules': len(sys.modules)}
+        if hasattr(os, 'fork') and os.path.exists('/proc/self/smaps_rollup'):
+            result['fork'] = {'parent': smaps_mb(), 'child': forked_child_memory()}
+            gc.collect()
+            gc.freeze()
+            result['fork']['child_after_gc_freeze'] = forked_child_memory()
+    result['loaded'] = {name: name in sys.modules for name in app.WARMUP_MODULES}
+    print(json.dumps(result))
+
+
+def run_probe(mode, workdir):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--probe', mode],
+                                     cwd=workdir, stderr=subprocess.DEVNULL, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def slowest_imports(workdir, top):
+    code = f'import sys; sys.path.insert(0, {REPO_ROOT!r}); import app'
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=workdir,
+                          capture_output=True, text=True, check=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        rows.append({'module': name.strip(), 'self_ms': round(int(self_us) / 1000, 1),
+                     'cumulative_ms': round(int(cumulative_us) / 1000, 1)})
+    rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+    return rows[:top]
+
+
+def main():
+    args = parse_args()
+    if args.probe:
+        probe(args.probe)
+        return
+
+    # The app creates uploads/, generated/ and cache/ relative to the working directory
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='reportgen-startup-'))
+    os.makedirs(workdir, exist_ok=True)
+
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0]}}
+    for mode in ('lazy', 'warm'):
+        runs = [run_probe(mode, workdir) for _ in range(max(1, args.repeat))]
+        report[mode] = min(runs, key=lambda run: run['import']['seconds'])
+    report['slowest_imports'] = slowest_imports(workdir, args.top)
+
+    lazy, warm = report['lazy'], report['warm']
+    print(f"import app   {lazy['import']['seconds']:>7.3f} s  rss {lazy['import']['rss_mb']:>7.1f} MB  "
+          f"{lazy['import']['modules']} modules")
+    print(f"+ warm_up()  {warm['warm_up']['seconds']:>7.3f} s  rss {warm['warm_up']['rss_mb']:>7.1f} MB  "
+          f"{warm['warm_up']['modules']} modules")
+    print('deferred until first use: ' + ', '.join(name for name, loaded in lazy['loaded'].items() if not loaded))
+    if 'fork' in warm:
+        for label, key in (('forked worker', 'child'), ('  with gc.freeze', 'child_after_gc_freeze')):
+            memory = warm['fork'][key]
+            print(f"{label:<17} shared {memory['shared_mb']:>7.1f} MB  private {memory['private_mb']:>7.1f} MB")
+    print('slowest imports (cumulative):')
+    for row in report['slowest_imports']:
+        print(f"  {row['cumulative_ms']:>8.1f} ms  {row['module']}")
+
+    if args.output:
+        with open(os.path.abspath(args.output), 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Gunicorn settings, read automatically from the working directory by `gunicorn app:app`.
+
+PRELOAD=1 (the default) imports app.py once in the master and runs app.warm_up()
+there before the workers fork, so the heavy modules and any datasets it loads
+(WARMUP_DATASETS) are shared copy-on-write instead of being loaded per worker.
+With PRELOAD=0 each worker imports the app itself and, unless WARMUP=0, warms up
+after it boots. Without warm-up the subsystems load on the first request that
+needs them.
+
+WORKER_CLASS / WORKERS / THREADS pick gunicorn's worker model (sync, one worker by
+default). Render job progress is only streamed over server-sent events with gthread
+or async workers, where an open stream doesn't hold the only thread of a worker;
+with sync workers the browser polls the job status instead.
+"""
+import gc
+import os
+
+preload_app = os.getenv('PRELOAD', '1') != '0'
+warmup = os.getenv('WARMUP', '1') != '0'
+
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+workers = int(os.getenv('WORKERS', '1'))
+threads = int(os.getenv('THREADS', '1'))
+if threads > 1 and worker_class == 'sync':
+    # gunicorn switches to gthread itself when given threads
+    worker_class = 'gthread'
+# Read by app.py on import (in the master when preloading, else in each worker)
+os.environ.setdefault('RENDER_JOB_EVENTS', '1' if worker_class in ('gthread', 'gevent', 'eventlet') else '0')
+
+
+def when_ready(server):
+    if preload_app and warmup:
+        import app
+        app.warm_up()
+    if preload_app:
+        # Park everything allocated before fork in the permanent generation, so garbage
+        # collections in the workers don't write to (and un-share) the inherited pages
+        gc.collect()
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    if not preload_app and warmup:
+        import app
+        app.warm_up()
@@ -63,7 +63,9 @@ function showNotification(message, type = 'info', delay = 3000) { // type 可以
     });
 }
 
-let currentFilteredData = [];    //Filtered data set
+let currentDataset = null;       //Dataset handle returned by /filter_data
+let lastSentFormulas = null;     //Formulas the server's preview graph was last evaluated with
+let currentResults = {};         //Latest preview value of every variable
 let formulas = {};               //Formula or chart setting for each variable
 let currentVariable = '';        //The currently selected variable
 let startDateInput = '';
@@ -83,6 +85,9 @@ function getChartTypeName(chartType) {
 //Handle chart switching to show/hide
 function setupChartToggles() {
     document.querySelectorAll('.chart-preview-toggle').forEach(toggle => {
+        //Charts left untouched by a delta update keep their existing listener
+        if (toggle.dataset.bound) return;
+        toggle.dataset.bound = 'true';
         toggle.addEventListener('click', function() {
             const chartContainer = this.nextElementSibling;
             
@@ -101,11 +106,32 @@ function setupChartToggles() {
     });
 }
 
-function generateChartPreview(varName, xAxis, yAxis, chartType, filteredData, chartTitle) {
+function generateChartPreview(varName, chartResult) {
     const chartContainer = document.getElementById(`chart-${varName}`);
     chartContainer.innerHTML = '';
 
-    if (!filteredData || filteredData.length === 0) {
+    if (typeof chartResult === 'string' && chartResult.startsWith('錯誤')) {
+        chartContainer.innerHTML = `<p class="text-danger">${chartResult}</p>`;
+        return;
+    }
+
+    //Raster fidelity: the server has already rendered a PNG for the current dataset handle
+    if (!chartResult || !chartResult.chart) {
+        const img = document.createElement('img');
+        img.src = `/generated/${encodeURIComponent(varName)}.png?t=${Date.now()}`;
+        img.alt = varName;
+        img.style.maxWidth = '90%';
+        img.style.maxHeight = '100%';
+        img.onerror = () => {
+            chartContainer.innerHTML = '<p class="text-danger">沒有資料可顯示圖表</p>';
+        };
+        chartContainer.appendChild(img);
+        return;
+    }
+
+    //Vector fidelity: draw the aggregated chart spec returned by /render_preview
+    const spec = chartResult.chart;
+    if (!spec.x || spec.x.length === 0) {
         chartContainer.innerHTML = '<p class="text-danger">沒有資料可顯示圖表</p>';
         return;
     }
@@ -117,21 +143,16 @@ function generateChartPreview(varName, xAxis, yAxis, chartType, filteredData, ch
     plotArea.style.margin = '0 auto';
     chartContainer.appendChild(plotArea);
 
-    const finalTitle = (chartTitle !== undefined && chartTitle !== null) ? chartTitle : varName;
-
-    let plotData = [];
-    
-    //Completely modify the title setting method when creating layout
     let layout = {
         margin: { t: 80, b: 60, l: 60, r: 60 },
         height: 400,
         autosize: true
     };
-    
+
     //Set the title only if it is not empty
-    if (finalTitle !== "") {
+    if (spec.title) {
         layout.title = {
-            text: finalTitle,
+            text: spec.title,
             font: {
                 size: 20
             },
@@ -140,36 +161,22 @@ function generateChartPreview(varName, xAxis, yAxis, chartType, filteredData, ch
         };
     }
 
-    if (chartType === 'line') {
-        const grouped = {};
-        filteredData.forEach(row => {
-            const dateStr = new Date(row[xAxis]).toISOString().slice(0, 10);
-            grouped[dateStr] = (grouped[dateStr] || 0) + (Number(row[yAxis]) || 0);
-        });
-        const x = Object.keys(grouped).sort();
-        const y = x.map(date => grouped[date]);
-        plotData = [{ x, y, mode: 'lines+markers', type: 'scatter' }];
-    } else if (chartType === 'bar') {
-        const grouped = {};
-        filteredData.forEach(row => {
-            const key = row[xAxis];
-            grouped[key] = (grouped[key] || 0) + (Number(row[yAxis]) || 0);
-        });
-        const x = Object.keys(grouped);
-        const y = x.map(k => grouped[k]);
-        plotData = [{ x, y, type: 'bar' }];
-    } else if (chartType === 'hist') {
-        const values = filteredData.map(row => Number(row[yAxis])).filter(v => !isNaN(v));
-        plotData = [{ x: values, type: 'histogram', nbinsx: 20 }];
-    } else if (chartType === 'pie') {
-        const grouped = {};
-        filteredData.forEach(row => {
-            const key = row[xAxis];
-            grouped[key] = (grouped[key] || 0) + (Number(row[yAxis]) || 0);
-        });
-        const labels = Object.keys(grouped);
-        const values = labels.map(k => grouped[k]);
-        plotData = [{ labels, values, type: 'pie' }];
+    if (spec.chartType !== 'pie') {
+        layout.xaxis = { title: { text: spec.xLabel } };
+        layout.yaxis = { title: { text: spec.chartType === 'hist' ? 'count' : spec.yLabel } };
+    }
+
+    let plotData = [];
+    if (spec.chartType === 'line') {
+        plotData = [{ x: spec.x, y: spec.y, mode: 'lines+markers', type: 'scatter' }];
+    } else if (spec.chartType === 'bar') {
+        plotData = [{ x: spec.x, y: spec.y, type: 'bar' }];
+    } else if (spec.chartType === 'hist') {
+        //Bins are computed on the server; draw them as touching bars
+        plotData = [{ x: spec.x, y: spec.y, type: 'bar', width: spec.binWidth }];
+        layout.bargap = 0;
+    } else if (spec.chartType === 'pie') {
+        plotData = [{ labels: spec.x, values: spec.y, type: 'pie' }];
     } else {
         chartContainer.innerHTML = '<p class="text-danger">不支援的圖表類型</p>';
         return;
@@ -187,17 +194,17 @@ function generateChartPreview(varName, xAxis, yAxis, chartType, filteredData, ch
             scale: 2
         }
     };
-    
+
     //Clear previous chart
     Plotly.purge(plotArea);
-    
-    //Draw a new chart to make sure the title is set correctly
     Plotly.newPlot(plotArea, plotData, layout, config);
 }
 
 //New function: Set the quick modification button function
 function setupQuickEditButtons() {
     document.querySelectorAll('.quick-edit-chart-btn').forEach(btn => {
+        if (btn.dataset.bound) return;
+        btn.dataset.bound = 'true';
         btn.addEventListener('click', function() {
             const varName = this.getAttribute('data-variable');
             if (formulas[varName] && formulas[varName].type === 'chart') {
@@ -345,10 +352,7 @@ function openQuickEditModal(varName, chartSetting) {
                 chartType: newChartType,
                 chartTitle: newChartTitle,  //Make sure the title is passed to the backend
                 dpi: parseFloat(document.getElementById('quickEditDpi').value), 
-                data: currentFilteredData.map(row => ({
-                    [newXAxis]: row[newXAxis],
-                    [newYAxis]: row[newYAxis]
-                }))
+                dataset: currentDataset
             })
         })
         .then(response => response.json())
@@ -393,10 +397,14 @@ document.getElementById('filterForm').addEventListener('submit', function(e) {
     })
     .then(response => response.json())
     .then(data => {
-        currentFilteredData = data;
         hideLoading();
-        // alert(`成功套用篩選條件！目前資料量：${data.length} 筆`);
-        showNotification(`成功套用篩選條件！目前資料量：${data.length} 筆`, 'primary');
+        if (data.error) {
+            showNotification(data.error, 'danger');
+            return;
+        }
+        currentDataset = data;
+        // alert(`成功套用篩選條件！目前資料量：${data.row_count} 筆`);
+        showNotification(`成功套用篩選條件！目前資料量：${data.row_count} 筆`, 'primary');
         document.getElementById('generateSection').style.display = 'block';
 
         //Update the display of start_date, end_date
@@ -538,9 +546,21 @@ document.getElementById('saveFormulaBtn').addEventListener('click', function() {
     calculateAndRender();
 });
 
+//Variables added/changed/removed since the last preview request
+function formulasDelta(previous, next) {
+    const changed = {};
+    Object.keys(next).forEach(key => {
+        if (JSON.stringify(previous[key]) !== JSON.stringify(next[key])) {
+            changed[key] = next[key];
+        }
+    });
+    const removed = Object.keys(previous).filter(key => !(key in next));
+    return { changed, removed };
+}
+
 //===== 4. The real "instant calculation + update preview" ======
-function calculateAndRender() {
-    if (currentFilteredData.length === 0) {
+function calculateAndRender(forceFull = false) {
+    if (!currentDataset || currentDataset.row_count === 0) {
         console.warn('尚未篩選資料！');
         return;
     }
@@ -558,20 +578,58 @@ function calculateAndRender() {
         }
     });
 
+    //After the first request only the delta is sent; the server recomputes what it affects
+    const snapshot = JSON.parse(JSON.stringify(formulas));
+    const isDelta = !forceFull && lastSentFormulas !== null;
+    const body = {
+        dataset: currentDataset,
+        fidelity: 'vector'  //High-resolution PNGs are only exported by /render
+    };
+    if (isDelta) {
+        body.delta = formulasDelta(lastSentFormulas, snapshot);
+    } else {
+        body.formulas = snapshot;
+    }
+
     fetch('/render_preview', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            formulas: formulas,
-            data: currentFilteredData
-        })
+        body: JSON.stringify(body)
     })
-    .then(response => response.json())
-    .then(results => {
+    .then(response => {
+        //409: the server no longer holds our preview state, resend everything
+        if (response.status === 409) return null;
+        //A failed request answers {error} with a non-2xx status; a 200 body maps variables to values
+        return response.json().then(body => ({ ok: response.ok, body }));
+    })
+    .then(reply => {
         hideLoading();
 
+        if (reply === null) {
+            lastSentFormulas = null;
+            calculateAndRender(true);
+            return;
+        }
+        if (!reply.ok) {
+            showNotification(reply.body.error || '即時計算失敗', 'danger');
+            return;
+        }
+        const results = reply.body;
+
+        lastSentFormulas = snapshot;
+        if (!isDelta) {
+            currentResults = {};
+        } else {
+            body.delta.removed.forEach(key => delete currentResults[key]);
+        }
+        Object.assign(currentResults, results);
+
         document.querySelectorAll('.variable').forEach(span => {
             const varName = span.getAttribute('data-variable');
+            //Only variables the server reported as changed need to be redrawn
+            if (isDelta && !(varName in results) && !body.delta.removed.includes(varName)) {
+                return;
+            }
             span.innerHTML = '';
 
             if (formulas[varName] && formulas[varName].type === 'chart') {
@@ -580,13 +638,6 @@ function calculateAndRender() {
                 //Decryption: Record the title value when processing the chart
                 console.log(`處理變數 ${varName} 的圖表，標題設定:`, JSON.stringify(setting));
 
-                const filteredData = currentFilteredData
-                    .filter(row => row[setting.x] !== undefined && row[setting.y] !== undefined)
-                    .map(row => ({
-                        [setting.x]: row[setting.x],
-                        [setting.y]: row[setting.y]
-                    }));
-
                 const chartHTML = `
                     <div class="chart-container" style="width:1000px; height:600px; max-width:90vw; margin-left:auto; margin-right:auto;">
                         <button class="btn btn-outline-primary btn-sm chart-preview-toggle mb-2">
@@ -617,18 +668,10 @@ function calculateAndRender() {
                 `;
                 span.innerHTML = chartHTML;
 
-                //Key correction: Make sure the title is delivered correctly!
-                generateChartPreview(
-                    varName, 
-                    setting.x, 
-                    setting.y, 
-                    setting.chartType, 
-                    filteredData,
-                    setting.chartTitle  //Pass setting.chartTitle directly without any processing
-                );
+                generateChartPreview(varName, currentResults[varName]);
 
-            } else if (results[varName] !== undefined) {
-                const value = results[varName];
+            } else if (currentResults[varName] !== undefined) {
+                const value = currentResults[varName];
 
                 if (typeof value === 'string' && value.startsWith('錯誤')) {
                     span.textContent = value;
@@ -652,40 +695,86 @@ function calculateAndRender() {
 }
 
 //===== 5. The last button generates a Word report =======
+// The report renders as a background job; progress arrives over server-sent events when the
+// server offers them (events_url), else by polling, and the finished file is downloaded.
+function setLoadingText(text) {
+    const el = document.querySelector('#loadingOverlay .loading-text');
+    if (el) el.textContent = text;
+}
+
+function followRenderJob(job, onUpdate) {
+    return new Promise((resolve, reject) => {
+        const handle = status => {
+            onUpdate(status);
+            if (status.status === 'done') { resolve(status); return true; }
+            if (status.status === 'failed') { reject(new Error(status.error || '報表產生失敗')); return true; }
+            return false;
+        };
+
+        if (window.EventSource && job.events_url) {
+            const source = new EventSource(job.events_url);
+            source.onmessage = event => {
+                if (handle(JSON.parse(event.data))) source.close();
+            };
+            source.onerror = () => {
+                source.close();
+                pollRenderJob(job, handle, reject);
+            };
+        } else {
+            pollRenderJob(job, handle, reject);
+        }
+    });
+}
+
+function pollRenderJob(job, handle, reject) {
+    fetch(job.status_url)
+        .then(response => response.json())
+        .then(status => {
+            if (!handle(status)) setTimeout(() => pollRenderJob(job, handle, reject), 1000);
+        })
+        .catch(reject);
+}
+
 document.getElementById('generateForm').addEventListener('submit', function(e) {
     e.preventDefault();
     showLoading();
 
-    const filename = document.getElementById('docxFileName').value.trim() || 'weekly_report.docx';
+    let filename = document.getElementById('docxFileName').value.trim() || 'weekly_report.docx';
+    if (!filename.toLowerCase().endsWith('.docx')) {
+        filename += '.docx';  //Automatically fill in .docx
+    }
 
-    fetch('/render', {
+    fetch('/render_jobs', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
             formulas: formulas,
-            data: currentFilteredData,
+            dataset: currentDataset,
             filename: filename
         })
     })
-    .then(response => response.blob())
-    .then(blob => {
+    .then(response => response.json().then(data => {
+        if (!response.ok) throw new Error(data.error || '報表產生失敗');
+        return data;
+    }))
+    .then(job => followRenderJob(job, status => {
+        setLoadingText(`${status.message || '處理中'}（${Math.round((status.progress || 0) * 100)}%）`);
+    }).then(() => job))
+    .then(job => {
         hideLoading();
-        const url = window.URL.createObjectURL(blob);
+        setLoadingText('處理中，請稍候...');
         const a = document.createElement('a');
-        a.href = url;
-        const filenameInput = document.getElementById('docxFileName').value.trim() || 'weekly_report.docx';
-        let finalFilename = filenameInput;
-        if (!finalFilename.toLowerCase().endsWith('.docx')) {
-            finalFilename += '.docx';  //Automatically fill in .docx
-        }
-        a.download = finalFilename;
+        a.href = job.download_url;
+        a.download = filename;
         document.body.appendChild(a);
         a.click();
         a.remove();
     })
     .catch(err => {
         hideLoading();
+        setLoadingText('處理中，請稍候...');
         console.error('產生 Word 失敗', err);
+        showNotification(`產生 Word 失敗：${err.message}`, 'danger');
     });
 });
 
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# app creates uploads/, generated/ and cache/ relative to the working directory on import
+os.chdir(tempfile.mkdtemp(prefix='reportgen-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
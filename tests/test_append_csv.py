@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def rollups(monkeypatch):
+    monkeypatch.setattr(app, 'ROLLUP_MIN_ROWS', 1)
+
+
+def frame(seed, start, hours, regions=('North', 'South')):
+    rng = np.random.default_rng(seed)
+    price = rng.normal(20, 5, hours).round(2)
+    price[::17] = np.nan
+    return pd.DataFrame({
+        'date': (pd.Timestamp(start) + pd.to_timedelta(np.arange(hours) * 3, unit='h')).strftime('%Y-%m-%d %H:%M'),
+        'region': rng.choice(regions, hours),
+        'price': price,
+        'qty': rng.integers(0, 10, hours),
+        'score': rng.normal(0, 1, hours).round(3),
+    })
+
+
+@pytest.fixture
+def csvs(tmp_path):
+    def write(name, df):
+        path = tmp_path / name
+        df.to_csv(path, index=False)
+        return str(path)
+    return write
+
+
+def assert_same(appended, full):
+    pd.testing.assert_frame_equal(appended.df, full.df, check_categorical=False)
+    assert (appended.date_index == full.date_index).all()
+    assert (appended.date_min, appended.date_max) == (full.date_min, full.date_max)
+    assert appended.prefix_sums.keys() == full.prefix_sums.keys()
+    assert appended.prefix_counts.keys() == full.prefix_counts.keys()
+    for col, sums in full.prefix_sums.items():
+        np.testing.assert_allclose(appended.prefix_sums[col], sums, rtol=1e-12)
+    for col, counts in full.prefix_counts.items():
+        assert (appended.prefix_counts[col] == counts).all()
+    pd.testing.assert_frame_equal(appended.rollup.daily, full.rollup.daily, check_exact=False, rtol=1e-12)
+    assert (appended.rollup.day_starts == full.rollup.day_starts).all()
+    assert list(appended.rollup.by_dimension) == list(full.rollup.by_dimension)
+    for col, table in full.rollup.by_dimension.items():
+        def rows(t):
+            return t.assign(**{col: t[col].astype(str)}).sort_values(['date', col]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(rows(appended.rollup.by_dimension[col]), rows(table),
+                                      check_exact=False, rtol=1e-12)
+
+
+def test_appends_match_a_full_parse(csvs):
+    # The second part starts on the base's last day; the third brings a new region
+    parts = [frame(1, '2024-01-01', 100), frame(2, '2024-01-13 12:00', 60),
+             frame(3, '2024-01-21', 40, ('North', 'South', 'West'))]
+    base = app.analyze_csv(csvs('base.csv', parts[0]))
+    first = app.dataset_store.append_csv(base, csvs('w1.csv', parts[1]))
+    second = app.dataset_store.append_csv(first, csvs('w2.csv', parts[2]))
+    full = app.analyze_csv(csvs('all.csv', pd.concat(parts)))
+
+    assert second.segments == 2
+    assert_same(second, full)
+    assert list(second.df['region'].cat.categories) == ['North', 'South', 'West']
+    lo, hi = second.bounds('2024-01-13', '2024-01-20 23:59')
+    for func in ('sum', 'count', 'mean', 'min', 'max'):
+        assert second.range_aggregate(func, 'price', lo, hi) == \
+            pytest.approx(full.df['price'].iloc[lo:hi].agg(func))
+
+    # Another worker loads the chain from the cached segments
+    app.dataset_store._datasets.clear()
+    assert_same(app.dataset_store.get(second.id), full)
+    assert app.dataset_store.append_csv(first, csvs('w2.csv', parts[2])).id == second.id
+
+
+def test_infinite_values_in_an_append_drop_the_prefix_sums(csvs):
+    tail = frame(5, '2024-02-10', 30)
+    tail.loc[4, 'score'] = np.inf
+    parts = [frame(4, '2024-02-01', 80), tail]
+    base = app.analyze_csv(csvs('base.csv', parts[0]))
+    assert 'score' in base.prefix_sums
+    appended = app.dataset_store.append_csv(base, csvs('w1.csv', tail))
+    assert 'score' not in appended.prefix_sums
+    assert_same(appended, app.analyze_csv(csvs('all.csv', pd.concat(parts))))
+
+
+def test_out_of_order_append_is_resorted(csvs):
+    parts = [frame(6, '2024-03-10', 50), frame(7, '2024-03-01', 50)]
+    base = app.analyze_csv(csvs('base.csv', parts[0]))
+    appended = app.dataset_store.append_csv(base, csvs('old.csv', parts[1]))
+    assert appended.segments == 1
+    assert_same(appended, app.analyze_csv(csvs('all.csv', pd.concat(parts))))
+
+
+@pytest.mark.parametrize('change', [lambda df: df.drop(columns='qty'), lambda df: df.assign(qty='many')])
+def test_mismatched_schema_is_rejected(csvs, change):
+    base = app.analyze_csv(csvs('base.csv', frame(8, '2024-04-01', 40)))
+    with pytest.raises(ValueError, match='結構不符'):
+        app.dataset_store.append_csv(base, csvs('bad.csv', change(frame(9, '2024-04-10', 10))))
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'ROLLUP_MIN_ROWS', 1)
+    rng = np.random.default_rng(7)
+    n = 240
+    price = rng.normal(50, 20, n).round(2)
+    price[[3, 40, 41, 150]] = np.nan
+    spiky = rng.normal(0, 1, n).round(3)
+    spiky[[10, 200]] = [np.inf, -np.inf]
+    spiky[[11, 120]] = np.nan
+    frame = pd.DataFrame({
+        # Several rows a day, so row windows can start or end mid-day
+        'date': pd.Timestamp('2024-03-01') + pd.to_timedelta(np.sort(rng.integers(0, 20 * 24, n)), unit='h'),
+        'qty': rng.integers(0, 100, n),
+        'price': price,
+        'spiky': spiky,
+        'region': rng.choice(['North', 'South', 'East'], n),
+    })
+    path = tmp_path / 'data.csv'
+    frame.to_csv(path, index=False)
+    df, date_column, schema, _ = app.parse_csv(str(path))
+    return app.Dataset('test', df, date_column, schema)
+
+
+def windows(dataset):
+    n = len(dataset.date_index)
+    days = dataset.rollup.day_starts
+    yield from [(0, n), (0, 0), (5, 6), (17, 133), (41, 42), (100, n)]
+    yield from [(int(days[i]), int(days[j])) for i, j in [(0, 1), (2, 9), (3, len(days) - 1)]]
+    # Windows that split a day
+    yield from [(int(days[2]) + 1, int(days[9]) - 1), (int(days[4]) + 1, int(days[4]) + 2)]
+
+
+def expected(rows, func):
+    value = rows.agg(func)
+    return float('nan') if pd.isna(value) else value
+
+
+@pytest.mark.parametrize('column', ['qty', 'price', 'spiky'])
+@pytest.mark.parametrize('func', ['sum', 'count', 'mean', 'min', 'max'])
+def test_range_aggregate_matches_pandas(dataset, column, func):
+    for lo, hi in windows(dataset):
+        value = dataset.range_aggregate(func, column, lo, hi)
+        if value is None:
+            # Not answerable from the indexes; the caller reads the rows
+            continue
+        assert value == pytest.approx(expected(dataset.df[column].iloc[lo:hi], func), nan_ok=True), (lo, hi)
+
+
+def test_infinite_columns_fall_back_to_rows(dataset):
+    assert 'spiky' not in dataset.prefix_sums
+    assert dataset.range_aggregate('sum', 'spiky', 0, len(dataset.date_index)) is None
+    days = dataset.df['date'].dt.date
+    spikes = days[np.isinf(dataset.df['spiky'])]
+    # Up to the +inf row, between the two spikes, and past both
+    for start, end in [(days.iloc[0], spikes.iloc[1] - pd.Timedelta(days=1)),
+                       (spikes.iloc[0] + pd.Timedelta(days=1), spikes.iloc[1] - pd.Timedelta(days=1)),
+                       (spikes.iloc[1] + pd.Timedelta(days=1), days.iloc[-1])]:
+        view = dataset.slice(start, end)
+        assert app.evaluate_formula('SUM(spiky)', view) == pytest.approx(view['spiky'].sum())
+        assert app.evaluate_formula('MEAN(spiky)', view) == pytest.approx(view['spiky'].mean())
+
+
+def test_missing_values_are_skipped(dataset):
+    lo, hi = 0, len(dataset.date_index)
+    assert dataset.range_aggregate('count', 'price', lo, hi) == dataset.df['price'].count()
+    assert dataset.range_aggregate('sum', 'price', lo, hi) == pytest.approx(dataset.df['price'].sum())
+
+
+@pytest.mark.parametrize('dimension', [None, 'region'])
+def test_rollup_table_matches_rows(dataset, dimension):
+    measures = app.rollup_measures(dataset.df, dataset.date_column)
+    for lo, hi in windows(dataset):
+        table = dataset.rollup_table(lo, hi, dimension).reset_index(drop=True)
+        rows = app.build_rollup_table(dataset.df.iloc[lo:hi], dataset.date_column, measures, dimension)
+        pd.testing.assert_frame_equal(table, rows, check_dtype=False, check_categorical=False)
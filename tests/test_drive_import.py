@@ -0,0 +1,133 @@
+import hashlib
+import json
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+import app
+
+CREDENTIALS = {'token': 'tok', 'refresh_token': None, 'token_uri': 'https://oauth2.googleapis.com/token',
+               'client_id': 'x', 'client_secret': None, 'scopes': ['https://www.googleapis.com/auth/drive.readonly']}
+
+
+class DriveStub:
+    """Just enough of the Drive v3 files API: metadata and ranged media downloads."""
+
+    def __init__(self):
+        self.files = {}
+        self.downloads = {}
+        self.server = make_server('127.0.0.1', 0, self.api, threaded=True)
+        self.root = f'http://127.0.0.1:{self.server.port}/drive/v3/'
+
+    def put(self, file_id, name, data, mime_type='text/csv', modified='2024-01-01T00:00:00Z', md5=True):
+        self.files[file_id] = {'name': name, 'data': data, 'mimeType': mime_type, 'modifiedTime': modified,
+                               'md5Checksum': hashlib.md5(data).hexdigest() if md5 else None}
+
+    @Request.application
+    def api(self, request):
+        file_id = request.path.rsplit('/', 1)[-1]
+        entry = self.files.get(file_id)
+        if entry is None:
+            return Response('{}', 404, {'Content-Type': 'application/json'})
+        if request.args.get('alt') != 'media':
+            metadata = {key: value for key, value in entry.items() if key != 'data' and value is not None}
+            return Response(json.dumps(dict(metadata, id=file_id)), 200, {'Content-Type': 'application/json'})
+        data = entry['data']
+        start, end = map(int, request.headers['Range'].split('=')[1].split('-'))
+        if start == 0:
+            self.downloads[file_id] = self.downloads.get(file_id, 0) + 1
+        end = min(end, len(data) - 1)
+        return Response(data[start:end + 1], 206, {'Content-Range': f'bytes {start}-{end}/{len(data)}'})
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    stub = DriveStub()
+    thread = threading.Thread(target=stub.server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(app, 'DRIVE_API_ROOT', stub.root)
+    # Several ranged requests per file, and several parser chunks per download
+    monkeypatch.setattr(app, 'DRIVE_CHUNK_BYTES', 4096)
+    monkeypatch.setattr(app, 'CSV_CHUNK_ROWS', 100)
+    app._drive_clients.clear()
+    yield stub
+    stub.server.shutdown()
+    app._drive_clients.clear()
+
+
+@pytest.fixture
+def client():
+    client = app.app.test_client()
+    with client.session_transaction() as s:
+        s['credentials'] = CREDENTIALS
+    return client
+
+
+def csv_bytes(seed, rows=600):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'date': pd.date_range('2024-01-01', periods=rows, freq='h').strftime('%Y-%m-%d %H:%M'),
+        'region': rng.choice(['North', 'South', 'East'], rows),
+        'sales': rng.normal(100, 30, rows).round(2),
+        'qty': rng.integers(0, 50, rows),
+    }).to_csv(index=False).encode('utf-8')
+
+
+def import_file(client, file_id, file_type='csv'):
+    body = client.get(f'/import_drive_file?file_id={file_id}&type={file_type}').get_json()
+    assert body['success'], body
+    return body
+
+
+def session_files(client):
+    with client.session_transaction() as s:
+        return app.dataset_store.session_files(s.get('sid'))
+
+
+def test_unchanged_file_is_not_downloaded_again(drive, client):
+    drive.put('same', 'sales.csv', csv_bytes(1))
+    first = import_file(client, 'same')
+    second = import_file(client, 'same')
+    assert not first['cached'] and second['cached']
+    assert second['filename'] == first['filename']
+    assert drive.downloads['same'] == 1
+    assert session_files(client)['csv_path'] == app.read_drive_manifest()['same']['path']
+
+
+def test_changed_file_is_fetched_again(drive, client):
+    drive.put('changing', 'sales.csv', csv_bytes(2))
+    import_file(client, 'changing')
+    drive.put('changing', 'sales.csv', csv_bytes(3), modified='2024-02-01T00:00:00Z')
+    assert not import_file(client, 'changing')['cached']
+    assert drive.downloads['changing'] == 2
+    entry = app.read_drive_manifest()['changing']
+    assert entry['md5Checksum'] == hashlib.md5(csv_bytes(3)).hexdigest()
+    with open(entry['path'], 'rb') as f:
+        assert f.read() == csv_bytes(3)
+
+
+def test_modified_time_is_compared_without_a_checksum(drive, client):
+    drive.put('native', 'settings.json', b'{"a": 1}', mime_type='application/json', md5=False)
+    import_file(client, 'native', 'json')
+    assert import_file(client, 'native', 'json')['cached']
+    drive.put('native', 'settings.json', b'{"a": 2}', mime_type='application/json',
+              modified='2024-03-01T00:00:00Z', md5=False)
+    assert not import_file(client, 'native', 'json')['cached']
+    assert drive.downloads['native'] == 2
+
+
+def test_streamed_csv_matches_parse_csv(drive, client):
+    drive.put('stream', 'sales.csv', csv_bytes(4))
+    import_file(client, 'stream')
+    files = session_files(client)
+    dataset = app.dataset_store.get(files['dataset_id'])
+    df, date_column, schema, _ = app.parse_csv(files['csv_path'])
+    pd.testing.assert_frame_equal(dataset.df, df)
+    assert dataset.date_column == date_column
+    assert {col: info['kind'] for col, info in dataset.schema.items()} == \
+        {col: info['kind'] for col, info in schema.items()}
+    assert dataset.id == app.file_content_hash(files['csv_path'])
@@ -0,0 +1,146 @@
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import app
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'sales': [10.0, 25.5, 3.0, 40.0, 12.5, 7.0],
+        'qty': [1, 6, 2, 9, 5, 8],
+        'region': ['North', 'South', 'North', 'East', 'North', 'South'],
+        'Unit Price': [2.0, 3.0, 1.5, 4.0, 2.5, 1.0],
+    })
+
+
+@pytest.mark.parametrize('formula, expected', [
+    ('SUM(sales)', lambda df: df['sales'].sum()),
+    ('MEAN(sales)', lambda df: df['sales'].mean()),
+    ('MAX(qty) - MIN(qty)', lambda df: df['qty'].max() - df['qty'].min()),
+    ('SUM(sales * qty)', lambda df: (df['sales'] * df['qty']).sum()),
+    ('SUM(df["Unit Price"])', lambda df: df['Unit Price'].sum()),
+    ('COUNT(DISTINCT(region))', lambda df: df['region'].nunique()),
+    ("COUNT(region == 'North')", lambda df: (df['region'] == 'North').sum()),
+    ("COUNT(region in ['North', 'East'])", lambda df: df['region'].isin(['North', 'East']).sum()),
+    ('round(SUM(sales) / COUNT(qty), 2)', lambda df: round(df['sales'].sum() / df['qty'].count(), 2)),
+    ('np.sqrt(SUM(qty))', lambda df: np.sqrt(df['qty'].sum())),
+])
+def test_aggregates_match_pandas(df, formula, expected):
+    assert app.evaluate_formula(formula, df) == pytest.approx(expected(df))
+
+
+def test_columns_are_case_insensitive(df):
+    assert app.evaluate_formula('SUM(SALES)', df) == df['sales'].sum()
+
+
+def test_variables_resolve_through_formulas(df):
+    formulas = {'total': 'SUM(sales)', 'n': 'COUNT(qty)'}
+    assert app.evaluate_formula('total / n', df, {}, formulas) == pytest.approx(df['sales'].mean())
+
+
+def test_undefined_variable(df):
+    with pytest.raises(ValueError, match="name 'missing' is not defined"):
+        app.evaluate_formula('missing + 1', df)
+
+
+def test_quoted_text_is_returned_as_is(df):
+    assert app.evaluate_formula("'hello'", df) == 'hello'
+
+
+@pytest.mark.parametrize('formula', [
+    "__import__('os').system('true')",
+    'df.__class__',
+    '(lambda: 1)()',
+    '[x for x in qty]',
+    'open("app.py")',
+    'sales.sum()',
+])
+def test_unsafe_syntax_is_rejected(df, formula):
+    with pytest.raises(ValueError):
+        app.evaluate_formula(formula, df)
+
+
+def test_conditional_expression_on_aggregates(df):
+    assert app.evaluate_formula('SUM(sales) if SUM(sales) > 10 else 0', df) == df['sales'].sum()
+    assert app.evaluate_formula('SUM(sales) if SUM(sales) > 1000 else 0', df) == 0
+
+
+def test_conditional_expression_per_row(df):
+    expected = np.where(df['qty'] > 5, df['sales'], 0).sum()
+    assert app.evaluate_formula('SUM(sales if qty > 5 else 0)', df) == pytest.approx(expected)
+
+
+def test_conditional_expression_only_evaluates_chosen_branch(df):
+    assert app.evaluate_formula('1 if COUNT(qty) > 0 else missing', df) == 1
+
+
+def test_small_powers(df):
+    assert app.evaluate_formula('2 ** 10', df) == 1024
+    assert app.evaluate_formula('2 ** -1', df) == 0.5
+    assert app.evaluate_formula('SUM(qty ** 2)', df) == (df['qty'] ** 2).sum()
+
+
+@pytest.mark.parametrize('formula', ['9 ** 9 ** 9', '10 ** 100000', 'n ** 10 ** 8'])
+def test_oversized_powers_are_rejected_quickly(df, formula):
+    start = time.perf_counter()
+    with pytest.raises(ValueError, match='次方結果過大'):
+        app.evaluate_formula(formula, df, {'n': 7})
+    assert time.perf_counter() - start < 1
+
+
+def test_compiled_plans_are_shared_per_schema(df):
+    columns = tuple(df.columns)
+    assert app.compile_formula('SUM(sales)', columns) is app.compile_formula('SUM(sales)', columns)
+
+
+@pytest.mark.parametrize('condition', [
+    "qty > 5 & region == 'North'",
+    "qty > 5 | region == 'North'",
+    "qty > 5 & region == 'South' | sales < 5",
+    "(qty > 5) & (region == 'South')",
+    "qty >= 2 & qty <= 6",
+    "~(qty > 5) & region != 'East'",
+    "region == 'North' and qty > 1 or sales > 30",
+])
+def test_count_conditions_match_df_query(df, condition):
+    expected = len(df.query(condition, engine='python'))
+    assert app.evaluate_formula(f'COUNT({condition})', df) == expected
+
+
+def test_boolean_indexed_aggregate_matches_baseline(df):
+    # The eval-based engine answered 85.0 for this template formula on this frame
+    assert app.evaluate_formula('SUM(sales[qty > 3])', df) == 85.0
+    assert app.evaluate_formula("MEAN(sales[region == 'North'])", df) == \
+        pytest.approx(df.loc[df['region'] == 'North', 'sales'].mean())
+    assert app.evaluate_formula("COUNT(qty[qty > 3 & region != 'East'])", df) == 3
+
+
+@pytest.mark.parametrize('formula', ['sales[0]', 'sales[1:3]', 'df[0]'])
+def test_positional_subscripts_are_rejected(df, formula):
+    with pytest.raises(ValueError):
+        app.evaluate_formula(f'SUM({formula})', df)
+
+
+def test_count_of_negated_column_counts_rows(df):
+    assert app.evaluate_formula('COUNT(-qty)', df) == len(df)
+    assert app.evaluate_formula('COUNT(~(qty > 5))', df) == (df['qty'] <= 5).sum()
+    assert app.evaluate_formula('COUNT(not qty > 5)', df) == (df['qty'] <= 5).sum()
+
+
+def test_invert_is_bitwise_on_integers(df):
+    assert app.evaluate_formula('~5', df) == -6
+    assert app.evaluate_formula('SUM(~qty)', df) == (~df['qty']).sum()
+
+
+@pytest.mark.parametrize('formula', ["'a' * 10 ** 10", "10 ** 9 * 'ab'", "len('x' * n)"])
+def test_oversized_repetition_is_rejected(df, formula):
+    with pytest.raises(ValueError, match='重複結果過大'):
+        app.evaluate_formula(formula, df, {'n': 10 ** 8})
+
+
+def test_small_repetition(df):
+    assert app.evaluate_formula("'ab' * 3", df) == 'ababab'
@@ -0,0 +1,116 @@
+import os
+import time
+
+import pandas as pd
+import pytest
+from docx import Document
+
+import app
+
+
+@pytest.fixture
+def template(tmp_path):
+    path = str(tmp_path / 'template.docx')
+    doc = Document()
+    doc.add_paragraph('Total {{ total }}')
+    doc.save(path)
+    return path
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame({'date': pd.date_range('2024-01-01', periods=5), 'sales': [1.0, 2.0, 3.0, 4.0, 5.0]})
+
+
+def wait_for(job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = app.read_render_job(job_id)
+        # The counters are settled just after the final status write
+        idle = app.render_job_stats['queued'] == app.render_job_stats['running'] == 0
+        if job['status'] in ('done', 'failed') and idle:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'job {job_id} did not finish')
+
+
+def write_job(status, age, **fields):
+    job = dict({'id': os.urandom(16).hex(), 'status': status, 'filename': 'r.docx', 'progress': 0.0,
+                'message': '', 'error': None, 'submitted_at': time.time() - age,
+                'started_at': None, 'finished_at': None}, **fields)
+    os.makedirs(app._render_job_folder(job['id']), exist_ok=True)
+    app.write_render_job(job)
+    return job
+
+
+def test_job_runs_to_done(template, frame):
+    job = app.submit_render_job(template, {'total': {'type': 'formula', 'value': 'SUM(sales)'}}, 'r.docx', frame)
+    assert job['status'] == 'queued'
+    finished = wait_for(job['id'])
+    assert finished['status'] == 'done'
+    assert finished['progress'] == 1.0
+    assert finished['started_at'] >= finished['submitted_at']
+    assert finished['finished_at'] >= finished['started_at']
+    assert os.path.exists(os.path.join(app._render_job_folder(job['id']), 'report.docx'))
+
+
+def test_job_with_missing_template_fails(frame):
+    before = dict(app.render_job_stats)
+    job = app.submit_render_job('missing.docx', {}, 'r.docx', frame)
+    finished = wait_for(job['id'])
+    assert finished['status'] == 'failed'
+    assert finished['error']
+    assert app.render_job_stats['failed'] == before['failed'] + 1
+    assert app.render_job_stats['running'] == before['running']
+
+
+def test_orphaned_job_is_failed_then_pruned(monkeypatch):
+    orphan = write_job('running', app.RENDER_JOB_TIMEOUT + 60, started_at=time.time() - 100)
+    recent = write_job('running', 5, started_at=time.time() - 5)
+    app.prune_render_jobs()
+    assert app.read_render_job(orphan['id'])['status'] == 'failed'
+    assert app.read_render_job(recent['id'])['status'] == 'running'
+
+    # Once past the TTL the failed job is removed like any finished one
+    monkeypatch.setattr(app, 'RENDER_JOB_TTL', -1)
+    app.prune_render_jobs()
+    assert app.read_render_job(orphan['id']) is None
+    assert not os.path.exists(app._render_job_folder(orphan['id']))
+
+
+def test_job_counters_survive_status_write_failure(monkeypatch, template, frame):
+    before = dict(app.render_job_stats)
+
+    def fail(job):
+        raise OSError('disk full')
+    monkeypatch.setattr(app, 'write_render_job', fail)
+    with app._render_jobs_lock:
+        app.render_job_stats['queued'] += 1
+    with pytest.raises(OSError):
+        app._run_render_job({'id': 'f' * 32, 'status': 'queued', 'finished_at': None}, template, {}, frame)
+    assert app.render_job_stats['queued'] == before['queued']
+    assert app.render_job_stats['running'] == before['running']
+    assert app.render_job_stats['failed'] == before['failed'] + 1
+
+
+def test_event_stream_sends_keep_alive_between_changes(monkeypatch):
+    monkeypatch.setattr(app, 'RENDER_JOB_EVENTS_INTERVAL', 0.01)
+    job = write_job('running', 1)
+    response = app.app.test_client().get(f"/render_jobs/{job['id']}/events")
+    chunks = response.response
+    assert next(chunks).decode().startswith('data: ')
+    assert next(chunks).decode() == ': keep-alive\n\n'
+    app.write_render_job(dict(job, status='done', progress=1.0))
+    rest = b''.join(chunks).decode()
+    assert '"status": "done"' in rest
+    response.close()
+
+
+@pytest.mark.parametrize('enabled', [True, False])
+def test_events_url_is_only_offered_when_enabled(monkeypatch, template, frame, enabled):
+    monkeypatch.setattr(app, 'RENDER_JOB_EVENTS', enabled)
+    monkeypatch.setattr(app, 'prepare_report', lambda payload: (template, {}, 'r.docx', frame))
+    response = app.app.test_client().post('/render_jobs', json={})
+    assert response.status_code == 202
+    assert ('events_url' in response.get_json()) == enabled
+    wait_for(response.get_json()['job_id'])
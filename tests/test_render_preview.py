@@ -0,0 +1,81 @@
+import threading
+
+import pandas as pd
+import pytest
+
+import app
+
+FORMULAS = {
+    'total': {'type': 'formula', 'value': 'SUM(sales)'},
+    'n': {'type': 'formula', 'value': 'COUNT(sales)'},
+    'ratio': {'type': 'formula', 'value': 'total / n'},
+    'label': {'type': 'fixed', 'value': 'hi'},
+}
+
+
+@pytest.fixture
+def handle(tmp_path):
+    path = tmp_path / 'sales.csv'
+    pd.DataFrame({'date': pd.date_range('2024-01-01', periods=10).strftime('%Y-%m-%d'),
+                  'sales': [float(i) for i in range(1, 11)]}).to_csv(path, index=False)
+    dataset = app.dataset_store.load_csv(str(path))
+    return {'dataset_id': dataset.id, 'start_date': '2024-01-01', 'end_date': '2024-01-10'}
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def preview(client, handle, **body):
+    return client.post('/render_preview', json=dict(body, dataset=handle))
+
+
+def test_delta_reports_what_it_changed(client, handle):
+    full = preview(client, handle, formulas=FORMULAS)
+    assert full.status_code == 200
+    assert full.get_json() == {'total': 55.0, 'n': 10, 'ratio': 5.5, 'label': 'hi'}
+
+    changed = preview(client, handle, delta={'changed': {'n': {'type': 'formula', 'value': 'COUNT(sales) * 2'}}})
+    assert changed.get_json() == {'n': 20, 'ratio': 2.75}
+    removed = preview(client, handle, delta={'changed': {}, 'removed': ['label']})
+    assert removed.get_json() == {}
+
+
+def test_lost_state_forces_a_resync(client, handle):
+    preview(client, handle, formulas=FORMULAS)
+    # As after eviction, a restart or a request landing on another worker
+    with app._preview_sessions_lock:
+        app.preview_sessions.clear()
+    delta = {'changed': {'label': {'type': 'fixed', 'value': 'yo'}}}
+    stale = preview(client, handle, delta=delta)
+    assert stale.status_code == 409
+    assert stale.get_json()['resync'] is True
+
+    resent = preview(client, handle, formulas=dict(FORMULAS, label=delta['changed']['label']))
+    assert resent.status_code == 200 and resent.get_json()['label'] == 'yo'
+    assert preview(client, handle, delta={'changed': {}, 'removed': ['ratio']}).status_code == 200
+
+
+def test_variable_named_error_is_a_result(client, handle):
+    response = preview(client, handle, formulas={'error': {'type': 'formula', 'value': 'SUM(sales)'},
+                                                 'bad': {'type': 'formula', 'value': 'SUM(missing)'}})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['error'] == 55.0
+    assert body['bad'].startswith('錯誤')
+
+
+def test_requests_of_one_session_are_serialized(client, handle):
+    preview(client, handle, formulas=FORMULAS)
+    with client.session_transaction() as s:
+        lock = app.preview_lock(s['preview_id'])
+    responses = []
+    delta = {'changed': {'n': {'type': 'formula', 'value': 'COUNT(sales) + 1'}}}
+    with lock:
+        thread = threading.Thread(target=lambda: responses.append(preview(client, handle, delta=delta)))
+        thread.start()
+        thread.join(0.3)
+        assert thread.is_alive()
+    thread.join(10)
+    assert responses[0].get_json() == {'n': 11, 'ratio': 5.0}
@@ -0,0 +1,75 @@
+import os
+import time
+
+import pandas as pd
+
+import app
+
+DAY = 24 * 3600
+
+
+def make(folder, name, size=100, age=0):
+    path = os.path.join(str(folder), name)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def remaining(folder):
+    return sorted(entry.name for entry in os.scandir(folder) if entry.is_file())
+
+
+def test_old_files_are_removed(tmp_path):
+    make(tmp_path, 'old.csv', age=3 * DAY)
+    make(tmp_path, 'new.csv', age=60)
+    (tmp_path / 'jobs').mkdir()
+    make(tmp_path / 'jobs', 'ancient.docx', age=30 * DAY)
+    assert app.prune_folder(str(tmp_path), DAY, 0) == (1, 100)
+    assert remaining(tmp_path) == ['new.csv']
+    assert remaining(tmp_path / 'jobs') == ['ancient.docx']
+
+
+def test_size_cap_removes_least_recently_modified_first(tmp_path):
+    for i, age in enumerate([50, 40, 30, 20, 10]):
+        make(tmp_path, f'{i}.csv', size=100, age=age)
+    assert app.prune_folder(str(tmp_path), DAY, 250) == (3, 300)
+    assert remaining(tmp_path) == ['3.csv', '4.csv']
+
+
+def test_kept_files_survive_age_and_size_limits(tmp_path):
+    kept = make(tmp_path, 'settings.json', size=1000, age=10 * DAY)
+    make(tmp_path, 'old.csv', age=10 * DAY)
+    make(tmp_path, 'new.csv', age=10)
+    app.prune_folder(str(tmp_path), DAY, 150, keep=[kept, None])
+    assert remaining(tmp_path) == ['new.csv', 'settings.json']
+
+
+def test_grouped_files_go_together(tmp_path):
+    old, fresh = 'a' * 64, 'b' * 64
+    make(tmp_path, f'{old}.feather', size=500, age=5 * DAY)
+    make(tmp_path, f'{old}.json', size=10, age=5 * DAY)
+    # The newest file of an entry dates it
+    make(tmp_path, f'{fresh}.feather', size=500, age=5 * DAY)
+    make(tmp_path, f'{fresh}.json', size=10, age=60)
+    make(tmp_path, 'notes.txt', age=5 * DAY)
+    assert app.prune_folder(str(tmp_path), DAY, 0, group=app._dataset_cache_entry) == (2, 510)
+    assert remaining(tmp_path) == [f'{fresh}.feather', f'{fresh}.json', 'notes.txt']
+
+
+def test_dataset_cache_keeps_live_datasets(tmp_path, monkeypatch):
+    path = tmp_path / 'live.csv'
+    pd.DataFrame({'date': ['2024-05-01', '2024-05-02'], 'sales': [1.0, 2.0]}).to_csv(path, index=False)
+    live = app.analyze_csv(str(path))
+    stale = time.time() - DAY
+    for cached in app._dataset_cache_paths(live.id):
+        os.utime(cached, (stale, stale))
+    orphan = 'c' * 64
+    for ext in ('.feather', '.json'):
+        make(app.CACHE_FOLDER, orphan + ext, age=DAY)
+    monkeypatch.setattr(app, 'DATASET_CACHE_RETENTION_SECONDS', 3600)
+    app.prune_dataset_cache()
+    names = remaining(app.CACHE_FOLDER)
+    assert f'{live.id}.feather' in names and f'{live.id}.json' in names
+    assert not any(name.startswith(orphan) for name in names)